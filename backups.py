@@ -0,0 +1,295 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+import time
+import zipfile
+import zlib
+from datetime import datetime
+
+from metrics import METRICS
+from storage import read_json, run_io, write_file_atomic
+
+# Backups are incremental: the exported players.json/feed_data.json are cut
+# into chunks, each stored once under its SHA-256 in backups/chunks/
+# (zlib-compressed), and a manifest in backups/manifests/ lists the chunks
+# of every file. A backup only writes the chunks that changed since any
+# earlier one, so an hourly backup costs little more than reading the data.
+# /backup sends the chunks the admin doesn't have yet: those missing from the
+# last backup that was actually sent, recorded in backups/sent.json.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "3600"))  # seconds; 0 turns scheduled backups off
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "48"))  # manifests kept; chunks only they used are deleted
+CHUNK_RECORDS = 32  # average records per chunk
+CHUNK_MAX = 1024 * 1024  # cut here if no record border comes along
+
+# The line opening a record keyed by a user id, at any depth (farms in
+# players.json, mills and plants in feed_data.json)
+RECORD_START = re.compile(rb'\n *"-?\d+": \{\n')
+
+
+def chunk_bounds(data):
+    # Chunk borders that depend on the content, not on offsets: a chunk ends
+    # before a record whose opening line hashes to 0 mod CHUNK_RECORDS. So
+    # an edited farm changes only its own chunk, and farms added or removed
+    # don't shift the borders of the others.
+    start = 0
+    for match in RECORD_START.finditer(data):
+        cut = match.start() + 1
+        while cut - start > CHUNK_MAX:
+            yield start, start + CHUNK_MAX
+            start += CHUNK_MAX
+        if cut > start and zlib.crc32(match.group()) % CHUNK_RECORDS == 0:
+            yield start, cut
+            start = cut
+    while len(data) - start > CHUNK_MAX:
+        yield start, start + CHUNK_MAX
+        start += CHUNK_MAX
+    if len(data) > start:
+        yield start, len(data)
+
+
+def chunk_path(digest, directory=BACKUP_DIR):
+    return os.path.join(directory, "chunks", digest[:2], digest)
+
+
+def manifest_paths(directory=BACKUP_DIR):
+    # Oldest first
+    folder = os.path.join(directory, "manifests")
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(".json")]
+
+
+def latest_manifest(directory=BACKUP_DIR):
+    paths = manifest_paths(directory)
+    return (paths[-1], read_json(paths[-1], None)) if paths else (None, None)
+
+
+def chunk_file(path, directory):
+    # {"size", "sha256", "chunks"} for one file, storing the chunks we don't
+    # have yet; also returns the new chunks' digests and compressed bytes
+    entry = {"size": os.path.getsize(path), "chunks": []}
+    whole = hashlib.sha256()
+    new, written = [], 0
+    if entry["size"]:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in chunk_bounds(data):
+                chunk = data[start:end]
+                whole.update(chunk)
+                digest = hashlib.sha256(chunk).hexdigest()
+                entry["chunks"].append(digest)
+                target = chunk_path(digest, directory)
+                if not os.path.exists(target):
+                    packed = zlib.compress(chunk, 6)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    write_file_atomic(target, packed)
+                    new.append(digest)
+                    written += len(packed)
+    entry["sha256"] = whole.hexdigest()
+    return entry, new, written
+
+
+def snapshot(files, directory=BACKUP_DIR):
+    # Back up the given files. Returns (manifest path, manifest, digests of
+    # the chunks this backup added, their compressed bytes); if nothing
+    # changed since the last backup that one is returned, with no chunks.
+    files_entry, new, written = {}, [], 0
+    for path in files:
+        entry, added, size = chunk_file(path, directory)
+        files_entry[os.path.basename(path)] = entry
+        new += added
+        written += size
+    last_path, last = latest_manifest(directory)
+    if last is not None and last["files"] == files_entry:
+        return last_path, last, [], 0
+    manifest = {"created": datetime.now().isoformat(timespec="seconds"), "files": files_entry}
+    path = os.path.join(directory, "manifests", datetime.now().strftime("%Y%m%d-%H%M%S-%f") + ".json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file_atomic(path, json.dumps(manifest))
+    prune(directory)
+    return path, manifest, new, written
+
+
+def prune(directory=BACKUP_DIR, keep=BACKUP_KEEP):
+    # Drop the oldest manifests past `keep`, then chunks no manifest uses
+    paths = manifest_paths(directory)
+    if len(paths) <= keep:
+        return 0
+    for path in paths[:-keep]:
+        os.remove(path)
+    used = set()
+    for path in paths[-keep:]:
+        for entry in read_json(path, {"files": {}})["files"].values():
+            used.update(entry["chunks"])
+    removed = 0
+    chunks = os.path.join(directory, "chunks")
+    for folder in os.listdir(chunks):
+        for digest in os.listdir(os.path.join(chunks, folder)):
+            if digest not in used:
+                os.remove(os.path.join(chunks, folder, digest))
+                removed += 1
+    return removed
+
+
+def rebuild(entry, out, directory=BACKUP_DIR):
+    # Write a backed up file to the binary file out, checking its hash
+    whole = hashlib.sha256()
+    for digest in entry["chunks"]:
+        with open(chunk_path(digest, directory), "rb") as f:
+            chunk = zlib.decompress(f.read())
+        whole.update(chunk)
+        out.write(chunk)
+    if whole.hexdigest() != entry["sha256"]:
+        raise ValueError("backup is corrupt, hash mismatch")
+
+
+def restore(manifest, target, directory=BACKUP_DIR):
+    # Recreate the files of a manifest in the directory target
+    os.makedirs(target, exist_ok=True)
+    paths = []
+    for name, entry in manifest["files"].items():
+        path = os.path.join(target, name)
+        with open(path + ".tmp", "wb") as f:
+            rebuild(entry, f, directory)
+        os.replace(path + ".tmp", path)
+        paths.append(path)
+    return paths
+
+
+def sent_path(directory=BACKUP_DIR):
+    return os.path.join(directory, "sent.json")
+
+
+def missing_chunks(manifest, base):
+    # Chunks of manifest that aren't in base, the last manifest sent (all
+    # of them if none was); with every zip sent so far, enough to restore it
+    have = set() if base is None else {d for entry in base["files"].values() for d in entry["chunks"]}
+    missing = []
+    for entry in manifest["files"].values():
+        for digest in entry["chunks"]:
+            if digest not in have:
+                have.add(digest)
+                missing.append(digest)
+    return missing
+
+
+def delta_archive(manifest_path, new, out_path, directory=BACKUP_DIR):
+    # A zip of the manifest and the chunks it added: together with the
+    # earlier deltas, everything needed to restore it. Chunks are already
+    # compressed, so they're stored as they are.
+    with zipfile.ZipFile(out_path, "w", zipfile.ZIP_STORED) as archive:
+        archive.write(manifest_path, os.path.join("manifests", os.path.basename(manifest_path)))
+        for digest in new:
+            archive.write(chunk_path(digest, directory), os.path.relpath(chunk_path(digest, directory), directory))
+    return out_path
+
+
+def full_archives(manifest, out_dir, directory=BACKUP_DIR):
+    # The backed up files themselves, gzipped: [path of name.gz]
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for name, entry in manifest["files"].items():
+        path = os.path.join(out_dir, name + ".gz")
+        with gzip.open(path, "wb", compresslevel=6) as out:
+            rebuild(entry, out, directory)
+        paths.append(path)
+    return paths
+
+
+class Backups:
+    # Takes an incremental backup every BACKUP_INTERVAL seconds
+
+    def __init__(self, directory=BACKUP_DIR):
+        self.directory = directory
+        self.task = None
+        self._lock = asyncio.Lock()
+
+    async def backup(self, store):
+        # (manifest path, manifest, new chunk digests, their bytes); the
+        # export and the chunking both run on the storage I/O thread
+        async with self._lock:
+            return await self._backup(store)
+
+    async def _backup(self, store):
+        with METRICS.timed("storage", "backup"):
+            files = await store.export_json(os.path.join(self.directory, "export"))
+            return await run_io(snapshot, files, self.directory)
+
+    async def archive(self, store, full=False):
+        # Back up, then return (files to send, summary, sent): a zip of the
+        # chunks the admin is missing, or with full=True the whole files
+        # gzipped. No files if nothing changed since the last backup sent.
+        # Call sent() on the I/O thread once the zip has been delivered, so
+        # the next one builds on it.
+        async with self._lock:
+            manifest_path, manifest, _, _ = await self._backup(store)
+            name = os.path.basename(manifest_path)[:-len(".json")]
+            size = sum(entry["size"] for entry in manifest["files"].values()) / 1024
+            base = None if full else await run_io(read_json, sent_path(self.directory), None)
+            if base is not None and base["files"] == manifest["files"]:
+                return [], f"nothing changed since {base['manifest']}", None
+            # Only the files of the last /backup are kept here
+            outbox = os.path.join(self.directory, "outbox")
+            await run_io(shutil.rmtree, outbox, True)
+            if full:
+                paths = await run_io(full_archives, manifest, outbox, self.directory)
+                return paths, f"full snapshot {name}, {size:.0f} KB uncompressed", None
+            os.makedirs(outbox, exist_ok=True)
+            new = missing_chunks(manifest, base)
+            path = await run_io(delta_archive, manifest_path, new, os.path.join(outbox, f"backup-{name}.zip"),
+                                self.directory)
+            written = await run_io(os.path.getsize, path)
+            since = f"on top of {base['manifest']}" if base is not None else "complete, no earlier backup was sent"
+            summary = f"{name}: {len(new)} chunks {since}, {written / 1024:.0f} KB of {size:.0f} KB"
+            record = json.dumps({"manifest": name, "files": manifest["files"]})
+            return [path], summary, lambda: write_file_atomic(sent_path(self.directory), record)
+
+    def start(self, store):
+        if BACKUP_INTERVAL and self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run(store))
+
+    async def _run(self, store):
+        while True:
+            await asyncio.sleep(BACKUP_INTERVAL)
+            started = time.perf_counter()
+            try:
+                _, _, new, written = await self.backup(store)
+                if new:
+                    print(f"💾 Backup: {len(new)} changed chunks, {written / 1024:.0f} KB "
+                          f"in {time.perf_counter() - started:.1f}s")
+            except Exception as e:
+                print(f"⚠️ Backup failed: {e}")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+BACKUPS = Backups()
+
+
+if __name__ == "__main__":
+    # python backups.py restore [manifest] [directory]: rebuild the files of
+    # a backup (the latest by default) into directory (default restored/)
+    if len(sys.argv) < 2 or sys.argv[1] != "restore":
+        print("Usage: python backups.py restore [manifest] [directory]")
+        sys.exit(1)
+    path = sys.argv[2] if len(sys.argv) > 2 else latest_manifest()[0]
+    manifest = read_json(path, None) if path else None
+    if manifest is None:
+        print(f"❌ No backup {path or 'at all'} in {BACKUP_DIR}/")
+        sys.exit(1)
+    target = sys.argv[3] if len(sys.argv) > 3 else "restored"
+    for restored in restore(manifest, target):
+        print(f"✅ Restored {restored}")
@@ -0,0 +1,406 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+# Benchmarks the real command handlers against generated farms.
+#
+#   python benchmark.py generate 100000            # bench-data/100000/*.json
+#   python benchmark.py run --users 1000,10000 --output results.json
+#   python benchmark.py compare old.json new.json
+#
+# Each command is sent as a stand-in Update through the same per-user
+# locking and activity tracking the bot uses, to a fake bot that answers
+# instantly. Latency covers the handler only; bytes read and written come
+# from /proc/self/io and include the flush that follows each batch, so the
+# write-behind cost is counted against the command that caused it.
+
+DATA_DIR = "bench-data"
+COMMANDS = ("feed", "myfarm", "breed", "buyfeed", "topbrands", "tonlog", "broadcast")
+FIRST_USER_ID = 1_000_000_000
+
+# The bot reads these at import
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("BROADCAST_RATE", "1000000000")
+os.environ.setdefault("BROADCAST_FILE", "broadcast.json")
+
+
+# Datasets
+
+def fake_player(rng, uid, today):
+    age = rng.randint(0, 400)
+    birth = today - timedelta(days=age)
+    player = {
+        "username": f"farmer{uid}",
+        "coins": rng.randint(0, 500),
+        "streak": rng.randint(0, 60),
+        "referrals": rng.choice((0, 0, 0, 1, 2, 5)),
+        "claimed_tasks": rng.sample(["join1", "view1", "share1"], rng.randint(0, 3)),
+        "feed": rng.randint(0, 20),
+        "ton_balance": round(rng.random() * 5, 2) if rng.random() < 0.3 else 0,
+        "last_seen": (today - timedelta(days=int(rng.expovariate(1 / 20)))).toordinal() - date(1970, 1, 1).toordinal(),
+        "pig": {
+            "birth_date": birth.isoformat(),
+            "pregnant": rng.random() < 0.1,
+            "pregnant_date": None,
+        },
+    }
+    pig = player["pig"]
+    if pig["pregnant"]:
+        pig["pregnant_date"] = (today - timedelta(days=rng.randint(0, 5))).isoformat()
+
+    # Half the farms still carry the old per-day fed_dates list and piglet
+    # dicts, the way long-lived records look before they're migrated
+    fed = [birth + timedelta(days=d) for d in range(age + 1) if rng.random() < 0.7]
+    types_ = rng.choices(["normal", "spotted", "golden"], weights=[80, 15, 5], k=int(rng.expovariate(1 / 8)))
+    if rng.random() < 0.5:
+        pig["fed_dates"] = [d.isoformat() for d in fed]
+        player["piglets"] = [{"type": t, "age": rng.randint(0, 15)} for t in types_]
+    else:
+        epoch = date(1970, 1, 1).toordinal()
+        last = fed[-1].toordinal() - epoch if fed else None
+        bits = 0
+        for d in fed:
+            if last is not None and last - (d.toordinal() - epoch) < 32:
+                bits |= 1 << (last - (d.toordinal() - epoch))
+        pig["last_fed"], pig["fed_bits"] = last, bits
+        piglets = {}
+        for t in types_:
+            ages = piglets.setdefault(t, {})
+            age_key = str(rng.randint(0, 15))
+            ages[age_key] = ages.get(age_key, 0) + 1
+        player["piglets"] = piglets
+    if player["ton_balance"]:
+        player["ton_log"] = [
+            {"date": (today - timedelta(days=rng.randint(0, 90))).isoformat(), "source": "upgradeplant", "amount": -1}
+            for _ in range(rng.randint(1, 10))
+        ]
+    return player
+
+
+def fake_mill(rng, uid, today):
+    level = rng.randint(0, 6)
+    return {
+        "mill_id": uid,
+        "level": level,
+        "last_production": (datetime.combine(today, datetime.min.time()) - timedelta(hours=rng.randint(0, 48))).isoformat(),
+        "stock": [
+            {"amount": rng.randint(2, 8), "type": "premium" if level == 6 else "normal",
+             "timestamp": (datetime.combine(today, datetime.min.time()) - timedelta(hours=h)).isoformat()}
+            for h in range(rng.randint(0, 12))
+        ],
+        "brand": f"Mill #{uid}",
+        "emoji": "🏭",
+        "slogan": "Quality feed for every pig!",
+        "royalty_points": rng.randint(0, 300),
+        "sales": rng.randint(0, 300),
+    }
+
+
+def generate(n_users, directory, seed=1):
+    # Writes players.json and feed_data.json for n_users farms, streaming the
+    # players so a million of them never sit in memory at once
+    from storage import encode_object, encode_record
+
+    rng = random.Random(seed)
+    today = date.today()
+    os.makedirs(directory, exist_ok=True)
+    mills, plants, market = {}, {}, []
+
+    def players():
+        for i in range(n_users):
+            uid = str(FIRST_USER_ID + i)
+            if rng.random() < 0.1:
+                mills[uid] = fake_mill(rng, uid, today)
+                if rng.random() < 0.1:
+                    market.append({
+                        "seller_id": uid, "amount": rng.randint(1, 20), "price": rng.randint(1, 5),
+                        "type": "normal", "timestamp": today.isoformat(), "brand": mills[uid]["brand"],
+                        "emoji": "🏭", "slogan": mills[uid]["slogan"], "sales": 0,
+                    })
+            if rng.random() < 0.05:
+                plants[uid] = {"plant_level": rng.randint(0, 6)}
+            yield uid, encode_record(fake_player(rng, uid, today))
+
+    with open(os.path.join(directory, "players.json"), "w") as f:
+        f.write(encode_object(players()))
+    feed = {"mills": mills, "market": market, **plants}
+    with open(os.path.join(directory, "feed_data.json"), "w") as f:
+        json.dump(feed, f, indent=2)
+    return directory
+
+
+def dataset(n_users, seed=1):
+    directory = os.path.join(DATA_DIR, str(n_users))
+    if not os.path.exists(os.path.join(directory, "feed_data.json")):
+        print(f"🧪 Generating {n_users} farms into {directory}")
+        generate(n_users, directory, seed)
+    return directory
+
+
+# Stand-in Telegram objects
+
+class FakeMessage:
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat = self
+        self.chat_id = chat_id
+        self.message_id = 1
+        self.document = None
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def reply_document(self, document=None, **kwargs):
+        self.bot.sent += 1
+        return self
+
+    async def send_action(self, **kwargs):
+        pass
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+
+class FakeBot:
+    username = "PigFarmBenchBot"
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, chat_id)
+
+    async def edit_message_text(self, text, **kwargs):
+        return True
+
+
+def fake_update(bot, user_id, args):
+    user = types.SimpleNamespace(id=int(user_id), username=f"farmer{user_id}", first_name="Farmer")
+    update = types.SimpleNamespace(
+        effective_user=user,
+        effective_chat=types.SimpleNamespace(id=int(user_id)),
+        message=FakeMessage(bot, int(user_id)),
+    )
+    context = types.SimpleNamespace(args=list(args), bot=bot, user_data={}, application=None)
+    return update, context
+
+
+# Running
+
+def io_counters():
+    # (bytes read, bytes written) by this process, where the OS reports it
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def command_plan(bot, name, user_ids, iterations, rng):
+    # (sender, args) for each call of the command
+    admin = bot.ADMIN_IDS[0]
+    if name == "broadcast":
+        return [(admin, ["Benchmark", "broadcast"])]
+    if name == "tonlog":
+        return [(admin, [])] * iterations
+    if name == "buyfeed":
+        return [(rng.choice(user_ids), [str(rng.randint(1, 5))]) for _ in range(iterations)]
+    return [(rng.choice(user_ids), []) for _ in range(iterations)]
+
+
+async def bench_command(bot, name, plan, concurrency):
+    from broadcaster import BROADCASTER
+    from dispatch import per_user
+
+    # buyfeed takes its own locks, like it's registered in the bot
+    handler = getattr(bot, name) if name == "buyfeed" else per_user(getattr(bot, name))
+    touch = per_user(bot.mark_active)
+    fake_bot = FakeBot()
+    latencies, errors = [], Counter()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(user_id, args):
+        update, context = fake_update(fake_bot, user_id, args)
+        async with limit:
+            start = time.perf_counter()
+            try:
+                await touch(update, context)
+                await handler(update, context)
+                if name == "broadcast" and BROADCASTER.task is not None:
+                    await BROADCASTER.task
+            except Exception as e:
+                errors[f"{type(e).__name__}: {e}"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    io_before = io_counters()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user_id, args) for user_id, args in plan))
+    await bot.STORE.flush_async()
+    elapsed = time.perf_counter() - started
+    io_after = io_counters()
+
+    latencies.sort()
+    result = {
+        "calls": len(plan),
+        "errors": sum(errors.values()),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 4),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 4),
+        "throughput_per_s": round(len(plan) / elapsed, 2),
+        "messages_sent": fake_bot.sent,
+    }
+    if io_before and io_after:
+        result["read_bytes_per_call"] = round((io_after[0] - io_before[0]) / len(plan), 1)
+        result["written_bytes_per_call"] = round((io_after[1] - io_before[1]) / len(plan), 1)
+    if errors:
+        result["error_messages"] = dict(errors.most_common(3))
+    return result
+
+
+async def bench_dataset(bot, n_users, commands, iterations, concurrency, seed):
+    import storage
+
+    source = dataset(n_users, seed)
+    work = tempfile.mkdtemp(prefix="pigfarm-bench-")
+    for name in ("players.json", "feed_data.json"):
+        shutil.copy(os.path.join(source, name), work)
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        if storage.STORAGE_BACKEND == "sqlite":
+            storage.import_json_files("players.json", "feed_data.json", storage.DB_FILE)
+        started = time.perf_counter()
+        bot.STORE = storage.Store(storage.open_backend(bot.DATA_FILE, bot.FEED_FILE))
+        await bot.STORE.load_rankings()
+        load_seconds = time.perf_counter() - started
+
+        rng = random.Random(seed)
+        user_ids = [str(FIRST_USER_ID + i) for i in range(n_users)]
+        run = {"users": n_users, "load_seconds": round(load_seconds, 3), "commands": {}}
+        for name in commands:
+            plan = command_plan(bot, name, user_ids, iterations, rng)
+            run["commands"][name] = await bench_command(bot, name, plan, concurrency)
+            print(f"  {n_users:>8} users  {name:<10} {run['commands'][name]}")
+            failed = run["commands"][name]["errors"]
+            if failed:
+                # Its timings are of the error path, not of the command
+                print(f"  ⚠️ {name}: {failed} of {len(plan)} calls raised, e.g. "
+                      f"{next(iter(run['commands'][name]['error_messages']))}")
+        await bot.STORE.stop()
+        return run
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def run(args):
+    # Import the bot from an empty directory so its own startup load is free
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    global DATA_DIR
+    DATA_DIR = os.path.abspath(args.data_dir)
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="pigfarm-bench-"))
+    try:
+        import bot
+    finally:
+        os.chdir(cwd)
+    import storage
+    if args.backend:
+        storage.STORAGE_BACKEND = args.backend
+
+    commands = args.commands.split(",")
+    unknown = set(commands) - set(COMMANDS)
+    if unknown:
+        sys.exit(f"Unknown commands: {', '.join(sorted(unknown))}")
+
+    results = {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": storage.STORAGE_BACKEND,
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "runs": [],
+    }
+    for n_users in (int(n) for n in args.users.split(",")):
+        results["runs"].append(asyncio.run(
+            bench_dataset(bot, n_users, commands, args.iterations, args.concurrency, args.seed)
+        ))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    failed = sorted({
+        name for r in results["runs"] for name, result in r["commands"].items() if result["errors"]
+    })
+    if failed:
+        sys.exit(f"❌ Results written to {args.output}, but {', '.join(failed)} raised errors; "
+                 f"their numbers don't measure the command")
+    print(f"✅ Results written to {args.output}")
+
+
+def compare(args):
+    # p50/p99/throughput of a new run relative to an old one
+    with open(args.old) as f:
+        old = {r["users"]: r for r in json.load(f)["runs"]}
+    with open(args.new) as f:
+        new = {r["users"]: r for r in json.load(f)["runs"]}
+    for users in sorted(old.keys() & new.keys()):
+        for name in sorted(old[users]["commands"].keys() & new[users]["commands"].keys()):
+            a, b = old[users]["commands"][name], new[users]["commands"][name]
+            deltas = []
+            for key in ("p50_ms", "p99_ms", "throughput_per_s", "written_bytes_per_call"):
+                if a.get(key) and key in b:
+                    deltas.append(f"{key} {a[key]} → {b[key]} ({(b[key] - a[key]) / a[key] * 100:+.1f}%)")
+            print(f"{users:>8} {name:<10} " + ", ".join(deltas))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pig farm bot benchmarks")
+    sub = parser.add_subparsers(dest="action", required=True)
+
+    gen = sub.add_parser("generate", help="write a synthetic dataset")
+    gen.add_argument("users", type=int)
+    gen.add_argument("--out", help="directory (default bench-data/<users>)")
+    gen.add_argument("--seed", type=int, default=1)
+
+    bench = sub.add_parser("run", help="time the handlers")
+    bench.add_argument("--users", default="1000,10000", help="comma separated dataset sizes, e.g. 1000,10000,100000,1000000")
+    bench.add_argument("--commands", default=",".join(COMMANDS))
+    bench.add_argument("--iterations", type=int, default=2000, help="calls per command (broadcast runs once)")
+    bench.add_argument("--concurrency", type=int, default=1, help="commands in flight at once")
+    bench.add_argument("--backend", choices=("json", "journal", "pack", "sqlite"), help="default: STORAGE_BACKEND")
+    bench.add_argument("--data-dir", default=DATA_DIR)
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("--output", default="bench-results.json")
+
+    cmp_ = sub.add_parser("compare", help="compare two result files")
+    cmp_.add_argument("old")
+    cmp_.add_argument("new")
+
+    args = parser.parse_args()
+    if args.action == "generate":
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        print(f"✅ Wrote {generate(args.users, args.out or os.path.join(DATA_DIR, str(args.users)), args.seed)}")
+    elif args.action == "run":
+        run(args)
+    else:
+        compare(args)
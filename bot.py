@@ -1,12 +1,18 @@
 import os
+import asyncio
 import json
 import random
+import secrets
+import time
 from datetime import datetime, timedelta, timezone
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,   # ✅ <== Add this line
+    TypeHandler,
     ContextTypes,
     filters           # ✅ <== And this if not already there
 )
@@ -15,6 +21,20 @@ from dotenv import load_dotenv
 from telegram.constants import ChatAction
 from telegram import Document
 import shutil
+from storage import Store, open_backend, read_json, run_io, write_file_atomic
+from dispatch import CONCURRENT_UPDATES, USER_LOCKS, per_user
+from broadcaster import BROADCASTER
+from metrics import METRICS, TimedRequest, instrument
+from piglets import PIGLET_PRICES, add_piglets, count_piglets, piglet_groups, remove_piglets
+from feeding import epoch_day, fed_every_day, fed_on, mark_fed
+from daily import DAILY
+from backups import BACKUPS
+from schema import SchemaError, check_file
+from records import Pig
+from orderbook import LISTING_DAYS, listed_at
+import webhook
+from shards import CLUSTER, MARKET_SHARD, SHARD_ID, SHARDS, on_owner_shard, run_router, shared_file
+from mills import MILL_ALERTS, MILL_CAP_BATCHES, collect, full_at, last_production, next_batch_at, ready_batches
 
 # Better to use environment variable or config file
 
@@ -30,28 +50,19 @@ print("🔑 Loaded token:", TOKEN[:10] + "..." if TOKEN else "None")
 
 # Data management
 DATA_FILE = "players.json"
-
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
-
 FEED_FILE = "feed_data.json"
 
-def load_feed_data():
-    if os.path.exists(FEED_FILE):
-        with open(FEED_FILE, "r") as f:
-            return json.load(f)
-    return {"mills": {}, "market": []}
+if __name__ == "__main__" and SHARDS > 1 and not CLUSTER.sharded:
+    # Sharded: this process only routes updates to the workers, each of
+    # which runs this file again for its own players (see shards.py)
+    run_router(__file__, TOKEN, DATA_FILE, FEED_FILE)
+    exit(0)
 
-def save_feed_data(data):
-    with open(FEED_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+# Farms, mills and market listings are kept in memory by the store. Handlers
+# fetch single records with STORE.get_player()/get_mill(), mutate them and
+# call save_player()/save_mill(); only those rows are written back by the
+# background flusher (JSON files or SQLite, see STORAGE_BACKEND).
+STORE = Store(open_backend(DATA_FILE, FEED_FILE))
 
 def filter_valid_feed(stock):
     # Optional cleaner to remove spoiled feed — for now, just return stock
@@ -67,13 +78,10 @@ MILL_LEVELS = {
     6: {"cooldown": 1, "amount": 8, "type": "premium"},
 }
 
-def can_produce(last_timestamp, cooldown_hours):
-    try:
-        last_time = datetime.fromisoformat(last_timestamp)
-    except:
-        return True
-    now = datetime.now()
-    return (now - last_time).total_seconds() >= cooldown_hours * 3600
+def until(when):
+    # "3h 20m" from now until a datetime
+    minutes = max(0, int((when - datetime.now()).total_seconds() // 60) + 1)
+    return f"{minutes // 60}h {minutes % 60}m"
 
 # Task list - Admin-defined daily tasks
 TASKS = {
@@ -122,57 +130,86 @@ PLANT_LEVELS = {
 
 def has_processed_today(user_data, product):
     today = datetime.now().strftime("%Y-%m-%d")
-    return user_data.get("last_processed", {}).get(product) == today
+    return user_data["last_processed"].get(product) == today
 
 def mark_processed_today(user_data, product):
     today = datetime.now().strftime("%Y-%m-%d")
-    if "last_processed" not in user_data:
-        user_data["last_processed"] = {}
+    # Only today's entries matter, drop the rest
+    user_data["last_processed"] = {p: day for p, day in user_data["last_processed"].items() if day == today}
     user_data["last_processed"][product] = today
 
-def load_tasks():
-    try:
-        with open("tasks.json", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {"tasks": []}
+# tasks.json is read and written on the storage I/O thread. Every shard
+# uses the same one.
+TASKS_FILE = shared_file("tasks.json")
+
+async def load_tasks():
+    return await run_io(read_json, TASKS_FILE, {"tasks": []})
+
+async def save_tasks(tasks):
+    await run_io(write_file_atomic, TASKS_FILE, json.dumps(tasks, indent=2))
 
-def save_tasks(tasks):
-    with open("tasks.json", "w") as f:
-        json.dump(tasks, f, indent=2)
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
 
 
 EXCHANGE_RATE = 100  # 100 coins = 1 TON 🪙 💰 👛 
 
 # 🌭 Pork Plant Levels & Rewards
 
+# Long listings are shown PAGE_SIZE entries at a time, with ◀️/▶️ buttons
+# whose callback data is "<view>:<page>" (see turn_page)
+PAGE_SIZE = 10
+
+def page_bounds(page, total):
+    # (page, pages, first index) with page clamped to 1..pages
+    pages = max(1, -(-total // PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    return page, pages, (page - 1) * PAGE_SIZE
+
+def page_buttons(view, page, pages):
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=f"{view}:{page - 1}"))
+    if page < pages:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"{view}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def page_arg(args):
+    # /feedmarket 3 -> 3
+    return int(args[0]) if args and args[0].isdigit() else 1
+
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = str(user.id)
-    data = load_data()
 
     # Optional: Referrer check
     referrer_id = context.args[0] if context.args else None
 
-    if user_id not in data:
+    if STORE.get_player(user_id) is None:
         # New user: create record
-        data[user_id] = {
+        player = {
             "username": user.username or user.first_name,
             "coins": 0,
             "streak": 0,
-            "piglets": [],
+            "piglets": {},
             "referrals": 0,
             "claimed_tasks": []
         }
 
         # Reward user for joining
-        data[user_id]["coins"] += 2
+        player["coins"] += 2
+        STORE.add_player(user_id, player)
 
         # Handle referral bonus
-        if referrer_id and referrer_id in data and referrer_id != user_id:
-            data[referrer_id]["coins"] += 5
-            data[referrer_id]["referrals"] = data[referrer_id].get("referrals", 0) + 1
+        if not referrer_id or referrer_id == user_id:
+            referred = False
+        elif CLUSTER.local(referrer_id):
+            referred = credit_referral(referrer_id)
+        else:
+            referred = await CLUSTER.call("referral", user=referrer_id, referrer_id=referrer_id)
+        if referred:
             await update.message.reply_text("🎉 You joined with a referral! +2 coins for you 🐽")
             try:
                 await context.bot.send_message(
@@ -183,115 +220,126 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 print(f"Failed to send referral notification: {e}")
         else:
             await update.message.reply_text("🐷 Welcome to Pig Farm! Feed your pig and grow your farm.")
-
-        save_data(data)
     else:
         await update.message.reply_text("👋 You're already part of the farm. Let's grow some pigs!")
 
+def credit_referral(referrer_id):
+    # The caller holds the referrer's lock
+    referrer = STORE.get_player(referrer_id)
+    if referrer is None:
+        return False
+    referrer.coins += 5
+    referrer.referrals += 1
+    STORE.save_player(referrer_id)
+    return True
+
+# /start with a referrer on another shard
+@CLUSTER.op("referral")
+async def referral_op(app, referrer_id):
+    async with USER_LOCKS.hold(referrer_id):
+        return credit_referral(referrer_id)
+
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = str(user.id)
-    data = load_data()
+    player = STORE.get_player(user_id)
     today = datetime.now(timezone.utc).date().strftime("%Y-%m-%d")
 
     # Initialize user data if not exists
-    if user_id not in data:
-        data[user_id] = {
+    if player is None:
+        player = STORE.add_player(user_id, {
             "username": user.username or user.first_name,
             "coins": 0,
             "streak": 0,
-            "piglets": [],
+            "piglets": {},
             "referrals": 0,
             "claimed_tasks": []
-        }
+        })
 
-    if "pig" in data[user_id]:
+    if "pig" in player:
         await update.message.reply_text("😅 You already own a pig!")
         return
 
     # Set up a full pig object
-    new_pig = {
-        "birth_date": today,
-        "fed_dates": [],
-        "pregnant": False,
-        "pregnant_date": None
-    }
-
-    data[user_id]["pig"] = new_pig
-    save_data(data)
+    player.pig = Pig(
+        birth_date=today,
+        last_fed=None,
+        fed_bits=0,
+        pregnant=False,
+        pregnant_date=None,
+        breed_spent=0,
+    )
+    STORE.save_player(user_id)
 
     await update.message.reply_text("🎉 You just bought your first pig 🐖!\nTake good care of it and it might give you piglets!")
 
 async def feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = str(user.id)
-    data = load_data()
+    player = STORE.get_player(user_id)
 
-    if user_id not in data:
+    if player is None:
         await update.message.reply_text("🐷 You don't own a pig yet! Use /myfarm to get started.")
         return
 
-    player = data[user_id]
-    today = datetime.utcnow().strftime("%Y-%m-%d")
+    today = epoch_day(datetime.utcnow().date())
 
-    # Ensure feed tracking exists
-    if "feed" not in player:
-        player["feed"] = 0
-
-    if player["feed"] <= 0:
+    if player.feed <= 0:
         await update.message.reply_text("❌ You don’t have any feed! Use /buyfeed or /makefeed.")
         return
 
-    pig = player["pig"]
-    if today in pig.get("fed_dates", []):
+    pig = player.pig
+    if fed_on(pig, today):
         await update.message.reply_text("🐖 Your pig has already been fed today.")
         return
 
-    # Feed pig
-    pig.setdefault("fed_dates", []).append(today)
-    player["streak"] = player.get("streak", 0) + 1
-    player["feed"] -= 1
+    # Feed pig; a missed day starts the streak over (the daily rollover
+    # does the same for everyone at midnight)
+    if pig.last_fed is None or pig.last_fed < today - 1:
+        player.streak = 0
+    mark_fed(pig, today)
+    player.streak += 1
+    player.feed -= 1
 
     # Reward coins
     coins_earned = 1
-    if player["streak"] % 3 == 0:
+    if player.streak % 3 == 0:
         coins_earned += 1
 
-    player["coins"] += coins_earned
+    player.coins += coins_earned
 
-    save_data(data)
+    STORE.save_player(user_id)
 
     await update.message.reply_text(
         f"✅ Your pig enjoyed the meal!\n"
-        f"🔥 Streak: {player['streak']} days! (+{coins_earned} coins)\n"
-        f"💰 Coins: {player['coins']}\n"
-        f"📦 Feed left: {player['feed']}"
+        f"🔥 Streak: {player.streak} days! (+{coins_earned} coins)\n"
+        f"💰 Coins: {player.coins}\n"
+        f"📦 Feed left: {player.feed}"
     )
 
 async def myfarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = str(user.id)
-    data = load_data()
+    user_data = STORE.get_player(user_id)
 
-    if user_id not in data or "pig" not in data[user_id]:
+    if user_data is None or "pig" not in user_data:
         await update.message.reply_text("😢 You don't have a pig yet. Use /buy to start your farm!")
         return
 
-    user_data = data[user_id]
-    pig = user_data["pig"]
+    pig = user_data.pig
     today = datetime.now(timezone.utc).date()
 
     # Core info
-    birth_date = datetime.strptime(pig["birth_date"], "%Y-%m-%d").date()
+    birth_date = datetime.strptime(pig.birth_date, "%Y-%m-%d").date()
     age = (today - birth_date).days
-    streak = user_data.get("streak", 0)
-    coins = user_data.get("coins", 0)
-    feed_stock = user_data.get("feed", 0)
+    streak = user_data.streak
+    coins = user_data.coins
+    feed_stock = user_data.feed
 
     # Mood check
-    last_fed = pig["fed_dates"][-1] if pig["fed_dates"] else None
-    if last_fed:
-        days_missed = (today - datetime.strptime(last_fed, "%Y-%m-%d").date()).days
+    last_fed = pig.last_fed
+    if last_fed is not None:
+        days_missed = epoch_day(today) - last_fed
         if days_missed == 0:
             mood = "😊 Happy"
         elif days_missed == 1:
@@ -305,8 +353,8 @@ async def myfarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Pregnancy check
     pregnant_msg = ""
-    if pig.get("pregnant"):
-        preg_date = datetime.strptime(pig["pregnant_date"], "%Y-%m-%d").date()
+    if pig.pregnant:
+        preg_date = datetime.strptime(pig.pregnant_date, "%Y-%m-%d").date()
         days_pregnant = (today - preg_date).days
         if days_pregnant >= 3:
             pregnant_msg = "🍼 Ready to give birth! Use /checkbreed to collect piglets."
@@ -315,11 +363,11 @@ async def myfarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pregnant_msg = f"🤰 Pregnant ({days_pregnant} days). {remaining} day(s) until birth."
 
     # Piglet info
-    piglet_count = len(user_data.get("piglets", []))
+    piglet_count = count_piglets(user_data)
 
     await update.message.reply_text(
         f"🏡 Welcome to your farm!\n"
-        f"👤 Owner: {user_data.get('username', 'Farmer')}\n"
+        f"👤 Owner: {user_data.username or 'Farmer'}\n"
         f"🐖 Pig Age: {age} days\n"
         f"🔥 Streak: {streak} days\n"
         f"💰 Coins: {coins}\n"
@@ -331,71 +379,64 @@ async def myfarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def breed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    player = STORE.get_player(user_id)
     today = datetime.now(timezone.utc).date()
 
-    if user_id not in data or "pig" not in data[user_id]:
+    if player is None or "pig" not in player:
         await update.message.reply_text("🐷 You don't own any pigs to breed!")
         return
 
-    pig = data[user_id]["pig"]
+    pig = player.pig
 
     # Age Check (changed to 7 days minimum)
-    birth_date_str = pig.get("birth_date")
-    if not birth_date_str:
-        await update.message.reply_text("❌ Pig birth date missing.")
-        return
-
-    birth_date = datetime.strptime(birth_date_str, "%Y-%m-%d").date()
+    birth_date = datetime.strptime(pig.birth_date, "%Y-%m-%d").date()
     age_days = (today - birth_date).days
     if age_days < 7:
         await update.message.reply_text("🍼 Your pig must be at least 7 days old to breed.")
         return
 
     # Feeding Check (last 3 days)
-    fed_dates = pig.get("fed_dates", [])
-    last_3 = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(3)]
-    if not all(day in fed_dates for day in last_3):
+    if not fed_every_day(pig, epoch_day(today), 3):
         await update.message.reply_text("🍽 Your pig must be well-fed (last 3 days) to breed.")
         return
 
     # Coin Check
-    coins = data[user_id].get("coins", 0)
+    coins = player.coins
     if coins < 1:
         await update.message.reply_text("💰 You need at least 1 coin to breed.")
         return
 
     # Check if already pregnant
-    if pig.get("pregnant"):
+    if pig.pregnant:
         await update.message.reply_text("🤰 Your pig is already pregnant!")
         return
 
     # BREED: deduct coin and set pregnancy
-    data[user_id]["coins"] -= 1
-    pig["pregnant"] = True
-    pig["pregnant_date"] = today.strftime("%Y-%m-%d")
-    save_data(data)
+    player.coins -= 1
+    pig.pregnant = True
+    pig.pregnant_date = today.strftime("%Y-%m-%d")
+    STORE.save_player(user_id)
 
     await update.message.reply_text("💘 Your pig is now pregnant! Come back in 3 days to check for piglets.")
 
 async def checkbreed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    player = STORE.get_player(user_id)
     today = datetime.now(timezone.utc).date()
 
-    if user_id not in data or "pig" not in data[user_id]:
+    if player is None or "pig" not in player:
         await update.message.reply_text("🐷 You don't have a pig yet!")
         return
 
-    pig = data[user_id]["pig"]
+    pig = player.pig
 
     # Check if pig is pregnant
-    if not pig.get("pregnant", False):
+    if not pig.pregnant:
         await update.message.reply_text("🤰 Your pig is not pregnant right now.")
         return
 
     # Check how many days since pregnancy
-    preg_date = pig.get("pregnant_date")
+    preg_date = pig.pregnant_date
     if not preg_date:
         await update.message.reply_text("⚠️ Pregnancy date missing.")
         return
@@ -410,80 +451,105 @@ async def checkbreed(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Birth time! Generate piglets
     piglets_count = random.randint(1, 4)  # 1-4 piglets
-    piglets = []
+    summary = {}
     for _ in range(piglets_count):
         roll = random.randint(1, 100)
         if roll <= 5:
-            piglets.append({"type": "golden", "age": 0})
+            pig_type = "golden"
         elif roll <= 20:
-            piglets.append({"type": "spotted", "age": 0})
+            pig_type = "spotted"
         else:
-            piglets.append({"type": "normal", "age": 0})
+            pig_type = "normal"
+        summary[pig_type] = summary.get(pig_type, 0) + 1
 
-    pig["pregnant"] = False
-    pig["pregnant_date"] = None
-    data[user_id]["piglets"] = data[user_id].get("piglets", []) + piglets
-    save_data(data)
+    pig.pregnant = False
+    pig.pregnant_date = None
+    for pig_type, count in summary.items():
+        add_piglets(player, pig_type, count)
+    STORE.save_player(user_id)
 
     # Summary message
-    summary = {}
-    for p in piglets:
-        summary[p["type"]] = summary.get(p["type"], 0) + 1
 
     summary_msg = "\n".join([f"🐽 {typ.title()}: {count}" for typ, count in summary.items()])
     await update.message.reply_text(f"🎉 Your pig gave birth to {piglets_count} piglet(s)!\n{summary_msg}")
 
+def piglet_page(player, page):
+    # Numbered like /sellpiglet expects, across pages. Groups are one per
+    # type and age, so there are only ever a few dozen of them.
+    groups = piglet_groups(player)
+    page, pages, first = page_bounds(page, len(groups))
+    msg = f"🐽 Your piglets ({count_piglets(player)}), page {page}/{pages}:\n"
+    for i, (pig_type, age, count) in enumerate(groups[first:first + PAGE_SIZE], first + 1):
+        price = PIGLET_PRICES.get(pig_type, 1)
+        msg += f"{i}. {pig_type.title()} ×{count}, {age} day(s) old (worth {price} coins each)\n"
+    msg += "\nUse: /sellpiglet <number|type> [amount|all]"
+    return {"text": msg, "reply_markup": page_buttons("sellpiglet", page, pages)}
+
 async def sellpiglet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    player = STORE.get_player(user_id)
 
-    if user_id not in data or not data[user_id].get("piglets"):
+    if player is None or not count_piglets(player):
         await update.message.reply_text("😢 You don't have any piglets to sell.")
         return
 
-    # Show piglets first if no argument provided
-    if not context.args:
-        piglets = data[user_id]["piglets"]
-        msg = "🐽 Your piglets:\n"
-        for i, piglet in enumerate(piglets, 1):
-            price = 5 if piglet["type"] == "golden" else 3 if piglet["type"] == "spotted" else 1
-            msg += f"{i}. {piglet['type'].title()} (worth {price} coins)\n"
-        msg += "\nUse: /sellpiglet <number>"
-        await update.message.reply_text(msg)
+    # Show piglets first if no argument provided (/sellpiglet page 2 for more)
+    if not context.args or context.args[0].lower() == "page":
+        await update.message.reply_text(**piglet_page(player, page_arg(context.args[1:])))
         return
 
-    # Validate input
-    try:
-        index = int(context.args[0]) - 1
-    except ValueError:
-        await update.message.reply_text("⚠️ Please enter a valid number.")
-        return
-
-    piglets = data[user_id]["piglets"]
+    groups = piglet_groups(player)
 
-    if index < 0 or index >= len(piglets):
-        await update.message.reply_text("❌ Invalid piglet number.")
+    # Which piglets: a number from the list above, or every piglet of a type
+    target = context.args[0].lower()
+    if target.isdigit():
+        index = int(target) - 1
+        if index < 0 or index >= len(groups):
+            await update.message.reply_text("❌ Invalid piglet number.")
+            return
+        chosen = [groups[index]]
+    elif target in PIGLET_PRICES:
+        chosen = [group for group in groups if group[0] == target]
+        if not chosen:
+            await update.message.reply_text(f"😢 You don't have any {target} piglets.")
+            return
+    else:
+        await update.message.reply_text("⚠️ Please enter a valid number or piglet type.")
         return
 
-    # Get piglet and assign value
-    piglet = piglets.pop(index)
-    pig_type = piglet["type"]
-
-    if pig_type == "golden":
-        coins_earned = 5
-    elif pig_type == "spotted":
-        coins_earned = 3
+    available = sum(count for _, _, count in chosen)
+    amount_arg = context.args[1].lower() if len(context.args) > 1 else "1"
+    if amount_arg == "all":
+        amount = available
     else:
-        coins_earned = 1
+        try:
+            amount = int(amount_arg)
+        except ValueError:
+            amount = 0
+        if amount <= 0:
+            await update.message.reply_text("⚠️ Please enter a valid amount.")
+            return
+    if amount > available:
+        await update.message.reply_text(f"❌ You only have {available} of those piglets.")
+        return
+
+    # Youngest first, so older piglets stay for processing
+    sold = coins_earned = 0
+    for pig_type, age, _ in chosen:
+        taken = remove_piglets(player, pig_type, age, amount - sold)
+        sold += taken
+        coins_earned += taken * PIGLET_PRICES.get(pig_type, 1)
+        if sold == amount:
+            break
 
     # Update user coins and save
-    data[user_id]["coins"] += coins_earned
-    save_data(data)
+    player["coins"] += coins_earned
+    STORE.save_player(user_id)
 
     await update.message.reply_text(
-        f"💰 Sold your {pig_type} piglet for {coins_earned} coin(s)!\n"
-        f"🐖 Remaining piglets: {len(piglets)}\n"
-        f"💰 Total coins: {data[user_id]['coins']}"
+        f"💰 Sold {sold} {chosen[0][0]} piglet(s) for {coins_earned} coin(s)!\n"
+        f"🐖 Remaining piglets: {count_piglets(player)}\n"
+        f"💰 Total coins: {player['coins']}"
     )
 
 async def market(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -499,11 +565,13 @@ async def market(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def buymarket(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
-    user_data = data.get(user_id, {})
-    coins = user_data.get("coins", 0)
+    user_data = STORE.get_player(user_id)
     offers = context.user_data.get("market")
 
+    if user_data is None:
+        await update.message.reply_text("🐷 You need a farm first! Use /myfarm.")
+        return
+
     if not offers:
         await update.message.reply_text("❌ No market offers. Use /market first.")
         return
@@ -519,25 +587,23 @@ async def buymarket(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Invalid selection. Use /market to see options.")
         return
 
-    if coins < offer["price"]:
+    if user_data["coins"] < offer["price"]:
         await update.message.reply_text("💸 Not enough coins!")
         return
 
     # Deduct coins & add piglet
     user_data["coins"] -= offer["price"]
-    user_data["piglets"] = user_data.get("piglets", [])
-    user_data["piglets"].append({"type": offer["type"], "age": 0})
+    add_piglets(user_data, offer["type"])
 
-    save_data(data)
+    STORE.save_player(user_id)
     await update.message.reply_text(
         f"✅ You bought a {offer['type']} piglet!\n💰 Coins left: {user_data['coins']}"
     )
 
 async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
-    user_data = data.get(user_id, {})
-    referral_count = user_data.get("referrals", 0)
+    user_data = STORE.get_player(user_id)
+    referral_count = user_data["referrals"] if user_data else 0
 
     bot_username = context.bot.username
     await update.message.reply_text(
@@ -546,28 +612,31 @@ async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"👥 Total referrals: {referral_count}"
     )
 
+def tasks_page(tasks_list, page):
+    page, pages, first = page_bounds(page, len(tasks_list))
+    msg = f"🎯 *Active Tasks* ({len(tasks_list)}), page {page}/{pages}:\n\n"
+    for task in tasks_list[first:first + PAGE_SIZE]:
+        msg += f"• `{task['code']}` — {task['message']}\n"
+        msg += f"💰 Reward: {task['reward']} coins\n"
+        msg += f"✅ Use: /claim {task['code']}\n\n"
+    return {"text": msg, "parse_mode": "Markdown", "reply_markup": page_buttons("tasks", page, pages)}
+
 async def tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    tasks_data = load_tasks()
+    tasks_data = await load_tasks()
     
     if not tasks_data["tasks"]:
         await update.message.reply_text("📭 No tasks available at the moment.")
         return
 
-    msg = "🎯 *Active Tasks:*\n\n"
-    for task in tasks_data["tasks"]:
-        msg += f"• `{task['code']}` — {task['message']}\n"
-        msg += f"💰 Reward: {task['reward']} coins\n"
-        msg += f"✅ Use: /claim {task['code']}\n\n"
-
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await update.message.reply_text(**tasks_page(tasks_data["tasks"], page_arg(context.args)))
     
 
 async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
-    tasks_data = load_tasks()
+    user = STORE.get_player(user_id)
+    tasks_data = await load_tasks()
 
-    if user_id not in data:
+    if user is None:
         await update.message.reply_text("🐷 You need a farm first! Use /myfarm.")
         return
 
@@ -577,9 +646,6 @@ async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     taskcode = context.args[0]
 
-    user = data[user_id]
-    user.setdefault("claimed_tasks", [])
-
     # Already claimed?
     if taskcode in user["claimed_tasks"]:
         await update.message.reply_text("⚠️ You’ve already claimed this task.")
@@ -597,10 +663,10 @@ async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Award coins + log claim
-    user["coins"] = user.get("coins", 0) + reward
+    user["coins"] += reward
     user["claimed_tasks"].append(taskcode)
 
-    save_data(data)
+    STORE.save_player(user_id)
 
     await update.message.reply_text(
         f"🎉 You earned {reward} coins for completing `{taskcode}`!"
@@ -609,116 +675,147 @@ async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Start feed mill
 async def startmill(update, context):
     user_id = str(update.effective_user.id)
-    data = load_feed_data()
-    if user_id in data["mills"]:
+    if STORE.get_mill(user_id) is not None:
         await update.message.reply_text("🏭 You already own a feed mill!")
         return
-    data["mills"][user_id] = {
+    mill_id = STORE.allocate_mill_id(user_id)
+    # The first batch is ready right away
+    first_batch = datetime.now() - timedelta(hours=MILL_LEVELS[0]["cooldown"])
+    mill = STORE.add_mill(user_id, {
+        "mill_id": mill_id,
         "level": 0,
-        "last_production": "1970-01-01T00:00:00",
+        "last_production": first_batch.isoformat(),
         "stock": [],
-        "brand": f"Mill #{user_id[-4:]}",
+        "brand": f"Mill #{mill_id}",
         "emoji": "🏭",
         "slogan": "Quality feed for every pig!",
         "royalty_points": 0,
         "sales": 0
-    }
-    save_feed_data(data)
-    await update.message.reply_text("🎉 Feed mill created at level 0! Use /makefeed to produce feed.")
+    })
+    MILL_ALERTS.schedule(user_id, mill, MILL_LEVELS[0]["cooldown"])
+    await update.message.reply_text("🎉 Feed mill created at level 0! Use /makefeed to collect its feed.")
 
-# Make feed
+# Make feed: collect what the mill produced since the last time
 async def makefeed(update, context):
     user_id = str(update.effective_user.id)
-    data = load_feed_data()
-    if user_id not in data["mills"]:
+    mill = STORE.get_mill(user_id)
+    if mill is None:
         await update.message.reply_text("❌ You don’t own a feed mill. Use /startmill first.")
         return
 
-    mill = data["mills"][user_id]
-    mill["stock"] = filter_valid_feed(mill.get("stock", []))
-    level = mill["level"]
+    mill.stock = filter_valid_feed(mill.stock)
+    level = mill.level
     cooldown = MILL_LEVELS[level]["cooldown"]
 
-    if not can_produce(mill["last_production"], cooldown):
-        await update.message.reply_text("⏳ Your mill is cooling down. Try again later.")
+    now = datetime.now()
+    batches = collect(mill, cooldown, now)
+    if not batches:
+        await update.message.reply_text(f"⏳ Your mill is cooling down. Next batch in {until(next_batch_at(mill, cooldown, now))}.")
         return
 
-    amount = MILL_LEVELS[level]["amount"]
+    amount = MILL_LEVELS[level]["amount"] * batches
     ftype = MILL_LEVELS[level].get("type", "normal")
 
-    mill["stock"].append({
+    mill.stock.append({
         "amount": amount,
         "type": ftype,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now.isoformat()
     })
-    mill["last_production"] = datetime.now().isoformat()
-    save_feed_data(data)
-    await update.message.reply_text(f"✅ Produced {amount} units of {ftype} feed!")
+    STORE.save_mill(user_id)
+    MILL_ALERTS.schedule(user_id, mill, cooldown)
+    await update.message.reply_text(f"✅ Collected {batches} batch(es): {amount} units of {ftype} feed!")
 
 # Mill status
 async def millstatus(update, context):
     user_id = str(update.effective_user.id)
-    data = load_feed_data()
-    if user_id not in data["mills"]:
+    mill = STORE.get_mill(user_id)
+    if mill is None:
         await update.message.reply_text("❌ You don’t own a feed mill. Use /startmill first.")
         return
-    mill = data["mills"][user_id]
     stock = filter_valid_feed(mill["stock"])
     total_feed = sum(item["amount"] for item in stock)
-    time_left = "Ready" if can_produce(mill["last_production"], MILL_LEVELS[mill["level"]]["cooldown"]) else "Cooling down"
+    level = MILL_LEVELS[mill["level"]]
+    now = datetime.now()
+    ready = ready_batches(mill, level["cooldown"], now)
+    if ready == MILL_CAP_BATCHES:
+        time_left = "Full, use /makefeed"
+    else:
+        time_left = f"next batch in {until(next_batch_at(mill, level['cooldown'], now))}, full in {until(full_at(mill, level['cooldown']))}"
     await update.message.reply_text(
         f"🏭 {mill['brand']} {mill['emoji']}\n"
+        f"🆔 Mill ID: {mill['mill_id']}\n"
         f"📦 Feed Stock: {total_feed} units\n"
         f"🧪 Level: {mill['level']}\n"
-        f"⏱️ Cooldown: {time_left}\n"
+        f"🧺 Ready: {ready}/{MILL_CAP_BATCHES} batches ({ready * level['amount']} units)\n"
+        f"⏱️ Production: {time_left}\n"
         f"💬 Slogan: {mill['slogan']}\n"
         f"🏅 Royalty Points: {mill['royalty_points']}\n"
         f"🛒 Total Sales: {mill['sales']}"
     )
 
 # Upgrade mill
-async def upgrademill(update, context):
-    user_id = str(update.effective_user.id)
-    data = load_feed_data()
-    players = load_data()
-    if user_id not in data["mills"]:
-        await update.message.reply_text("❌ You don’t own a feed mill.")
-        return
-
-    current_level = data["mills"][user_id]["level"]
+# The transaction only decides; the alert and the reply wait for its commit,
+# so a failed send can't undo a purchase already made
+def upgrade_mill(tx, user_id):
+    # (reply, whether the mill was upgraded)
+    mill = tx.get_mill(user_id)
+    player = tx.get_player(user_id)
+    if mill is None:
+        return "❌ You don’t own a feed mill.", False
+
+    current_level = mill["level"]
     if current_level >= 6:
-        await update.message.reply_text("🔝 Your feed mill is already maxed out!")
-        return
+        return "🔝 Your feed mill is already maxed out!", False
 
     cost = [0, 10, 20, 30, 50, 75][current_level + 1]
-    if players[user_id]["coins"] < cost:
-        await update.message.reply_text(f"💰 You need {cost} coins to upgrade to level {current_level + 1}.")
-        return
+    if player["coins"] < cost:
+        return f"💰 You need {cost} coins to upgrade to level {current_level + 1}.", False
 
-    players[user_id]["coins"] -= cost
-    data["mills"][user_id]["level"] += 1
-    save_data(players)
-    save_feed_data(data)
-    await update.message.reply_text(f"🔧 Upgraded to level {current_level + 1}!")
+    player["coins"] -= cost
+    mill["level"] += 1
+    tx.save_player(user_id)
+    tx.save_mill(user_id)
+    return f"🔧 Upgraded to level {current_level + 1}!", True
 
-# Rush mill
-async def rushmill(update, context):
+async def upgrademill(update, context):
     user_id = str(update.effective_user.id)
-    data = load_feed_data()
-    players = load_data()
-    if user_id not in data["mills"]:
-        await update.message.reply_text("❌ You don’t own a feed mill.")
-        return
+    with STORE.transaction() as tx:
+        reply, upgraded = upgrade_mill(tx, user_id)
+    if upgraded:
+        mill = STORE.get_mill(user_id)
+        MILL_ALERTS.schedule(user_id, mill, MILL_LEVELS[mill["level"]]["cooldown"])
+    await update.message.reply_text(reply)
 
-    if players[user_id].get("ton_balance", 0) < 1:
-        await update.message.reply_text("💎 You need at least 1 TON to rush production!")
-        return
+# Rush mill
+def rush_mill(tx, user_id):
+    # (reply, whether the mill was rushed)
+    mill = tx.get_mill(user_id)
+    player = tx.get_player(user_id)
+    if mill is None:
+        return "❌ You don’t own a feed mill.", False
+
+    if player["ton_balance"] < 1:
+        return "💎 You need at least 1 TON to rush production!", False
+
+    cooldown = MILL_LEVELS[mill["level"]]["cooldown"]
+    if ready_batches(mill, cooldown, datetime.now()) == MILL_CAP_BATCHES:
+        return "🏭 Your mill is already full! Use /makefeed first.", False
+
+    # Finishes one more batch right now
+    mill["last_production"] = (last_production(mill) - timedelta(hours=cooldown)).isoformat()
+    player["ton_balance"] -= 1
+    tx.save_player(user_id)
+    tx.save_mill(user_id)
+    return "⚡ Rush successful! You may now /makefeed immediately.", True
 
-    data["mills"][user_id]["last_production"] = "1970-01-01T00:00:00"
-    players[user_id]["ton_balance"] -= 1
-    save_data(players)
-    save_feed_data(data)
-    await update.message.reply_text("⚡ Rush successful! You may now /makefeed immediately.")
+async def rushmill(update, context):
+    user_id = str(update.effective_user.id)
+    with STORE.transaction() as tx:
+        reply, rushed = rush_mill(tx, user_id)
+    if rushed:
+        mill = STORE.get_mill(user_id)
+        MILL_ALERTS.schedule(user_id, mill, MILL_LEVELS[mill["level"]]["cooldown"])
+    await update.message.reply_text(reply)
 
 # Sell feed
 async def sellfeed(update, context):
@@ -734,13 +831,16 @@ async def sellfeed(update, context):
     except ValueError:
         await update.message.reply_text("❌ Please enter valid numbers.")
         return
+    if amount <= 0 or price <= 0:
+        await update.message.reply_text("❌ Amount and price must be above zero.")
+        return
 
-    data = load_feed_data()
-    if user_id not in data["mills"]:
+    mill = STORE.get_mill(user_id)
+    if mill is None:
         await update.message.reply_text("❌ You don’t own a feed mill.")
         return
 
-    stock = filter_valid_feed(data["mills"][user_id]["stock"])
+    stock = filter_valid_feed(mill.stock)
     total_feed = sum(item["amount"] for item in stock)
     if total_feed < amount:
         await update.message.reply_text("❌ Not enough feed to sell.")
@@ -759,146 +859,293 @@ async def sellfeed(update, context):
             new_stock.append({"amount": remain, "type": batch["type"], "timestamp": batch["timestamp"]})
             deducted = amount
 
-    data["mills"][user_id]["stock"] = new_stock
-
     # Add to market
     market_entry = {
         "seller_id": user_id,
         "amount": amount,
         "price": price,
-        "type": "premium" if data["mills"][user_id]["level"] == 6 else "normal",
+        "type": "premium" if mill.level == 6 else "normal",
         "timestamp": datetime.now().isoformat(),
-        "brand": data["mills"][user_id]["brand"],
-        "emoji": data["mills"][user_id]["emoji"],
-        "slogan": data["mills"][user_id]["slogan"],
+        "brand": mill.brand,
+        "emoji": mill.emoji,
+        "slogan": mill.slogan,
         "sales": 0
     }
-    data["market"].append(market_entry)
-    save_feed_data(data)
-    await update.message.reply_text(f"📦 Listed {amount} feed for {price} coins each.")
+    if CLUSTER.local_market:
+        STORE.add_listing(market_entry)
+    else:
+        await CLUSTER.call("list_feed", shard=MARKET_SHARD, listing=market_entry)
+    # Listed, so the feed leaves the mill
+    mill.stock = new_stock
+    STORE.save_mill(user_id)
+    await update.message.reply_text(
+        f"📦 Listed {amount} feed for {price} coins each.\n"
+        f"⏳ Whatever is unsold after {LISTING_DAYS:g} days goes back to your mill."
+    )
+
+@CLUSTER.op("list_feed")
+async def list_feed(app, listing):
+    return STORE.add_listing(listing)
 
 # View feed market
-async def feedmarket(update, context):
-    data = load_feed_data()
+def market_text(page):
+    # Cheapest offers first, oldest first at the same price. Expired
+    # listings stay listed (marked ⌛) until the hourly sweep removes them.
+    if not len(STORE.market):
+        return None
+    page, pages, first = page_bounds(page, len(STORE.market))
+    cutoff = STORE.market.cutoff()
     lines = []
-    for i, offer in enumerate(data["market"], 1):
-        lines.append(f"{i}. {offer['emoji']} {offer['brand']} — {offer['amount']} feed @ {offer['price']} coins\n"
+    for i, offer in enumerate(STORE.market.page(first, PAGE_SIZE), first + 1):
+        expired = " ⌛" if listed_at(offer) < cutoff else ""
+        lines.append(f"{i}. {offer['emoji']} {offer['brand']} — {offer['amount']} feed @ {offer['price']} coins{expired}\n"
                      f"   “{offer['slogan']}” | Sales: {offer['sales']}")
-    if not lines:
+    text = (
+        f"📦 FEED MARKET ({len(STORE.market)} listings), page {page}/{pages}:\n" + "\n".join(lines)
+        + "\n\nBuy with /buyfeed <amount> [max price]"
+    )
+    return {"text": text, "page": page, "pages": pages}
+
+@CLUSTER.op("market_page")
+async def market_text_op(app, page):
+    return market_text(page)
+
+async def market_page(page):
+    # None while the market is empty
+    if CLUSTER.local_market:
+        shown = market_text(page)
+    else:
+        shown = await CLUSTER.call("market_page", shard=MARKET_SHARD, page=page)
+    if shown is None:
+        return None
+    return {"text": shown["text"], "reply_markup": page_buttons("feedmarket", shown["page"], shown["pages"])}
+
+async def feedmarket(update, context):
+    shown = await market_page(page_arg(context.args))
+    if shown is None:
         await update.message.reply_text("📭 No feed available in the market.")
         return
-    await update.message.reply_text("📦 FEED MARKET:\n" + "\n".join(lines))
+    await update.message.reply_text(**shown)
 
 # Buy feed
-
-#update userid with millions
-def find_user_id_by_mill(mill_id):
-    feed_data = load_feed_data()
-    for user_id, mill in feed_data["mills"].items():
-        if str(user_id)[-4:] == str(mill_id):
-            return user_id
-    return None
-    
-#async def buyfeed(update, context):
+# /buyfeed <amount> [max price] buys from the cheapest listings across all
+# sellers. It takes the buyer's and sellers' locks itself (it's registered
+# without per_user), since the sellers are only known once it has matched.
 async def buyfeed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
-    feed_data = load_feed_data()
-
-    if user_id not in data:
-        await update.message.reply_text("🐷 You don't own a pig yet! Use /myfarm first.")
-        return
-
-    if len(context.args) != 2:
-        await update.message.reply_text("Usage: /buyfeed mill_id amount")
-        return
-
-    mill_id, amount = context.args
-    amount = int(amount)
-
-    # 🔍 Find actual user_id from mill_id
-    seller_id = find_user_id_by_mill(mill_id)
-
-    if (
-       not seller_id or 
-       seller_id not in feed_data["mills"] or 
-       feed_data["mills"][seller_id]["feed_stock"] < amount
-    ):
-       await update.message.reply_text("❌ Invalid mill or not enough feed available.")
-       return
-
-    #seller_mill = feed_data["mills"][seller_id]
-
-    #seller_mill = feed_data[seller_id]
-    seller_mill = feed_data["mills"][seller_id]
-    total_price = amount * seller_mill["price"]
-
-    if data[user_id]["coins"] < total_price:
-        await update.message.reply_text("💰 You don't have enough coins to buy this feed.")
-        return
-
-    # Do the trade
-    data[user_id]["feed"] = data[user_id].get("feed", 0) + amount
-    data[user_id]["coins"] -= total_price
-
-    feed_data["mills"][seller_id]["feed_stock"] -= amount
-    feed_data["mills"][seller_id]["sales"] += amount
-    feed_data["mills"][seller_id]["royalty_points"] += amount
-    data[seller_id]["coins"] += total_price
+    args = context.args
+    if len(args) not in (1, 2) or not all(a.isdigit() for a in args) or int(args[0]) == 0:
+        await update.message.reply_text("Usage: /buyfeed <amount> [max price]")
+        return
+
+    amount = int(args[0])
+    max_price = int(args[1]) if len(args) == 2 else None
+    if CLUSTER.sharded:
+        await buyfeed_sharded(update, user_id, amount, max_price)
+        return
+    sellers = {listing["seller_id"] for listing, _ in STORE.market.match(amount, user_id, max_price)}
+
+    async with USER_LOCKS.hold(user_id, *sellers):
+        # The book may have changed while we waited; only buy from sellers
+        # we hold the lock of
+        plan = STORE.market.match(amount, user_id, max_price, sellers)
+        with STORE.transaction() as tx:
+            reply = buy_feed(tx, user_id, plan, amount)
+    await update.message.reply_text(reply)
+
+def buy_feed(tx, user_id, plan, amount):
+    player = tx.get_player(user_id)
+    if player is None:
+        return "🐷 You don't own a pig yet! Use /myfarm first."
+    if not plan:
+        return "📭 No feed for sale at that price."
+
+    bought = sum(take for _, take in plan)
+    total_price = sum(listing["price"] * take for listing, take in plan)
+    if player.coins < total_price:
+        return f"💰 {bought} feed costs {total_price} coins, you have {player.coins}."
+
+    # Buyer, sellers and listings change together on commit
+    player.feed += bought
+    player.coins -= total_price
+    tx.save_player(user_id)
+    for listing, take in plan:
+        seller_id = listing["seller_id"]
+        seller = tx.get_player(seller_id)
+        if seller is not None:
+            seller.coins += listing["price"] * take
+            tx.save_player(seller_id)
+        mill = tx.get_mill(seller_id)
+        if mill is not None:
+            mill.sales += take
+            mill.royalty_points += take
+            tx.save_mill(seller_id)
+        tx.fill_listing(listing["id"], take)
+
+    sellers = len({listing["seller_id"] for listing, _ in plan})
+    note = f" (only {bought} were available)" if bought < amount else ""
+    return f"✅ Purchased {bought} feed from {sellers} seller(s) for {total_price} coins{note}."
+
+# With shards the book is on MARKET_SHARD and the sellers anywhere. The
+# buyer's shard holds the buyer's lock and sends their balance as a budget;
+# the market shard takes the feed off the book within it and keeps it under
+# a deal id. Once the buyer has paid, the deal is settled and the market
+# shard sends the sellers their coins without waiting (so two traders buying
+# from each other can't end up waiting on each other's locks). If the market
+# shard's answer never comes, the deal is cancelled and the feed goes back.
+async def buyfeed_sharded(update, user_id, amount, max_price):
+    deal_id = secrets.token_hex(8)
+    async with USER_LOCKS.hold(user_id):
+        player = STORE.get_player(user_id)
+        if player is None:
+            await update.message.reply_text("🐷 You don't own a pig yet! Use /myfarm first.")
+            return
+        try:
+            deal = await CLUSTER.call_again("take_feed", shard=MARKET_SHARD, deal_id=deal_id, buyer_id=user_id,
+                                            amount=amount, max_price=max_price, budget=player.coins)
+        except Exception as e:
+            print(f"⚠️ take_feed {deal_id} for {user_id} failed: {e}")
+            CLUSTER.post("cancel_feed", user_id, shard=MARKET_SHARD, deal_id=deal_id)
+            await update.message.reply_text("⚠️ The market didn't answer, nothing was bought. Try again in a moment.")
+            return
+        bought, total_price = deal["bought"], deal["cost"]
+        if not bought:
+            await update.message.reply_text("📭 No feed for sale at that price.")
+            return
+        if not deal["filled"]:
+            await update.message.reply_text(f"💰 {bought} feed costs {total_price} coins, you have {player.coins}.")
+            return
+        player.feed += bought
+        player.coins -= total_price
+        STORE.save_player(user_id)
+        CLUSTER.post("settle_feed", user_id, shard=MARKET_SHARD, deal_id=deal_id)
 
-    save_data(data)
-    save_feed_data(feed_data)
+    note = f" (only {bought} were available)" if bought < amount else ""
+    await update.message.reply_text(
+        f"✅ Purchased {bought} feed from {deal['sellers']} seller(s) for {total_price} coins{note}."
+    )
 
-    await update.message.reply_text(f"✅ Purchased {amount} feed from Mill #{mill_id} for {total_price} coins.")
+# Deals the market shard has taken feed off the book for, by deal id:
+# {"at", "reply" (take_feed's answer), "fills" [(listing, amount)]}. They
+# wait there for the buyer's shard to settle or cancel them; a cancelled
+# deal stays, empty, so a take_feed arriving after its cancel takes nothing.
+FEED_DEALS = {}
+DEAL_TIMEOUT = 600  # seconds before a deal nobody settled gives its feed back
+
+def no_deal(bought=0, cost=0):
+    return {"bought": bought, "cost": cost, "sellers": 0, "filled": False}
+
+@CLUSTER.op("take_feed")
+async def take_feed(app, deal_id, buyer_id, amount, max_price, budget):
+    # Asked again for the same deal, it answers as it did the first time
+    deal = FEED_DEALS.get(deal_id)
+    if deal is not None:
+        return deal["reply"]
+    plan = STORE.market.match(amount, buyer_id, max_price)
+    bought = sum(take for _, take in plan)
+    cost = sum(listing["price"] * take for listing, take in plan)
+    if not plan or cost > budget:
+        FEED_DEALS[deal_id] = {"at": time.time(), "reply": no_deal(bought, cost), "fills": []}
+        return FEED_DEALS[deal_id]["reply"]
+    for listing, take in plan:
+        STORE.fill_listing(listing["id"], take)
+    reply = {"bought": bought, "cost": cost, "sellers": len({l["seller_id"] for l, _ in plan}), "filled": True}
+    FEED_DEALS[deal_id] = {"at": time.time(), "reply": reply, "fills": plan}
+    return reply
+
+@CLUSTER.op("settle_feed")
+async def settle_feed(app, deal_id):
+    # The buyer has paid
+    deal = FEED_DEALS.pop(deal_id, None)
+    if deal is None:
+        return
+    proceeds = {}
+    for listing, take in deal["fills"]:
+        coins, sold = proceeds.get(listing["seller_id"], (0, 0))
+        proceeds[listing["seller_id"]] = (coins + listing["price"] * take, sold + take)
+    for seller_id, (coins, sold) in proceeds.items():
+        CLUSTER.post("feed_sold", seller_id, seller_id=seller_id, coins=coins, amount=sold)
+
+@CLUSTER.op("cancel_feed")
+async def cancel_feed(app, deal_id):
+    # The buyer hasn't paid and won't
+    deal = FEED_DEALS.setdefault(deal_id, {"at": time.time(), "reply": no_deal(), "fills": []})
+    for listing, take in deal["fills"]:
+        STORE.unfill_listing(listing, take)
+    deal["reply"], deal["fills"] = no_deal(), []
+
+def drop_stale_deals():
+    # A deal still open after DEAL_TIMEOUT most likely lost its buyer before
+    # they paid, so its feed goes back on the book
+    cutoff = time.time() - DEAL_TIMEOUT
+    for deal_id, deal in list(FEED_DEALS.items()):
+        if deal["at"] >= cutoff:
+            continue
+        if deal["fills"]:
+            print(f"⚠️ Deal {deal_id} was never settled, putting {deal['reply']['bought']} feed back on the market")
+            for listing, take in deal["fills"]:
+                STORE.unfill_listing(listing, take)
+        del FEED_DEALS[deal_id]
+
+@CLUSTER.op("feed_sold")
+async def feed_sold(app, seller_id, coins, amount):
+    async with USER_LOCKS.hold(seller_id):
+        seller = STORE.get_player(seller_id)
+        if seller is not None:
+            seller.coins += coins
+            STORE.save_player(seller_id)
+        mill = STORE.get_mill(seller_id)
+        if mill is not None:
+            mill.sales += amount
+            mill.royalty_points += amount
+            STORE.save_mill(seller_id)
 
 #updated milltofarm
-async def milltofarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    user_id = str(user.id)
-
-    data = load_data()
-    feed_data = load_feed_data()
+def mill_to_farm(tx, user_id, args):
+    player = tx.get_player(user_id)
+    mill = tx.get_mill(user_id)
 
-    if user_id not in data:
-        await update.message.reply_text("🐷 You don't own a pig yet. Use /myfarm to get started.")
-        return
+    if player is None:
+        return "🐷 You don't own a pig yet. Use /myfarm to get started."
 
-    if user_id not in feed_data.get("mills", {}):
-        await update.message.reply_text("🏭 You don't own a feed mill yet. Use /startmill to begin.")
-        return
+    if mill is None:
+        return "🏭 You don't own a feed mill yet. Use /startmill to begin."
 
-    if len(context.args) != 1 or not context.args[0].isdigit():
-        await update.message.reply_text("Usage: /milltofarm <amount>")
-        return
+    if len(args) != 1 or not args[0].isdigit():
+        return "Usage: /milltofarm <amount>"
 
-    amount = int(context.args[0])
-    mill = feed_data["mills"][user_id]
+    amount = int(args[0])
 
     if len(mill["stock"]) < amount:
-        await update.message.reply_text("❌ Not enough feed in your mill to transfer.")
-        return
+        return "❌ Not enough feed in your mill to transfer."
 
     # Transfer feed items from mill stock to player's feed
     mill["stock"] = mill["stock"][amount:]  # Remove from mill
-    data[user_id]["feed"] = data[user_id].get("feed", 0) + amount  # Add to farm
+    player["feed"] += amount  # Add to farm
 
-    save_feed_data(feed_data)
-    save_data(data)
+    tx.save_mill(user_id)
+    tx.save_player(user_id)
 
-    await update.message.reply_text(
+    return (
         f"✅ Moved {amount} feed from your Mill to your Farm.\n"
-        f"📦 Farm Feed: {data[user_id]['feed']} units\n"
+        f"📦 Farm Feed: {player['feed']} units\n"
         f"🏭 Mill Feed: {len(mill['stock'])} units"
     )
+
+async def milltofarm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    with STORE.transaction() as tx:
+        reply = mill_to_farm(tx, user_id, context.args)
+    await update.message.reply_text(reply)
+
 # Brand stats
 async def brandstats(update, context):
     user_id = str(update.effective_user.id)
-    data = load_feed_data()
-    if user_id not in data["mills"]:
+    mill = STORE.get_mill(user_id)
+    if mill is None:
         await update.message.reply_text("❌ You don’t own a feed mill.")
         return
 
-    mill = data["mills"][user_id]
     await update.message.reply_text(
         f"📊 {mill['brand']} {mill['emoji']}\n"
         f"🧪 Level: {mill['level']}\n"
@@ -907,18 +1154,90 @@ async def brandstats(update, context):
         f"🛒 Total Sales: {mill['sales']}"
     )
 
+# Leaderboards cover every shard: each sends its own top n and they're
+# merged here
+def top_brands_part(n):
+    return [(uid, m["brand"], m["emoji"], m["royalty_points"], m["sales"]) for uid, m in STORE.top_mills(n)]
+
+@CLUSTER.op("top_brands")
+async def top_brands_op(app, n):
+    return top_brands_part(n)
+
+def top_players_part(field, n, score):
+    ranking = STORE.player_ranks[field]
+    return {
+        "top": [(uid, p["username"], p[field]) for uid, p in STORE.top_players(field, n)],
+        "total": len(ranking),
+        "above": ranking.above(score) if score is not None else 0,
+    }
+
+@CLUSTER.op("top_players")
+async def top_players_op(app, field, n, score=None):
+    return top_players_part(field, n, score)
+
+async def top_players(field, n, score=None):
+    # ([(user_id, username, value)] highest first, players ranked, players
+    # ranked above score)
+    if CLUSTER.sharded:
+        parts = await CLUSTER.call("top_players", everywhere=True, field=field, n=n, score=score)
+    else:
+        parts = [top_players_part(field, n, score)]
+    rows = sorted((row for part in parts for row in part["top"]), key=lambda row: (-row[2], row[0]))[:n]
+    return rows, sum(part["total"] for part in parts), sum(part["above"] for part in parts)
+
 # Top brands leaderboard
 async def topbrands(update, context):
-    data = load_feed_data()
-    ranked = sorted(data["mills"].items(), key=lambda x: x[1].get("royalty_points", 0), reverse=True)
+    if CLUSTER.sharded:
+        parts = await CLUSTER.call("top_brands", everywhere=True, n=5)
+    else:
+        parts = [top_brands_part(5)]
+    brands = sorted((row for part in parts for row in part), key=lambda row: (-row[3], row[0]))[:5]
     lines = []
-    for i, (uid, mill) in enumerate(ranked[:5], 1):
-        lines.append(f"{i}. {mill['brand']} {mill['emoji']} — {mill['royalty_points']} RP, {mill['sales']} sales")
+    for i, (uid, brand, emoji, royalty_points, sales) in enumerate(brands, 1):
+        lines.append(f"{i}. {brand} {emoji} — {royalty_points} RP, {sales} sales")
     if not lines:
         await update.message.reply_text("📭 No branded mills ranked yet.")
     else:
         await update.message.reply_text("🏆 Top Feed Brands:\n" + "\n".join(lines))
 
+# Player leaderboards: /leaderboard [coins|streak|ton]
+LEADERBOARDS = {
+    "coins": ("coins", "💰"),
+    "streak": ("streak", "🔥"),
+    "ton": ("ton_balance", "💎"),
+}
+
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    board = context.args[0].lower() if context.args else "coins"
+    if board not in LEADERBOARDS:
+        await update.message.reply_text("Usage: /leaderboard [coins|streak|ton]")
+        return
+
+    field, emoji = LEADERBOARDS[board]
+
+    def show(value):
+        return f"{value:.2f}" if field == "ton_balance" else value
+
+    score = STORE.player_ranks[field].score(user_id)
+    rows, total, above = await top_players(field, 10, score)
+    lines = []
+    for i, (uid, name, value) in enumerate(rows, 1):
+        lines.append(f"{i}. {name or 'Farmer'} — {emoji} {show(value)}")
+    if not lines:
+        await update.message.reply_text("📭 Nobody is on this leaderboard yet.")
+        return
+
+    msg = f"🏆 Top Farmers by {board}:\n" + "\n".join(lines)
+    if CLUSTER.sharded:
+        # Players tied with us count as behind us
+        rank = above + 1 if score is not None else None
+    else:
+        rank, score, total = STORE.player_rank(field, user_id)
+    if rank:
+        msg += f"\n\n📍 Your rank: #{rank} of {total} ({emoji} {show(score)})"
+    await update.message.reply_text(msg)
+
 # 
 
 #pork plants 
@@ -926,19 +1245,19 @@ async def topbrands(update, context):
 
 async def startplant(update, context):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    player = STORE.get_player(user_id) or {}
 
-    if "plant" in data.get(user_id, {}):
+    if "plant" in player:
         await update.message.reply_text("🏭 You already own a pork plant!")
         return
 
-    if data[user_id].get("ton_balance", 0) < 1:
+    if player["ton_balance"] < 1:
         await update.message.reply_text("💎 You need 1 TON to start your pork plant business.")
         return
 
-    data[user_id]["ton_balance"] -= 1  # Deduct 1 TON
+    player["ton_balance"] -= 1  # Deduct 1 TON
 
-    data[user_id]["plant"] = {
+    player["plant"] = {
         "level": 0,
         "last_meat": "1970-01-01",
         "last_sausage": "1970-01-01",
@@ -947,24 +1266,20 @@ async def startplant(update, context):
         "ton_earned": 0
     }
 
-    save_data(data)
+    STORE.save_player(user_id)
     await update.message.reply_text("🎉 Welcome to the Sausage Syndicate™! Your pork plant is open for business. 🏭")
 
 async def process_pig(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
-    feed_data = load_feed_data()
+    user = STORE.get_player(user_id)
 
-    if user_id not in data:
+    if user is None:
         await update.message.reply_text("🐷 You don't have a farm yet! Use /myfarm first.")
         return
 
-    user = data[user_id]
-    mill = feed_data.get(user_id, {})
+    mill = STORE.get_plant(user_id) or {}
     plant_level = mill.get("plant_level", 0)
-    pigs = user.get("piglets", [])
-
-    if not pigs:
+    if not count_piglets(user):
         await update.message.reply_text("🐽 You have no piglets to process!")
         return
 
@@ -973,25 +1288,23 @@ async def process_pig(update: Update, context: ContextTypes.DEFAULT_TYPE):
     product = ""
     today = datetime.now().strftime("%Y-%m-%d")
 
-    for pig in pigs:
-        age = pig.get("age", 0)
-        pig_type = pig.get("type", "normal")
+    for pig_type, age, _ in piglet_groups(user):
 
         # Determine product based on eligibility + level
         if "bacon" in PLANT_LEVELS[plant_level]["products"]:
             if pig_type == "golden" and age >= 10 and not has_processed_today(user, "bacon"):
                 product = "bacon"
-                eligible_pig = pig
+                eligible_pig = (pig_type, age)
                 break
         if "sausage" in PLANT_LEVELS[plant_level]["products"]:
             if pig_type in ["golden", "spotted"] and not has_processed_today(user, "sausage"):
                 product = "sausage"
-                eligible_pig = pig
+                eligible_pig = (pig_type, age)
                 break
         if "meat" in PLANT_LEVELS[plant_level]["products"]:
             if age >= 3 and not has_processed_today(user, "meat"):
                 product = "meat"
-                eligible_pig = pig
+                eligible_pig = (pig_type, age)
                 break
 
     if not eligible_pig:
@@ -1000,10 +1313,10 @@ async def process_pig(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Reward TON using PLANT_LEVELS table
     reward_ton = PLANT_LEVELS[plant_level]["reward"][product]
-    user["ton_balance"] = user.get("ton_balance", 0) + reward_ton
-    user["piglets"].remove(eligible_pig)
+    user["ton_balance"] += reward_ton
+    remove_piglets(user, *eligible_pig)
     mark_processed_today(user, product)
-    save_data(data)
+    STORE.save_player(user_id)
 
     await update.message.reply_text(
         f"✅ Processed one piglet into {product.upper()}!\n💰 Earned {reward_ton} TON.\nCome back tomorrow to process again."
@@ -1011,9 +1324,7 @@ async def process_pig(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def plantstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    feed_data = load_feed_data()
-
-    user_plant = feed_data.get(user_id)
+    user_plant = STORE.get_plant(user_id)
     if not user_plant or "plant_level" not in user_plant:
         await update.message.reply_text("❌ You don’t have a pork plant yet. Use /startplant to begin.")
         return
@@ -1047,53 +1358,50 @@ async def plantstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(message)
 
-async def upgradeplant(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    data = load_data()
-    feed_data = load_feed_data()
-
-    user = data.get(user_id)
-    plant = feed_data.get(user_id)
+def upgrade_plant(tx, user_id):
+    user = tx.get_player(user_id)
+    plant = tx.get_plant(user_id)
 
     if not user or not plant:
-        await update.message.reply_text("❌ You need a farm and pork plant first.")
-        return
+        return "❌ You need a farm and pork plant first."
 
     level = plant.get("plant_level", 0)
     if level >= 6:
-        await update.message.reply_text("✅ Your plant is already at max level (6)!")
-        return
+        return "✅ Your plant is already at max level (6)!"
 
-    ton = user.get("ton_balance", 0)
+    ton = user["ton_balance"]
     if ton < 1:
-        await update.message.reply_text("❌ You need at least 1 TON to upgrade your plant.")
-        return
+        return "❌ You need at least 1 TON to upgrade your plant."
 
     # Upgrade
     user["ton_balance"] = round(ton - 1, 2)
     plant["plant_level"] = level + 1
 
     # Log it
-    if "ton_log" not in user:
-        user["ton_log"] = []
     user["ton_log"].append({
         "date": datetime.now().strftime("%Y-%m-%d"),
         "source": "upgradeplant",
         "amount": -1
     })
 
-    save_data(data)
-    save_feed_data(feed_data)
+    tx.save_player(user_id)
+    tx.save_plant(user_id)
 
     unlocked = PLANT_LEVELS[level + 1]["products"]
     emojis = {"meat": "🍖", "sausage": "🌭", "bacon": "🥓"}
     unlocked_str = ", ".join([emojis[p] + " " + p.capitalize() for p in unlocked])
 
-    await update.message.reply_text(
+    return (
         f"🎉 Pork Plant upgraded to Level {level + 1}!\n"
         f"🔓 New unlocks: {unlocked_str}\n"
         f"💎 Remaining TON: {user['ton_balance']:.2f}"
     )
+
+async def upgradeplant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    with STORE.transaction() as tx:
+        reply = upgrade_plant(tx, user_id)
+    await update.message.reply_text(reply)
 #
 # TON #Economy
 
@@ -1101,14 +1409,13 @@ async def upgradeplant(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
-    user = data.get(user_id)
+    user = STORE.get_player(user_id)
 
     if not user:
         await update.message.reply_text("🐷 You don't have a farm yet. Use /myfarm to begin.")
         return
 
-    ton = user.get("ton_balance", 0)
+    ton = user["ton_balance"]
     wallet = user.get("ton_wallet", "❌ Not set")
 
     await update.message.reply_text(
@@ -1120,9 +1427,9 @@ async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def setwallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    player = STORE.get_player(user_id)
 
-    if user_id not in data:
+    if player is None:
         await update.message.reply_text("❌ You don’t have a farm yet. Use /start first.")
         return
 
@@ -1135,8 +1442,8 @@ async def setwallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid TON address.")
         return
 
-    data[user_id]["ton_wallet"] = address
-    save_data(data)
+    player["ton_wallet"] = address
+    STORE.save_player(user_id)
 
     await update.message.reply_text(f"✅ Wallet address saved!\n{address}")
 
@@ -1144,9 +1451,9 @@ async def setwallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def exchangeton(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    user = STORE.get_player(user_id)
 
-    if user_id not in data:
+    if user is None:
         await update.message.reply_text("🐽 You need a farm first! Use /start.")
         return
 
@@ -1155,8 +1462,7 @@ async def exchangeton(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     coins_to_convert = int(context.args[0])
-    user = data[user_id]
-    user_coins = user.get("coins", 0)
+    user_coins = user["coins"]
 
     if coins_to_convert > user_coins:
         await update.message.reply_text("❌ Not enough coins.")
@@ -1164,18 +1470,16 @@ async def exchangeton(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     ton_earned = coins_to_convert / EXCHANGE_RATE
     user["coins"] -= coins_to_convert
-    user["ton_balance"] = user.get("ton_balance", 0) + ton_earned
+    user["ton_balance"] += ton_earned
 
     # log exchange
-    if "ton_log" not in user:
-        user["ton_log"] = []
     user["ton_log"].append({
         "date": datetime.now().strftime("%Y-%m-%d"),
         "source": f"exchange:{coins_to_convert}coins",
         "amount": ton_earned
     })
 
-    save_data(data)
+    STORE.save_player(user_id)
     await update.message.reply_text(
         f"🔄 Exchanged {coins_to_convert} coins for {ton_earned:.2f} TON.\n"
         f"💼 New TON balance: {user['ton_balance']:.2f}"
@@ -1186,14 +1490,13 @@ ADMIN_ID = "6382166583"  # replace with your Telegram ID
 
 async def claimton(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = load_data()
+    user = STORE.get_player(user_id)
 
-    if user_id not in data:
+    if user is None:
         await update.message.reply_text("🐽 You need a farm to claim TON.")
         return
 
-    user = data[user_id]
-    ton = user.get("ton_balance", 0)
+    ton = user["ton_balance"]
     wallet = user.get("ton_wallet")
 
     if not wallet:
@@ -1226,16 +1529,8 @@ async def tonlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🚫 You're not authorized to use this command.")
         return
 
-    data = load_data()
-    ton_summary = []
-
-    for uid, info in data.items():
-        ton = info.get("ton_balance", 0)
-        name = info.get("username", "Unknown")
-        if ton > 0:
-            ton_summary.append((ton, name, uid))
-
-    top_users = sorted(ton_summary, reverse=True)[:10]
+    rows, _, _ = await top_players("ton_balance", 10)
+    top_users = [(ton, name or "Unknown", uid) for uid, name, ton in rows]
     if not top_users:
         await update.message.reply_text("📭 No users with TON balance found.")
         return
@@ -1263,13 +1558,12 @@ async def payuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid amount.")
         return
 
-    data = load_data()
-    user = data.get(uid)
+    user = STORE.get_player(uid)
     if not user:
         await update.message.reply_text("❌ User not found.")
         return
 
-    current_balance = user.get("ton_balance", 0)
+    current_balance = user["ton_balance"]
     if amount > current_balance:
         await update.message.reply_text("❌ Not enough TON balance.")
         return
@@ -1277,15 +1571,13 @@ async def payuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user["ton_balance"] = round(current_balance - amount, 2)
 
     # Optional: Add log entry
-    if "ton_log" not in user:
-        user["ton_log"] = []
     user["ton_log"].append({
         "date": datetime.now().strftime("%Y-%m-%d"),
         "source": "admin:cashout",
         "amount": -amount
     })
 
-    save_data(data)
+    STORE.save_player(uid)
     await update.message.reply_text(f"✅ Deducted {amount} TON from {uid}.\n💼 New balance: {user['ton_balance']:.2f}")
 
 
@@ -1300,30 +1592,68 @@ async def cashout(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uid = context.args[0]
-    data = load_data()
-    user = data.get(uid)
+    user = STORE.get_player(uid)
     if not user:
         await update.message.reply_text("❌ User not found.")
         return
 
-    old_balance = user.get("ton_balance", 0)
+    old_balance = user["ton_balance"]
     user["ton_balance"] = 0
 
-    if "ton_log" not in user:
-        user["ton_log"] = []
     user["ton_log"].append({
         "date": datetime.now().strftime("%Y-%m-%d"),
         "source": "admin:fullcashout",
         "amount": -old_balance
     })
 
-    save_data(data)
+    STORE.save_player(uid)
     await update.message.reply_text(f"💸 Full cashout for {uid} completed.\nDeducted {old_balance:.2f} TON.")
 
 #
 
 ADMIN_ID = os.getenv("ADMIN_ID", "1576099978")
 
+async def send_backup(bot, chat_id, label="", full=False):
+    # Incremental backup (see backups.py): sends a zip of the chunks that
+    # changed since the last backup sent, or with full=True the gzipped
+    # players.json and feed_data.json; returns ([sent], [failed])
+    try:
+        paths, summary, sent = await BACKUPS.archive(STORE, full)
+    except Exception as e:
+        return [], [f"backup{label} (error: {str(e)})"]
+    if not paths:
+        await bot.send_message(chat_id=chat_id, text=f"💾 Backup{label}: {summary}")
+        return [f"backup{label} (unchanged)"], []
+    successful_backups = []
+    failed_backups = []
+
+    for path in paths:
+        filename = os.path.basename(path)
+        name = filename + label
+        try:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=await run_io(read_file, path),
+                filename=filename,
+                caption=f"📁 Backup{label}: {summary}"
+            )
+            successful_backups.append(name)
+
+        except FileNotFoundError:
+            failed_backups.append(f"{name} (not found)")
+        except PermissionError:
+            failed_backups.append(f"{name} (permission denied)")
+        except Exception as e:
+            failed_backups.append(f"{name} (error: {str(e)})")
+    if sent is not None and not failed_backups:
+        # The next /backup only sends what this one didn't have
+        await run_io(sent)
+    return successful_backups, failed_backups
+
+@CLUSTER.op("backup")
+async def backup_op(app, chat_id, full=False):
+    return await send_backup(app.bot, chat_id, f" (shard {SHARD_ID + 1}/{SHARDS})", full)
+
 async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
@@ -1332,34 +1662,17 @@ async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ You're not authorized to use this command.")
         return
 
+    # /backup sends what changed since the last backup, /backup full everything
+    full = bool(context.args) and context.args[0].lower() == "full"
     await update.message.chat.send_action(action=ChatAction.UPLOAD_DOCUMENT)
 
-    files_to_backup = ["players.json", "feed_data.json"]
-    successful_backups = []
-    failed_backups = []
-
-    for filename in files_to_backup:
-        try:
-            # Check if file exists
-            if not os.path.exists(filename):
-                failed_backups.append(f"{filename} (file not found)")
-                continue
-            
-            # Use context manager to ensure file is properly closed
-            with open(filename, "rb") as file:
-                await update.message.reply_document(
-                    document=file, 
-                    filename=filename,
-                    caption=f"📁 Backup: {filename}"
-                )
-            successful_backups.append(filename)
-            
-        except FileNotFoundError:
-            failed_backups.append(f"{filename} (not found)")
-        except PermissionError:
-            failed_backups.append(f"{filename} (permission denied)")
-        except Exception as e:
-            failed_backups.append(f"{filename} (error: {str(e)})")
+    if CLUSTER.sharded:
+        # Each shard sends its own files
+        parts = await CLUSTER.call("backup", everywhere=True, chat_id=update.effective_chat.id, full=full)
+        successful_backups = [name for sent, _ in parts for name in sent]
+        failed_backups = [name for _, failed in parts for name in failed]
+    else:
+        successful_backups, failed_backups = await send_backup(context.bot, update.effective_chat.id, full=full)
 
     # Send summary message
     if successful_backups and not failed_backups:
@@ -1373,43 +1686,6 @@ async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(f"❌ Backup failed: {', '.join(failed_backups)}")
 
-# Alternative version with even better error handling
-async def backup_v2(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ You're not authorized to use this command.")
-        return
-
-    await update.message.chat.send_action(action=ChatAction.UPLOAD_DOCUMENT)
-
-    backup_files = [
-        {"path": "players.json", "description": "Main game data"},
-        {"path": "feed_data.json", "description": "Feed mill data"}
-    ]
-
-    for file_info in backup_files:
-        filepath = file_info["path"]
-        description = file_info["description"]
-        
-        try:
-            if not os.path.exists(filepath):
-                await update.message.reply_text(f"⚠️ {description} file ({filepath}) not found, skipping...")
-                continue
-                
-            with open(filepath, "rb") as f:
-                await update.message.reply_document(
-                    document=f,
-                    filename=filepath,
-                    caption=f"📁 {description}"
-                )
-                
-        except Exception as e:
-            await update.message.reply_text(f"❌ Failed to backup {description}: {str(e)}")
-            continue
-
-    await update.message.reply_text("✅ Backup process completed!")
-
 async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if user_id != ADMIN_ID:
@@ -1427,14 +1703,32 @@ async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Only 'players.json' or 'feed_data.json' are allowed.")
         return
 
+    if CLUSTER.sharded:
+        # The file would have to be split between the shards
+        await update.message.reply_text("❌ Restore isn't available while the bot runs sharded.")
+        return
+
     file = await context.bot.get_file(doc.file_id)
-    file_path = f"./{file_name}"
+    # Downloaded next to the live file and only renamed over it once checked
+    file_path = f"./{file_name}.upload"
 
     try:
         await file.download_to_drive(file_path)
-        await update.message.reply_text(f"✅ Restored {file_name} successfully!")
+        counts = await run_io(check_file, file_name, file_path, len(MILL_LEVELS))
+        await STORE.restore_json(file_name, file_path)
+        if file_name == "feed_data.json":
+            # Schedule the restored mills' alerts
+            await MILL_ALERTS.stop()
+            MILL_ALERTS.start(STORE, context.bot, MILL_LEVELS)
+        held = ", ".join(f"{n} {what}" for what, n in counts.items())
+        await update.message.reply_text(f"✅ Restored {file_name} successfully! ({held})")
+    except SchemaError as e:
+        await update.message.reply_text(f"❌ {file_name} not restored, it doesn't look right: {e}")
     except Exception as e:
         await update.message.reply_text(f"❌ Restore failed: {e}")
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
 
 ADMIN_IDS = ["1576099978"]  # Replace with your admin Telegram ID(s)
 
@@ -1452,7 +1746,7 @@ async def posttask(update: Update, context: ContextTypes.DEFAULT_TYPE):
     coins = int(context.args[1])
     message = " ".join(context.args[2:])
 
-    tasks_data = load_tasks()
+    tasks_data = await load_tasks()
 
     # Avoid duplicate codes
     for task in tasks_data["tasks"]:
@@ -1466,7 +1760,7 @@ async def posttask(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "message": message
     })
 
-    save_tasks(tasks_data)
+    await save_tasks(tasks_data)
     await update.message.reply_text(f"✅ Task '{taskcode}' posted and saved!")
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1479,64 +1773,258 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /broadcast <your message>")
         return
 
+    # Sent in the background; the job posts a progress message it keeps updated
     message = "📢 *Admin Message:*\n" + " ".join(context.args)
-    data = load_data()
+    if CLUSTER.sharded:
+        # Every shard sends to its own players, with its own progress message
+        started = await CLUSTER.call("broadcast", everywhere=True, admin_chat=update.effective_chat.id, text=message)
+        if not any(started):
+            await update.message.reply_text("⏳ A broadcast is already running. Use /stopbroadcast to cancel it.")
+        return
 
-    count = 0
-    for uid in data:
-        try:
-            await context.bot.send_message(chat_id=int(uid), text=message, parse_mode="Markdown")
-            count += 1
-        except:
-            pass  # Skip failed sends (user may have blocked bot)
+    if BROADCASTER.running:
+        await update.message.reply_text("⏳ A broadcast is already running. Use /stopbroadcast to cancel it.")
+        return
+    BROADCASTER.start(STORE, context.bot, update.effective_chat.id, message)
 
-    await update.message.reply_text(f"✅ Message sent to {count} players!")
+@CLUSTER.op("broadcast")
+async def broadcast_op(app, admin_chat, text):
+    if BROADCASTER.running:
+        return False
+    BROADCASTER.start(STORE, app.bot, admin_chat, text, label=f"shard {SHARD_ID + 1}/{SHARDS}")
+    return True
 
+async def stopbroadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ You’re not allowed to use this command.")
+        return
 
+    if CLUSTER.sharded:
+        stopped = any(await CLUSTER.call("stopbroadcast", everywhere=True))
+    else:
+        stopped = await BROADCASTER.stop(cancel=True)
+    if not stopped:
+        await update.message.reply_text("📭 No broadcast is running.")
+
+@CLUSTER.op("stopbroadcast")
+async def stopbroadcast_op(app):
+    return await BROADCASTER.stop(cancel=True)
+
+def perf_lines(family, limit=10):
+    lines = []
+    for label, hist, errors in METRICS.rows(family)[:limit]:
+        mean = hist.sum / hist.count * 1000
+        p99 = hist.quantile(0.99) * 1000
+        line = f"• {label}: {hist.count}× avg {mean:.1f}ms p99 ≤{p99:g}ms"
+        if errors:
+            line += f" ⚠️ {errors} failed"
+        lines.append(line)
+    return lines or ["• nothing yet"]
+
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ You’re not allowed to use this command.")
+        return
+
+    # Slowest first (by p99); the full histograms are in the metrics file
+    uptime = timedelta(seconds=int(time.time() - METRICS.started))
+    text = (
+        f"📈 Performance (up {uptime})\n\n"
+        "🎮 Commands\n" + "\n".join(perf_lines("handler")) + "\n\n"
+        "💾 Storage\n" + "\n".join(perf_lines("storage")) + "\n\n"
+        "📡 Bot API\n" + "\n".join(perf_lines("bot_api"))
+    )
+    await update.message.reply_text(text)
+
+# ◀️/▶️ on a paged listing
+async def turn_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    view, _, page = query.data.partition(":")
+    page = int(page) if page.isdigit() else 1
+    await query.answer()
+
+    if view == "feedmarket":
+        shown = await market_page(page)
+        if shown is None:
+            return
+    elif view == "sellpiglet":
+        player = STORE.get_player(str(update.effective_user.id))
+        if player is None or not count_piglets(player):
+            return
+        shown = piglet_page(player, page)
+    elif view == "tasks":
+        tasks_data = await load_tasks()
+        if not tasks_data["tasks"]:
+            return
+        shown = tasks_page(tasks_data["tasks"], page)
+    else:
+        return
+    try:
+        await query.edit_message_text(**shown)
+    except BadRequest:
+        pass  # e.g. "message is not modified" after a double tap
+
+# Runs before every command: keeps the sender's farm in the working set, and
+# players who blocked the bot are skipped by broadcasts until they use it again
+async def mark_active(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user:
+        return
+    user_id = str(update.effective_user.id)
+    player = STORE.touch(user_id)
+    if player and player.get("blocked"):
+        del player["blocked"]
+        STORE.save_player(user_id)
+
+
+
+# Other players a command touches, so per_user() locks them as well
+def first_arg(update, context):
+    return context.args[:1]
+
+# Unsold listings past LISTING_DAYS go back to the seller's mill; buyfeed
+# already skips them
+EXPIRY_INTERVAL = 3600
+expiry_task = None
+
+async def expire_listings():
+    expired = 0
+    for listing in STORE.market.expired():
+        seller_id = listing["seller_id"]
+        if not CLUSTER.local(seller_id):
+            STORE.remove_listing(listing["id"])
+            CLUSTER.post("feed_returned", seller_id, seller_id=seller_id, amount=listing["amount"],
+                         feed_type=listing["type"])
+            expired += 1
+            continue
+        async with USER_LOCKS.hold(seller_id):
+            # Bought out or expired by someone else while we waited
+            if STORE.market.get(listing["id"]) is not listing:
+                continue
+            STORE.remove_listing(listing["id"])
+            return_feed(seller_id, listing["amount"], listing["type"])
+            expired += 1
+    return expired
+
+def return_feed(seller_id, amount, feed_type):
+    mill = STORE.get_mill(seller_id)
+    if mill is not None:
+        mill["stock"].append({
+            "amount": amount,
+            "type": feed_type,
+            "timestamp": datetime.now().isoformat()
+        })
+        STORE.save_mill(seller_id)
+
+@CLUSTER.op("feed_returned")
+async def feed_returned(app, seller_id, amount, feed_type):
+    async with USER_LOCKS.hold(seller_id):
+        return_feed(seller_id, amount, feed_type)
+
+async def expire_listings_loop():
+    while True:
+        try:
+            drop_stale_deals()
+            expired = await expire_listings()
+            if expired:
+                print(f"⏳ Returned {expired} expired listings to their mills")
+        except Exception as e:
+            print(f"⚠️ Listing expiry failed: {e}")
+        await asyncio.sleep(EXPIRY_INTERVAL)
+
+async def on_startup(application):
+    global expiry_task
+    if CLUSTER.sharded:
+        CLUSTER.start(application)
+    await STORE.load_rankings()
+    STORE.start(busy=USER_LOCKS.busy)
+    METRICS.start()
+    MILL_ALERTS.start(STORE, application.bot, MILL_LEVELS)
+    DAILY.start(STORE)
+    BACKUPS.start(STORE)
+    if CLUSTER.local_market:
+        expiry_task = asyncio.get_running_loop().create_task(expire_listings_loop())
+    BROADCASTER.resume(STORE, application.bot)
+
+async def on_shutdown(application):
+    # Leaves an unfinished broadcast on disk to resume next start
+    await BROADCASTER.stop()
+    await MILL_ALERTS.stop()
+    await DAILY.stop()
+    await BACKUPS.stop()
+    if expiry_task is not None:
+        expiry_task.cancel()
+    # Coins and feed still on their way to other shards
+    await CLUSTER.stop()
+    await STORE.stop()
+    await METRICS.stop()
 
 # Main application
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("buy", buy))
-    app.add_handler(CommandHandler("feed", feed))
-    app.add_handler(CommandHandler("myfarm", myfarm))
-    app.add_handler(CommandHandler("breed", breed))
-    app.add_handler(CommandHandler("checkbreed", checkbreed))
-    app.add_handler(CommandHandler("sellpiglet", sellpiglet))
-    app.add_handler(CommandHandler("market", market))
-    app.add_handler(CommandHandler("buymarket", buymarket))
-    app.add_handler(CommandHandler("referral", referral))
-    app.add_handler(CommandHandler("tasks", tasks))
-    app.add_handler(CommandHandler("claim", claim))
-    app.add_handler(CommandHandler("startmill", startmill))
-    app.add_handler(CommandHandler("makefeed", makefeed))
-    app.add_handler(CommandHandler("millstatus", millstatus))
-    app.add_handler(CommandHandler("upgrademill", upgrademill))
-    app.add_handler(CommandHandler("rushmill", rushmill))
-    app.add_handler(CommandHandler("sellfeed", sellfeed))
-    app.add_handler(CommandHandler("feedmarket", feedmarket))
-    app.add_handler(CommandHandler("buyfeed", buyfeed))
-    app.add_handler(CommandHandler("brandstats", brandstats))
-    app.add_handler(CommandHandler("topbrands", topbrands))
-    app.add_handler(CommandHandler("startplant", startplant))
-    app.add_handler(CommandHandler("processpig", process_pig))
-    app.add_handler(CommandHandler("plantstatus", plantstatus))
-    app.add_handler(CommandHandler("upgradeplant", upgradeplant))
-    app.add_handler(CommandHandler("wallet", wallet))
-    app.add_handler(CommandHandler("setwallet", setwallet))
-    app.add_handler(CommandHandler("exchangeton", exchangeton))
-    app.add_handler(CommandHandler("claimton",claimton))
-    app.add_handler(CommandHandler("tonlog", tonlog))
-    app.add_handler(CommandHandler("payuser", payuser))
-    app.add_handler(CommandHandler("cashout", cashout))
-    app.add_handler(CommandHandler("milltofarm", milltofarm))
-    app.add_handler(CommandHandler("backup", backup))
-    app.add_handler(MessageHandler(filters.Document.ALL, restore))
-    app.add_handler(CommandHandler("posttask", posttask))
-    #app.add_handler(CommandHandler("tasks", tasks))
-    app.add_handler(CommandHandler("broadcast", broadcast))
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .request(TimedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if webhook.BOT_MODE == "webhook":
+        # Updates come in through webhook.py, no polling
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", instrument("start", per_user(start, first_arg))))
+    app.add_handler(CommandHandler("buy", instrument("buy", per_user(buy))))
+    app.add_handler(CommandHandler("feed", instrument("feed", per_user(feed))))
+    app.add_handler(CommandHandler("myfarm", instrument("myfarm", per_user(myfarm))))
+    app.add_handler(CommandHandler("breed", instrument("breed", per_user(breed))))
+    app.add_handler(CommandHandler("checkbreed", instrument("checkbreed", per_user(checkbreed))))
+    app.add_handler(CommandHandler("sellpiglet", instrument("sellpiglet", per_user(sellpiglet))))
+    app.add_handler(CommandHandler("market", instrument("market", per_user(market))))
+    app.add_handler(CommandHandler("buymarket", instrument("buymarket", per_user(buymarket))))
+    app.add_handler(CommandHandler("referral", instrument("referral", per_user(referral))))
+    app.add_handler(CommandHandler("tasks", instrument("tasks", per_user(tasks))))
+    app.add_handler(CommandHandler("claim", instrument("claim", per_user(claim))))
+    app.add_handler(CommandHandler("startmill", instrument("startmill", per_user(startmill))))
+    app.add_handler(CommandHandler("makefeed", instrument("makefeed", per_user(makefeed))))
+    app.add_handler(CommandHandler("millstatus", instrument("millstatus", per_user(millstatus))))
+    app.add_handler(CommandHandler("upgrademill", instrument("upgrademill", per_user(upgrademill))))
+    app.add_handler(CommandHandler("rushmill", instrument("rushmill", per_user(rushmill))))
+    app.add_handler(CommandHandler("sellfeed", instrument("sellfeed", per_user(sellfeed))))
+    app.add_handler(CommandHandler("feedmarket", instrument("feedmarket", per_user(feedmarket))))
+    app.add_handler(CommandHandler("buyfeed", instrument("buyfeed", buyfeed)))
+    app.add_handler(CommandHandler("brandstats", instrument("brandstats", per_user(brandstats))))
+    app.add_handler(CommandHandler("topbrands", instrument("topbrands", per_user(topbrands))))
+    app.add_handler(CommandHandler("leaderboard", instrument("leaderboard", per_user(leaderboard))))
+    app.add_handler(CommandHandler("startplant", instrument("startplant", per_user(startplant))))
+    app.add_handler(CommandHandler("processpig", instrument("processpig", per_user(process_pig))))
+    app.add_handler(CommandHandler("plantstatus", instrument("plantstatus", per_user(plantstatus))))
+    app.add_handler(CommandHandler("upgradeplant", instrument("upgradeplant", per_user(upgradeplant))))
+    app.add_handler(CommandHandler("wallet", instrument("wallet", per_user(wallet))))
+    app.add_handler(CommandHandler("setwallet", instrument("setwallet", per_user(setwallet))))
+    app.add_handler(CommandHandler("exchangeton", instrument("exchangeton", per_user(exchangeton))))
+    app.add_handler(CommandHandler("claimton", instrument("claimton", per_user(claimton))))
+    app.add_handler(CommandHandler("tonlog", instrument("tonlog", per_user(tonlog))))
+    app.add_handler(CommandHandler("payuser", instrument("payuser", on_owner_shard(per_user(payuser, first_arg), first_arg))))
+    app.add_handler(CommandHandler("cashout", instrument("cashout", on_owner_shard(per_user(cashout, first_arg), first_arg))))
+    app.add_handler(CommandHandler("milltofarm", instrument("milltofarm", per_user(milltofarm))))
+    app.add_handler(CommandHandler("backup", instrument("backup", per_user(backup))))
+    app.add_handler(MessageHandler(filters.Document.ALL, instrument("restore", per_user(restore))))
+    app.add_handler(CommandHandler("posttask", instrument("posttask", per_user(posttask))))
+    #app.add_handler(CommandHandler("tasks", instrument("tasks", per_user(tasks))))
+    app.add_handler(CommandHandler("broadcast", instrument("broadcast", per_user(broadcast))))
+    app.add_handler(CommandHandler("stopbroadcast", instrument("stopbroadcast", per_user(stopbroadcast))))
+    app.add_handler(CommandHandler("perf", instrument("perf", per_user(perf))))
+    app.add_handler(CallbackQueryHandler(instrument("turn_page", per_user(turn_page)), pattern=r"^\w+:\d+$"))
+    app.add_handler(TypeHandler(Update, per_user(mark_active)), group=-1)
     
     print("🐷 Bot is running...")
-    app.run_polling()
+    if CLUSTER.sharded:
+        # A shard worker: updates and calls come from the router
+        webhook.run(app, rpc=CLUSTER.dispatch)
+    elif webhook.BOT_MODE == "webhook":
+        webhook.run(app)
+    else:
+        app.run_polling()
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from dispatch import USER_LOCKS
+from storage import read_json, run_io, write_file_atomic
+
+# Where a running broadcast keeps its progress so it can resume after a restart
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast.json")
+# Telegram allows about 30 messages a second to different chats; stay under it
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+CHUNK = 200  # players sent between progress saves
+PROGRESS_INTERVAL = 5  # seconds between progress message edits
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    # Hands out `rate` tokens a second with bursts of up to `burst`.
+    # pause() stops everyone, e.g. when Telegram answers with RetryAfter.
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.updated = max(self.updated, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now >= self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                else:
+                    await asyncio.sleep(self.updated - now)
+
+
+class BroadcastJob:
+    # Sends one message to every player who hasn't blocked the bot, walking
+    # them in id order. After each chunk the last id is saved as the cursor,
+    # so a restart picks up there (resending at most one chunk).
+
+    def __init__(self, store, bot, state, path):
+        self.store = store
+        self.bot = bot
+        self.state = state
+        self.path = path
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.limit = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        self.progress_id = None
+        self.last_report = 0.0
+
+    async def save(self):
+        await run_io(write_file_atomic, self.path, json.dumps(self.state))
+
+    async def pending(self):
+        cursor = self.state["cursor"]
+        ids = await self.store.scan_players(
+            lambda uid, player: uid if uid.lstrip("-").isdigit() and uid > cursor and not player.get("blocked") else None
+        )
+        # Sorted on the I/O thread too, it's the whole player list
+        return await run_io(sorted, ids)
+
+    async def run(self):
+        pending = await self.pending()
+        if not self.state["total"]:
+            self.state["total"] = len(pending)
+        await self.save()
+        await self.report(force=True)
+        for start in range(0, len(pending), CHUNK):
+            chunk = pending[start:start + CHUNK]
+            results = Counter(await asyncio.gather(*(self.send(uid) for uid in chunk)))
+            for outcome in ("sent", "blocked", "failed"):
+                self.state[outcome] += results[outcome]
+            self.state["cursor"] = chunk[-1]
+            await self.save()
+            await self.report()
+        self.state["finished"] = True
+        await self.report(force=True)
+        await run_io(os.remove, self.path)
+
+    async def send(self, uid):
+        async with self.limit:
+            for attempt in range(MAX_ATTEMPTS):
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id=int(uid), text=self.state["text"], parse_mode="Markdown")
+                    return "sent"
+                except RetryAfter as e:
+                    self.bucket.pause(e.retry_after)
+                except Forbidden:
+                    await self.mark_blocked(uid)
+                    return "blocked"
+                except BadRequest as e:
+                    # A NetworkError subclass, but retrying won't help
+                    print(f"⚠️ Broadcast to {uid} failed: {e}")
+                    return "failed"
+                except NetworkError:
+                    await asyncio.sleep(2 ** attempt)
+                except TelegramError as e:
+                    print(f"⚠️ Broadcast to {uid} failed: {e}")
+                    return "failed"
+            return "failed"
+
+    async def mark_blocked(self, uid):
+        # Later broadcasts skip them until they talk to the bot again
+        async with USER_LOCKS.hold(uid):
+            player = self.store.get_player(uid)
+            if player is not None:
+                player["blocked"] = True
+                self.store.save_player(uid)
+
+    def progress_text(self):
+        s = self.state
+        done = s["sent"] + s["blocked"] + s["failed"]
+        if s.get("finished"):
+            head = "✅ Broadcast finished!"
+        elif s.get("cancelled"):
+            head = "🛑 Broadcast cancelled."
+        else:
+            head = "📢 Broadcasting..."
+        if s.get("label"):
+            head += f" ({s['label']})"
+        return (
+            f"{head}\n"
+            f"📬 {done}/{s['total']} players\n"
+            f"✅ Sent: {s['sent']}\n"
+            f"🚫 Blocked: {s['blocked']}\n"
+            f"⚠️ Failed: {s['failed']}"
+        )
+
+    async def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        try:
+            if self.progress_id is None:
+                msg = await self.bot.send_message(chat_id=self.state["admin_chat"], text=self.progress_text())
+                self.progress_id = msg.message_id
+            else:
+                await self.bot.edit_message_text(
+                    self.progress_text(), chat_id=self.state["admin_chat"], message_id=self.progress_id
+                )
+        except TelegramError as e:
+            print(f"⚠️ Couldn't update broadcast progress: {e}")
+
+
+class Broadcaster:
+    # At most one broadcast runs at a time, as a background task
+
+    def __init__(self, path=BROADCAST_FILE):
+        self.path = path
+        self.job = None
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def _launch(self, store, bot, state):
+        self.job = BroadcastJob(store, bot, state, self.path)
+        self.task = asyncio.get_running_loop().create_task(self._run(self.job))
+
+    async def _run(self, job):
+        try:
+            await job.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Broadcast stopped, will resume on restart: {e}")
+
+    def start(self, store, bot, admin_chat, text, label=None):
+        # label tells apart the progress messages of several broadcasters,
+        # one per shard
+        state = {
+            "text": text,
+            "admin_chat": admin_chat,
+            "cursor": "",
+            "total": 0,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+        }
+        if label:
+            state["label"] = label
+        self._launch(store, bot, state)
+
+    def resume(self, store, bot):
+        # Pick up a broadcast that was interrupted by a restart
+        state = read_json(self.path, None)
+        if state and not self.running:
+            print("📢 Resuming interrupted broadcast")
+            self._launch(store, bot, state)
+
+    async def stop(self, cancel=False):
+        # Stop the running broadcast; cancel=True also forgets it instead of
+        # leaving it to resume on the next start
+        if not self.running:
+            return False
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        if cancel:
+            self.job.state["cancelled"] = True
+            await self.job.report(force=True)
+            if os.path.exists(self.path):
+                await run_io(os.remove, self.path)
+        return True
+
+
+BROADCASTER = Broadcaster()
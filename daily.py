@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from dispatch import USER_LOCKS
+from storage import epoch_today
+
+TIME_SLICE = 0.02  # seconds of work between yields to the event loop
+
+
+def seconds_to_midnight():
+    # Until the next UTC midnight
+    return 86400 - time.time() % 86400
+
+
+async def reset_streaks(store, today):
+    # Zero the streak of everyone whose pig wasn't fed yesterday or today.
+    # Candidates come from the streak ranking, so only players who still
+    # have a streak are looked at, not every farm. Piglet ages and moods
+    # need no pass of their own, see piglets.py and /myfarm.
+    holders = store.player_ranks["streak"].top(len(store.player_ranks["streak"]), positive=True)
+    reset = 0
+    slice_end = time.perf_counter() + TIME_SLICE
+    for user_id, _ in holders:
+        if USER_LOCKS.busy(user_id):
+            # A command has it; wait our turn rather than change it under them
+            async with USER_LOCKS.hold(user_id):
+                reset += lapse(store, user_id, today)
+        else:
+            reset += lapse(store, user_id, today)
+        if time.perf_counter() >= slice_end:
+            # Let waiting commands run
+            await asyncio.sleep(0)
+            slice_end = time.perf_counter() + TIME_SLICE
+    return reset
+
+
+def lapse(store, user_id, today):
+    player = store.get_player(user_id)
+    if player is None or not player.streak:
+        return 0
+    last_fed = player.pig.last_fed if "pig" in player else None
+    if last_fed is not None and last_fed >= today - 1:
+        return 0
+    player.streak = 0
+    store.save_player(user_id)
+    return 1
+
+
+class DailyRollover:
+    # Runs the day-change maintenance once a day, at midnight UTC
+
+    def __init__(self):
+        self.task = None
+
+    def start(self, store):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run(store))
+
+    async def _run(self, store):
+        while True:
+            await asyncio.sleep(seconds_to_midnight())
+            started = time.perf_counter()
+            try:
+                reset = await reset_streaks(store, epoch_today())
+                print(f"🌅 New day: reset {reset} streaks in {time.perf_counter() - started:.1f}s")
+            except Exception as e:
+                print(f"⚠️ Day rollover failed: {e}")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+DAILY = DailyRollover()
@@ -0,0 +1,65 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from functools import wraps
+
+# How many updates the application may process at once
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+
+class UserLocks:
+    # One asyncio.Lock per user id, created on demand and dropped once nobody
+    # holds or waits for it. Locks are FIFO, so updates from the same user run
+    # in the order they arrived while different users run in parallel.
+
+    def __init__(self):
+        self._locks = {}  # user_id -> [lock, holders + waiters]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def busy(self, key):
+        # True while an update holds or waits for key's lock
+        return key in self._locks
+
+    @asynccontextmanager
+    async def hold(self, *user_ids):
+        # Always lock in sorted order so two multi-user updates can't deadlock
+        keys = sorted(set(user_ids))
+        entries = []
+        for key in keys:
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append((key, entry))
+        acquired = []
+        try:
+            for _, entry in entries:
+                await entry[0].acquire()
+                acquired.append(entry[0])
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+USER_LOCKS = UserLocks()
+
+
+def per_user(callback, extra_keys=None):
+    # Run callback while holding the sender's lock, plus the locks of any
+    # other players extra_keys(update, context) says the command will touch
+    @wraps(callback)
+    async def wrapper(update, context):
+        keys = set()
+        if update.effective_user:
+            keys.add(str(update.effective_user.id))
+        if extra_keys:
+            keys.update(str(k) for k in extra_keys(update, context) if k)
+        async with USER_LOCKS.hold(*keys):
+            return await callback(update, context)
+
+    return wrapper
@@ -0,0 +1,60 @@
+from datetime import date, datetime
+
+# A pig's feeding history is two ints instead of a list of dates:
+#   last_fed   epoch day (days since 1970-01-01, UTC) of the latest meal
+#   fed_bits   bit i set = fed on day last_fed - i, for the last FED_WINDOW days
+# so recording a meal or checking a streak of days is constant time and the
+# record stops growing with the pig's age.
+
+EPOCH = date(1970, 1, 1)
+FED_WINDOW = 32
+FED_MASK = (1 << FED_WINDOW) - 1
+
+
+def epoch_day(day):
+    return (day - EPOCH).days
+
+
+def migrate_pig(pig):
+    # Convert the old fed_dates list; returns True if the pig was changed
+    if "fed_dates" not in pig:
+        return False
+    days = set()
+    for text in pig.pop("fed_dates") or []:
+        try:
+            days.add(epoch_day(datetime.strptime(text, "%Y-%m-%d").date()))
+        except (TypeError, ValueError):
+            pass
+    pig["last_fed"] = max(days) if days else None
+    pig["fed_bits"] = 0
+    for day in days:
+        age = pig["last_fed"] - day
+        if age < FED_WINDOW:
+            pig["fed_bits"] |= 1 << age
+    return True
+
+
+# The rest take a Pig (see records.py)
+def mark_fed(pig, day):
+    last = pig.last_fed
+    if last is None or day - last >= FED_WINDOW:
+        pig.fed_bits = 1
+        pig.last_fed = day
+    elif day > last:
+        pig.fed_bits = (pig.fed_bits << (day - last) | 1) & FED_MASK
+        pig.last_fed = day
+    elif last - day < FED_WINDOW:
+        pig.fed_bits |= 1 << (last - day)
+
+
+def fed_on(pig, day):
+    last = pig.last_fed
+    if last is None or not 0 <= last - day < FED_WINDOW:
+        return False
+    return bool(pig.fed_bits >> (last - day) & 1)
+
+
+def fed_every_day(pig, today, days):
+    # Fed on each of the `days` days ending today
+    want = (1 << days) - 1
+    return pig.last_fed == today and pig.fed_bits & want == want
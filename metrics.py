@@ -0,0 +1,173 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from telegram.request import HTTPXRequest
+
+# Prometheus text dump, rewritten every METRICS_INTERVAL seconds ("" turns it off)
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.prom")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "60"))
+
+# Histogram bucket upper bounds in seconds, plus +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# family -> (metric name, label, help)
+FAMILIES = {
+    "handler": ("pigfarm_handler_seconds", "command", "Time spent handling an update, lock wait included"),
+    "storage": ("pigfarm_storage_seconds", "op", "Time spent loading and saving game state"),
+    "bot_api": ("pigfarm_bot_api_seconds", "method", "Latency of outgoing Bot API calls"),
+}
+
+
+class Histogram:
+    # Counts per fixed bucket, so observe() is a bisect and two additions
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket the q-th observation falls in
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    # Everything is recorded on the event loop thread, so no locking
+
+    def __init__(self):
+        self.latency = {}  # (family, label) -> Histogram
+        self.errors = Counter()  # (family, label) -> failed calls
+        self.started = time.time()
+        self._writer = None
+
+    def observe(self, family, label, seconds, error=False):
+        hist = self.latency.get((family, label))
+        if hist is None:
+            hist = self.latency[family, label] = Histogram()
+        hist.observe(seconds)
+        if error:
+            self.errors[family, label] += 1
+
+    @contextmanager
+    def timed(self, family, label):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(family, label, time.perf_counter() - start, error)
+
+    def rows(self, family):
+        # [(label, histogram, errors)], slowest p99 first
+        rows = [
+            (label, hist, self.errors[fam, label])
+            for (fam, label), hist in self.latency.items() if fam == family
+        ]
+        return sorted(rows, key=lambda r: (r[1].quantile(0.99), r[1].sum), reverse=True)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [
+            "# HELP pigfarm_uptime_seconds Seconds since the bot started",
+            "# TYPE pigfarm_uptime_seconds gauge",
+            f"pigfarm_uptime_seconds {time.time() - self.started:.0f}",
+        ]
+        for family, (name, label_name, help_text) in FAMILIES.items():
+            rows = sorted(self.rows(family), key=lambda r: r[0])
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for label, hist, _ in rows:
+                label_text = f'{label_name}="{label}"'
+                seen = 0
+                for bound, n in zip(BUCKETS, hist.counts):
+                    seen += n
+                    lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {seen}')
+                lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {hist.count}')
+                lines.append(f"{name}_sum{{{label_text}}} {hist.sum:.6f}")
+                lines.append(f"{name}_count{{{label_text}}} {hist.count}")
+            errors = name.replace("_seconds", "_errors_total")
+            lines += [f"# HELP {errors} Calls that failed", f"# TYPE {errors} counter"]
+            for label, _, n in rows:
+                lines.append(f'{errors}{{{label_name}="{label}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, text):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    async def _write_loop(self, path, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Default executor, so the storage I/O thread isn't held up
+                await loop.run_in_executor(None, self.dump, path, self.render())
+            except OSError as e:
+                print(f"⚠️ Couldn't write metrics: {e}")
+
+    def start(self, path=METRICS_FILE, interval=METRICS_INTERVAL):
+        if path and self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop(path, interval))
+
+    async def stop(self, path=METRICS_FILE):
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        if path:
+            self.dump(path, self.render())
+
+
+METRICS = Metrics()
+
+
+def instrument(name, callback):
+    # Record latency and uncaught errors of a handler under `name`
+    @wraps(callback)
+    async def wrapper(update, context):
+        with METRICS.timed("handler", name):
+            return await callback(update, context)
+
+    return wrapper
+
+
+class TimedRequest(HTTPXRequest):
+    # The bot's HTTP client, timing every Bot API call by method name.
+    # Telegram errors come back as status codes and are raised later by the
+    # bot, so anything >= 400 counts as a failed call here.
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        error = True
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            error = code >= 400
+            return code, payload
+        finally:
+            METRICS.observe("bot_api", api_method, time.perf_counter() - start, error)
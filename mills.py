@@ -0,0 +1,167 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+from telegram.error import TelegramError
+
+from broadcaster import BROADCAST_RATE, TokenBucket
+
+# A mill keeps producing on its own, one batch per cooldown, until this
+# many batches are waiting; then it idles until the owner runs /makefeed.
+MILL_CAP_BATCHES = int(os.getenv("MILL_CAP_BATCHES", "4"))
+# Message owners when their mill fills up
+MILL_NOTIFY = os.getenv("MILL_NOTIFY", "1") == "1"
+WHEEL_TICK = 60  # seconds per timing wheel slot
+WHEEL_SLOTS = 1440  # slots per turn of the wheel, so one turn is a day
+
+
+def last_production(mill):
+    try:
+        return datetime.fromisoformat(mill["last_production"])
+    except (KeyError, TypeError, ValueError):
+        return datetime(1970, 1, 1)
+
+
+def ready_batches(mill, cooldown, now):
+    # Batches finished since last_production, worked out when asked rather
+    # than produced by a timer
+    elapsed = (now - last_production(mill)).total_seconds()
+    return min(MILL_CAP_BATCHES, max(0, int(elapsed // (cooldown * 3600))))
+
+
+def next_batch_at(mill, cooldown, now):
+    return last_production(mill) + timedelta(hours=cooldown * (ready_batches(mill, cooldown, now) + 1))
+
+
+def full_at(mill, cooldown):
+    return last_production(mill) + timedelta(hours=cooldown * MILL_CAP_BATCHES)
+
+
+def collect(mill, cooldown, now):
+    # Take the finished batches; returns how many. Time towards the next
+    # batch carries over, unless the mill was full and sitting idle.
+    batches = ready_batches(mill, cooldown, now)
+    if batches == MILL_CAP_BATCHES:
+        mill["last_production"] = now.isoformat()
+    elif batches:
+        mill["last_production"] = (last_production(mill) + timedelta(hours=cooldown * batches)).isoformat()
+    return batches
+
+
+class TimingWheel:
+    # Hashed timing wheel: WHEEL_SLOTS buckets of WHEEL_TICK seconds each,
+    # visited in turn. Keys due more than a turn away wait in their bucket
+    # for the remaining turns. Scheduling is O(1) and each tick only looks
+    # at one bucket, however many keys are waiting.
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.origin = time.time() if now is None else now
+        self.ticks = 0
+        self.buckets = [{} for _ in range(slots)]  # key -> turns left
+        self.where = {}  # key -> bucket index
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, when):
+        # (Re)schedule key for epoch time `when`; overdue keys fire next tick
+        self.cancel(key)
+        due = max(self.ticks + 1, -int((self.origin - when) // self.tick))
+        index = due % self.slots
+        self.buckets[index][key] = (due - self.ticks - 1) // self.slots
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.buckets[index][key]
+
+    def advance(self, now):
+        # Keys that came due up to `now`
+        fired = []
+        target = int((now - self.origin) // self.tick)
+        while self.ticks < target:
+            self.ticks += 1
+            bucket = self.buckets[self.ticks % self.slots]
+            for key, turns in list(bucket.items()):
+                if turns:
+                    bucket[key] = turns - 1
+                else:
+                    del bucket[key]
+                    del self.where[key]
+                    fired.append(key)
+        return fired
+
+
+class MillAlerts:
+    # Tells owners when their mill is full. Every mill sits in one timing
+    # wheel under the time it fills up; handlers that change a mill
+    # reschedule it, and a mill is checked again when it fires, so stale
+    # entries do no harm.
+
+    def __init__(self):
+        self.wheel = TimingWheel()
+        self.task = None
+
+    def schedule(self, user_id, mill, cooldown):
+        if MILL_NOTIFY and mill is not None:
+            self.wheel.schedule(user_id, full_at(mill, cooldown).timestamp())
+
+    def start(self, store, bot, levels):
+        if not MILL_NOTIFY or self.task is not None:
+            return
+        self.task = asyncio.get_running_loop().create_task(self._run(store, bot, levels))
+
+    async def _load(self, store, levels):
+        # Put every mill on the wheel. The scan doesn't hold up handlers;
+        # mills they schedule meanwhile just get a second, harmless entry.
+        now = datetime.now()
+
+        def due(user_id, mill):
+            cooldown = levels[mill["level"]]["cooldown"]
+            # Already full ones were told before the restart, or will be
+            # once they collect and fill up again
+            if ready_batches(mill, cooldown, now) < MILL_CAP_BATCHES:
+                return user_id, full_at(mill, cooldown).timestamp()
+            return None
+
+        for user_id, when in await store.scan_mills(due):
+            self.wheel.schedule(user_id, when)
+
+    async def _run(self, store, bot, levels):
+        await self._load(store, levels)
+        bucket = TokenBucket(BROADCAST_RATE)
+        while True:
+            await asyncio.sleep(WHEEL_TICK)
+            for user_id in self.wheel.advance(time.time()):
+                mill = store.get_mill(user_id)
+                if mill is None:
+                    continue
+                level = levels[mill["level"]]
+                if ready_batches(mill, level["cooldown"], datetime.now()) < MILL_CAP_BATCHES:
+                    self.schedule(user_id, mill, level["cooldown"])
+                    continue
+                await bucket.acquire()
+                try:
+                    await bot.send_message(
+                        chat_id=int(user_id),
+                        text=f"🏭 Your feed mill is full! Use /makefeed to collect "
+                             f"{MILL_CAP_BATCHES * level['amount']} units of {level['type']} feed."
+                    )
+                except TelegramError as e:
+                    print(f"⚠️ Couldn't send mill alert to {user_id}: {e}")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+MILL_ALERTS = MillAlerts()
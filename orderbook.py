@@ -0,0 +1,124 @@
+import os
+import time
+from datetime import datetime
+
+from sortedcontainers import SortedList
+
+# Listings nobody buys within this many days are taken off the market and
+# their feed goes back to the seller's mill
+LISTING_DAYS = float(os.getenv("LISTING_DAYS", "7"))
+
+
+def listed_at(listing):
+    # Epoch seconds a listing went up; listings from before the order book
+    # only have an ISO timestamp
+    when = listing.get("listed_at")
+    if when is None:
+        try:
+            when = datetime.fromisoformat(listing["timestamp"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            when = time.time()
+        listing["listed_at"] = int(when)
+    return listing["listed_at"]
+
+
+def index_listings(market, next_id=1):
+    # {str(id): listing} from a list of listings, numbering any that were
+    # stored before listings had ids
+    listings = {}
+    next_id = max([next_id] + [l["id"] + 1 for l in market if "id" in l])
+    for listing in market:
+        if "id" not in listing:
+            listing["id"] = next_id
+            next_id += 1
+        listings[str(listing["id"])] = listing
+    return listings
+
+
+class OrderBook:
+    # Open feed listings, indexed by (price, id) so the cheapest and, among
+    # equal prices, the oldest offer comes first. Ids only ever grow, so id
+    # order is listing order. A second index by (listed_at, id) finds the
+    # expired ones. `listings` is shared with the backend, like the store's
+    # player dict.
+
+    def __init__(self, listings):
+        self.listings = listings
+        self._by_price = SortedList((l["price"], l["id"]) for l in listings.values())
+        self._by_age = SortedList((listed_at(l), l["id"]) for l in listings.values())
+        self.next_id = max((l["id"] for l in listings.values()), default=0) + 1
+
+    def __len__(self):
+        return len(self.listings)
+
+    def get(self, listing_id):
+        return self.listings.get(str(listing_id))
+
+    def add(self, listing):
+        listing["id"] = self.next_id
+        listing.setdefault("listed_at", int(time.time()))
+        self.next_id += 1
+        self.listings[str(listing["id"])] = listing
+        self._by_price.add((listing["price"], listing["id"]))
+        self._by_age.add((listing["listed_at"], listing["id"]))
+        return listing["id"]
+
+    def remove(self, listing_id):
+        listing = self.listings.pop(str(listing_id), None)
+        if listing is not None:
+            self._by_price.discard((listing["price"], listing["id"]))
+            self._by_age.discard((listing["listed_at"], listing["id"]))
+        return listing
+
+    def fill(self, listing_id, amount):
+        # Take amount feed off a listing, closing it once it's sold out
+        listing = self.get(listing_id)
+        listing["amount"] -= amount
+        listing["sales"] += amount
+        if listing["amount"] <= 0:
+            self.remove(listing_id)
+
+    def unfill(self, listing, amount):
+        # Put back amount feed fill() took, reopening the listing if it had
+        # sold out
+        listing["amount"] += amount
+        listing["sales"] -= amount
+        if self.get(listing["id"]) is None:
+            self.listings[str(listing["id"])] = listing
+            self._by_price.add((listing["price"], listing["id"]))
+            self._by_age.add((listing["listed_at"], listing["id"]))
+
+    def cutoff(self):
+        return time.time() - LISTING_DAYS * 86400
+
+    def offers(self):
+        # Open listings, cheapest first, expired ones included
+        for _, listing_id in self._by_price:
+            yield self.listings[str(listing_id)]
+
+    def page(self, start, count):
+        # The start-th to (start + count)-th cheapest listings, straight from
+        # the index
+        return [self.listings[str(i)] for _, i in self._by_price.islice(start, start + count)]
+
+    def match(self, amount, buyer, max_price=None, sellers=None):
+        # [(listing, amount)] filling amount from the cheapest live offers,
+        # skipping the buyer's own and, if given, sellers outside `sellers`.
+        # Nothing is changed; see fill().
+        cutoff = self.cutoff()
+        plan = []
+        for listing in self.offers():
+            if amount <= 0 or (max_price is not None and listing["price"] > max_price):
+                break
+            seller = listing["seller_id"]
+            if seller == buyer or listed_at(listing) < cutoff or (sellers is not None and seller not in sellers):
+                continue
+            take = min(amount, listing["amount"])
+            plan.append((listing, take))
+            amount -= take
+        return plan
+
+    def expired(self):
+        # Oldest first, straight from the index
+        stale = self._by_age.islice(stop=self._by_age.bisect_left((self.cutoff(),)))
+        return [self.listings[str(i)] for _, i in stale]
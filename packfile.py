@@ -0,0 +1,195 @@
+import hashlib
+import itertools
+import json
+import mmap
+import struct
+import sys
+import zlib
+
+from records import record_json
+
+# Compact snapshot of players.json.
+#
+#   header   magic, record count, index slots, index offset, dictionary size
+#   zdict    zlib preset dictionary sampled from the records
+#   records  per player: user id length, user id, zlib'd compact-JSON record
+#   index    open-addressing hash table: (key, offset, length) per slot
+#
+# A reader memory-maps the file and decodes only the record it looks up, so
+# reading one farm costs the same however many farms the file holds. Farms
+# repeat the same keys and dates, so compressing each record against a
+# shared dictionary makes them a fraction of their indent=2 JSON size.
+
+MAGIC = b"PIGPAK1\0"
+HEADER = struct.Struct("<8sIIQI")
+SLOT = struct.Struct("<QQI")
+ID_LEN = struct.Struct("<H")
+EMPTY = 0
+ZDICT_SAMPLE = 64
+ZDICT_MAX = 32 * 1024
+
+
+def key_for(user_id):
+    # Telegram ids are used as-is; anything else gets a stable 63-bit hash
+    # with the top bit set so it can't collide with a real id
+    if user_id.isdigit() and 0 < int(user_id) < 1 << 63:
+        return int(user_id)
+    digest = hashlib.blake2b(user_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") | 1 << 63
+
+
+def slot_for(key, slots):
+    return (key * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> 32 & (slots - 1)
+
+
+def compact_json(rec):
+    return json.dumps(rec, separators=(",", ":"), default=record_json).encode()
+
+
+def build_zdict(records):
+    # zlib favours matches near the end of the dictionary, so the most
+    # common record shapes go last
+    return b"".join(compact_json(rec) for rec in records)[-ZDICT_MAX:]
+
+
+def encode_entry(user_id, rec, zdict):
+    uid = user_id.encode()
+    z = zlib.compressobj(9, zdict=zdict) if zdict else zlib.compressobj(9)
+    return ID_LEN.pack(len(uid)) + uid + z.compress(compact_json(rec)) + z.flush()
+
+
+def decode_id(raw):
+    (n,) = ID_LEN.unpack_from(raw, 0)
+    return bytes(raw[ID_LEN.size:ID_LEN.size + n]).decode(), ID_LEN.size + n
+
+
+def decode_entry(raw, zdict):
+    user_id, start = decode_id(raw)
+    z = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return user_id, json.loads(z.decompress(raw[start:]))
+
+
+def write_pack(f, items, zdict=None):
+    # items yields (user_id, record) or (user_id, entry bytes already encoded
+    # against zdict); without a zdict one is sampled from the first records
+    items = iter(items)
+    if zdict is None:
+        head = list(itertools.islice(items, ZDICT_SAMPLE))
+        zdict = build_zdict(rec for _, rec in head if not isinstance(rec, bytes))
+        items = itertools.chain(head, items)
+    f.write(HEADER.pack(MAGIC, 0, 0, 0, len(zdict)))
+    f.write(zdict)
+    offset = HEADER.size + len(zdict)
+    entries = []
+    for user_id, rec in items:
+        blob = rec if isinstance(rec, bytes) else encode_entry(user_id, rec, zdict)
+        f.write(blob)
+        entries.append((key_for(user_id), offset, len(blob)))
+        offset += len(blob)
+
+    slots = 1
+    while slots < 2 * len(entries):
+        slots <<= 1
+    table = [None] * slots
+    for entry in entries:
+        i = slot_for(entry[0], slots)
+        while table[i] is not None:
+            i = (i + 1) & (slots - 1)
+        table[i] = entry
+    index = bytearray(SLOT.size * slots)
+    for i, entry in enumerate(table):
+        if entry is not None:
+            SLOT.pack_into(index, i * SLOT.size, *entry)
+    f.write(index)
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, len(entries), slots, offset, len(zdict)))
+
+
+class PackReader:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.slots, self.index_offset, zdict_len = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a player pack file")
+        self.zdict = self._map[HEADER.size:HEADER.size + zdict_len]
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, user_id):
+        if not self.slots:
+            return None
+        key = key_for(user_id)
+        i = slot_for(key, self.slots)
+        while True:
+            slot_key, offset, length = SLOT.unpack_from(self._map, self.index_offset + i * SLOT.size)
+            if slot_key == EMPTY:
+                return None
+            if slot_key == key:
+                return offset, length
+            i = (i + 1) & (self.slots - 1)
+
+    def __contains__(self, user_id):
+        return self._find(user_id) is not None
+
+    def get_raw(self, user_id):
+        found = self._find(user_id)
+        return self._map[found[0]:found[0] + found[1]] if found else None
+
+    def get(self, user_id):
+        raw = self.get_raw(user_id)
+        if raw is None:
+            return None
+        stored_id, rec = decode_entry(raw, self.zdict)
+        return rec if stored_id == user_id else None
+
+    def raw_items(self):
+        # (user_id, encoded entry) in file order, without decoding records
+        offsets = []
+        for i in range(self.slots):
+            slot_key, offset, length = SLOT.unpack_from(self._map, self.index_offset + i * SLOT.size)
+            if slot_key != EMPTY:
+                offsets.append((offset, length))
+        for offset, length in sorted(offsets):
+            raw = self._map[offset:offset + length]
+            yield decode_id(raw)[0], raw
+
+    def items(self):
+        for _, raw in self.raw_items():
+            yield decode_entry(raw, self.zdict)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def json_to_pack(json_path, pack_path):
+    with open(json_path, "r") as f:
+        players = json.load(f)
+    with open(pack_path, "wb") as f:
+        write_pack(f, players.items())
+    return len(players)
+
+
+def pack_to_json(pack_path, json_path):
+    reader = PackReader(pack_path)
+    try:
+        players = dict(reader.items())
+    finally:
+        reader.close()
+    with open(json_path, "w") as f:
+        json.dump(players, f, indent=2)
+    return len(players)
+
+
+if __name__ == "__main__":
+    # python packfile.py topack players.json players.pak
+    # python packfile.py tojson players.pak players.json
+    if len(sys.argv) != 4 or sys.argv[1] not in ("topack", "tojson"):
+        print("Usage: python packfile.py topack|tojson <source> <destination>")
+        sys.exit(1)
+    convert = json_to_pack if sys.argv[1] == "topack" else pack_to_json
+    count = convert(sys.argv[2], sys.argv[3])
+    print(f"✅ Converted {count} players into {sys.argv[3]}")
@@ -0,0 +1,79 @@
+import time
+
+# Piglets are counted rather than listed: player["piglets"] maps
+# type -> {age in days (as a string, it's JSON): how many}, e.g.
+#   {"golden": {"0": 1}, "normal": {"0": 12, "3": 2}}
+# so breeding, buying and selling in bulk don't grow the farm record.
+#
+# Ages are as of player["piglets_day"] (an epoch day, UTC). Nothing walks
+# the farms at midnight to age piglets: the first read on a later day adds
+# the days that passed to every age of that farm in one go.
+
+PIGLET_TYPES = ("golden", "spotted", "normal")
+PIGLET_PRICES = {"golden": 5, "spotted": 3, "normal": 1}
+
+
+def today():
+    return int(time.time() // 86400)
+
+
+def migrate_piglets(player):
+    # Convert the old list of dicts; returns True if the farm was changed
+    piglets = player.get("piglets")
+    if piglets is not None and not isinstance(piglets, list) and "piglets_day" in player:
+        return False
+    if piglets is None or isinstance(piglets, list):
+        counts = {}
+        for piglet in piglets or []:
+            ages = counts.setdefault(piglet.get("type", "normal"), {})
+            age = str(piglet.get("age", 0))
+            ages[age] = ages.get(age, 0) + 1
+        player["piglets"] = counts
+    player["piglets_day"] = today()
+    return True
+
+
+def inventory(player):
+    # The player's piglet counts with ages as of today, a Piglets record
+    # (see records.py) that reads and writes like the dict above
+    day = today()
+    passed = day - player.piglets_day
+    if passed > 0:
+        player["piglets"] = {
+            t: {str(int(age) + passed): n for age, n in ages.items()} for t, ages in player.piglets.items()
+        }
+        player.piglets_day = day
+    return player.piglets
+
+
+def add_piglets(player, pig_type, count=1, age=0):
+    ages = inventory(player).setdefault(pig_type, {})
+    ages[str(age)] = ages.get(str(age), 0) + count
+
+
+def remove_piglets(player, pig_type, age, count=1):
+    # Takes up to count piglets of one type and age; returns how many it took
+    piglets = inventory(player)
+    ages = piglets.get(pig_type, {})
+    have = ages.get(str(age), 0)
+    taken = min(have, count)
+    if taken == have:
+        ages.pop(str(age), None)
+        if not ages:
+            piglets.pop(pig_type, None)
+    else:
+        ages[str(age)] = have - taken
+    return taken
+
+
+def piglet_groups(player):
+    # [(type, age, count)] in a stable order: by type as in PIGLET_TYPES,
+    # then youngest first. This is the numbering /sellpiglet shows.
+    piglets = inventory(player)
+    order = {t: i for i, t in enumerate(PIGLET_TYPES)}
+    groups = [(t, int(age), n) for t, ages in piglets.items() for age, n in ages.items() if n > 0]
+    return sorted(groups, key=lambda g: (order.get(g[0], len(order)), g[0], g[1]))
+
+
+def count_piglets(player):
+    return sum(n for ages in inventory(player).values() for n in ages.values())
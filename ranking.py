@@ -0,0 +1,58 @@
+from itertools import islice
+
+from sortedcontainers import SortedList
+
+
+class Ranking:
+    # Scores for one field, kept ordered highest first (ties by id) so top-N
+    # and "what's my rank" are O(log n) instead of sorting everyone
+
+    def __init__(self, scores=()):
+        self._scores = {}
+        entries = []
+        for key, score in scores:
+            score = score or 0
+            self._scores[key] = score
+            entries.append((-score, key))
+        self._sorted = SortedList(entries)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def update(self, key, score):
+        score = score or 0
+        old = self._scores.get(key)
+        if old == score:
+            return
+        if old is not None:
+            self._sorted.remove((-old, key))
+        self._scores[key] = score
+        self._sorted.add((-score, key))
+
+    def discard(self, key):
+        old = self._scores.pop(key, None)
+        if old is not None:
+            self._sorted.remove((-old, key))
+
+    def score(self, key):
+        return self._scores.get(key)
+
+    def rank(self, key):
+        # 1-based position, or None if key isn't ranked
+        score = self._scores.get(key)
+        if score is None:
+            return None
+        return self._sorted.index((-score, key)) + 1
+
+    def above(self, score):
+        # How many keys have a higher score
+        return self._sorted.bisect_left((-(score or 0),))
+
+    def top(self, n, positive=False):
+        # [(key, score)] for the n highest scores
+        result = []
+        for neg, key in islice(self._sorted, n):
+            if positive and -neg <= 0:
+                break
+            result.append((key, -neg))
+        return result
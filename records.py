@@ -0,0 +1,178 @@
+# Farms, pigs, piglet inventories, mills and market listings are held as
+# objects with __slots__ instead of dicts: with the whole players.json
+# resident, a dict per farm and per pig costs several times the memory of a
+# fixed row of slots. Hot paths read fields as attributes (player.coins,
+# pig.last_fed).
+#
+# A record still reads and writes like the dict it was loaded from
+# (player["coins"], "pig" in player, .get()), so code that deals in
+# JSON-shaped data keeps working. An optional field that isn't set ("pig"
+# on a farm without one) is an empty slot. Keys a record doesn't know are
+# kept in `extra` and written back, so nothing in the files is lost.
+# json.dumps(..., default=record_json) writes records as the same JSON
+# objects they were read from.
+
+from piglets import PIGLET_TYPES
+
+
+class Record:
+    __slots__ = ("extra",)
+    FIELDS = ()
+    NESTED = {}  # field -> Record class its JSON object is read as
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls._fields = frozenset(cls.FIELDS)
+
+    def __init__(self, **fields):
+        self.extra = None
+        for name, value in fields.items():
+            self[name] = value
+
+    @classmethod
+    def from_json(cls, data):
+        if isinstance(data, cls):
+            return data
+        rec = cls.__new__(cls)
+        rec.extra = None
+        for name, value in data.items():
+            rec[name] = value
+        return rec
+
+    def to_json(self):
+        # A dict of the set fields; nested records are left to record_json
+        data = {}
+        for name in self.FIELDS:
+            try:
+                data[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __getitem__(self, name):
+        if name in self._fields:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name) from None
+        if self.extra is None:
+            raise KeyError(name)
+        return self.extra[name]
+
+    def __setitem__(self, name, value):
+        nested = self.NESTED.get(name)
+        if nested is not None and isinstance(value, dict):
+            value = nested.from_json(value)
+        if name in self._fields:
+            setattr(self, name, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __delitem__(self, name):
+        if name in self._fields:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                raise KeyError(name) from None
+        elif self.extra is not None and name in self.extra:
+            del self.extra[name]
+        else:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        if name in self._fields:
+            return hasattr(self, name)
+        return self.extra is not None and name in self.extra
+
+    def __iter__(self):
+        return iter(self.to_json())
+
+    def __len__(self):
+        return len(self.to_json())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_json() == (other.to_json() if isinstance(other, Record) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_json()!r})"
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def pop(self, name, *default):
+        try:
+            value = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[name]
+        return value
+
+    def keys(self):
+        return self.to_json().keys()
+
+    def values(self):
+        return self.to_json().values()
+
+    def items(self):
+        return self.to_json().items()
+
+    def update(self, other):
+        for name, value in other.items():
+            self[name] = value
+
+
+class Pig(Record):
+    __slots__ = FIELDS = ("birth_date", "last_fed", "fed_bits", "pregnant", "pregnant_date", "breed_spent")
+
+
+class Piglets(Record):
+    # type -> {age: how many}, see piglets.py
+    __slots__ = FIELDS = PIGLET_TYPES
+
+
+class Player(Record):
+    __slots__ = FIELDS = (
+        "username", "coins", "streak", "feed", "referrals", "ton_balance", "ton_wallet",
+        "pig", "piglets", "piglets_day", "plant", "claimed_tasks", "ton_log", "last_processed",
+        "last_seen", "blocked", "schema",
+    )
+    NESTED = {"pig": Pig, "piglets": Piglets}
+
+
+class Mill(Record):
+    __slots__ = FIELDS = (
+        "mill_id", "level", "last_production", "stock", "brand", "emoji", "slogan",
+        "royalty_points", "sales", "schema",
+    )
+
+
+class Listing(Record):
+    __slots__ = FIELDS = (
+        "id", "seller_id", "amount", "price", "type", "timestamp", "listed_at",
+        "brand", "emoji", "slogan", "sales", "schema",
+    )
+
+
+def record_json(obj):
+    # default= for json.dumps()
+    if isinstance(obj, Record):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
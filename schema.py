@@ -0,0 +1,350 @@
+import copy
+import json
+import re
+from datetime import date, timedelta
+
+from feeding import migrate_pig
+from orderbook import listed_at
+from piglets import migrate_piglets
+
+# Checks an uploaded players.json or feed_data.json before /restore swaps it
+# in. The file is read a piece at a time and each farm, mill and listing is
+# decoded and checked on its own, so a big upload never sits in memory next
+# to the live data.
+READ_SIZE = 64 * 1024
+BLANK = re.compile(r"[ \t\r\n]*")
+USER_ID = re.compile(r"-?\d+\Z")
+
+
+class SchemaError(ValueError):
+    pass
+
+
+class JsonStream:
+    # Walks a JSON document from a text file without loading it whole
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _more(self, size=READ_SIZE):
+        if self.pos >= READ_SIZE:
+            # Drop what has been read
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(size)
+        self.eof = not chunk
+        self.buf += chunk
+        return bool(chunk)
+
+    def peek(self):
+        # The next non-blank character, left unread; "" at the end
+        while True:
+            self.pos = BLANK.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ""
+
+    def take(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise SchemaError(f"expected {' or '.join(repr(c) for c in chars)}, found {char or 'the end'!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        # Decode the next value whole
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof or not self._more(max(READ_SIZE, len(self.buf) - self.pos)):
+                    raise SchemaError(f"not valid JSON: {e.msg}")
+                continue
+            # A number at the end of what we have may go on in the next piece
+            if end < len(self.buf) or not self._more():
+                self.pos = end
+                return value
+
+    def members(self):
+        # Walk an object: yields each key with the stream at its value, which
+        # the caller reads (with value(), or members()/items() to go deeper)
+        self.take("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise SchemaError("object keys must be strings")
+            self.take(":")
+            yield key
+            if self.take(",}") == "}":
+                return
+
+    def items(self):
+        # Walk an array the same way, yielding indexes
+        self.take("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.take(",]") == "]":
+                return
+
+    def end(self):
+        if self.peek():
+            raise SchemaError("extra data after the JSON document")
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_text(value):
+    return value is None or isinstance(value, str)
+
+
+# field: (test, what it should be); fields may be missing
+PLAYER_FIELDS = {
+    "username": (is_text, "text"),
+    "coins": (is_number, "a number"),
+    "streak": (is_int, "a whole number"),
+    "ton_balance": (is_number, "a number"),
+    "feed": (is_number, "a number"),
+    "referrals": (is_int, "a whole number"),
+    "last_seen": (is_int, "a whole number"),
+    "pig": (lambda v: isinstance(v, dict), "an object"),
+    "piglets": (lambda v: isinstance(v, (dict, list)), "an object"),
+    "claimed_tasks": (lambda v: isinstance(v, list), "a list"),
+    "ton_log": (lambda v: isinstance(v, list), "a list"),
+}
+MILL_FIELDS = {
+    "mill_id": (lambda v: isinstance(v, str), "text"),
+    "level": (is_int, "a whole number"),
+    "last_production": (is_text, "a timestamp"),
+    "stock": (lambda v: isinstance(v, list) and all(
+        isinstance(b, dict) and is_number(b.get("amount")) for b in v), "a list of batches"),
+    "royalty_points": (is_number, "a number"),
+    "sales": (is_number, "a number"),
+}
+LISTING_FIELDS = {
+    "id": (is_int, "a whole number"),
+    "seller_id": (lambda v: isinstance(v, str), "text"),
+    "amount": (is_number, "a number"),
+    "price": (is_number, "a number"),
+    "listed_at": (is_number, "a number"),
+}
+LISTING_REQUIRED = ("seller_id", "amount", "price")
+
+
+def check_record(rec, where, fields, required=()):
+    if not isinstance(rec, dict):
+        raise SchemaError(f"{where} is not an object")
+    for name in required:
+        if name not in rec:
+            raise SchemaError(f"{where} has no {name}")
+    for name, (test, kind) in fields.items():
+        if name in rec and not test(rec[name]):
+            raise SchemaError(f"{where}: {name} should be {kind}")
+
+
+def check_user_id(user_id, where):
+    if not USER_ID.match(user_id):
+        raise SchemaError(f"{where}: {user_id!r} is not a user id")
+
+
+def check_players(stream):
+    farms = 0
+    for user_id in stream.members():
+        check_user_id(user_id, "farm")
+        check_record(stream.value(), f"farm {user_id}", PLAYER_FIELDS)
+        farms += 1
+    return {"farms": farms}
+
+
+def check_feed(stream, mill_levels=None):
+    counts = {"mills": 0, "listings": 0, "plants": 0}
+    seen = set()
+    for key in stream.members():
+        if key == "mills":
+            for user_id in stream.members():
+                check_user_id(user_id, "mill")
+                mill = stream.value()
+                check_record(mill, f"mill {user_id}", MILL_FIELDS)
+                if mill_levels is not None and not 0 <= mill.get("level", 0) < mill_levels:
+                    raise SchemaError(f"mill {user_id}: no level {mill['level']}")
+                counts["mills"] += 1
+        elif key == "market":
+            for index in stream.items():
+                listing = stream.value()
+                check_record(listing, f"listing {index + 1}", LISTING_FIELDS, LISTING_REQUIRED)
+                if "id" in listing and listing["id"] in seen:
+                    raise SchemaError(f"listing {index + 1}: id {listing['id']} is used twice")
+                seen.add(listing.get("id"))
+                counts["listings"] += 1
+        else:
+            check_record(stream.value(), f"plant {key}", {})
+            counts["plants"] += 1
+    return counts
+
+
+def read_players(path):
+    # (user_id, farm) from a players.json, decoded one farm at a time
+    with open(path, "r", encoding="utf-8") as f:
+        stream = JsonStream(f)
+        for user_id in stream.members():
+            yield user_id, stream.value()
+
+
+def read_feed(path):
+    # ("mills", user_id, mill), ("market", index, listing) and ("plants",
+    # user_id, plant) from a feed_data.json, the same way
+    with open(path, "r", encoding="utf-8") as f:
+        stream = JsonStream(f)
+        for key in stream.members():
+            if key == "mills":
+                for user_id in stream.members():
+                    yield "mills", user_id, stream.value()
+            elif key == "market":
+                for index in stream.items():
+                    yield "market", index, stream.value()
+            else:
+                yield "plants", key, stream.value()
+
+
+def check_file(file_name, path, mill_levels=None):
+    # Raises SchemaError if the file at path isn't a usable file_name;
+    # returns what it holds, e.g. {"farms": 1200}
+    with open(path, "r", encoding="utf-8") as f:
+        stream = JsonStream(f)
+        try:
+            if file_name == "players.json":
+                counts = check_players(stream)
+            else:
+                counts = check_feed(stream, mill_levels)
+            stream.end()
+        except UnicodeDecodeError:
+            raise SchemaError("not UTF-8 text")
+    return counts
+
+
+# Farms, mills and listings carry the version of the layout they were last
+# written in ("schema"). The store brings older records up to date once,
+# when it loads them (see Store.reload()), and saves them, so later starts
+# find them current and handlers can read every field directly.
+#
+#   1  anything without a version: fields were added over time and may be
+#      missing; the oldest farms keep their pig at the top level
+#   2  every field below is present
+SCHEMA_VERSION = 2
+
+# Fields every farm has, and their value on a farm that lacks them. Optional
+# ones whose presence means something ("pig", "plant", "ton_wallet",
+# "blocked") aren't listed.
+PLAYER_DEFAULTS = {
+    "username": None,
+    "coins": 0,
+    "streak": 0,
+    "feed": 0,
+    "referrals": 0,
+    "ton_balance": 0,
+    "claimed_tasks": [],
+    "ton_log": [],
+    "last_processed": {},
+}
+PIG_DEFAULTS = {
+    "last_fed": None,
+    "fed_bits": 0,
+    "pregnant": False,
+    "pregnant_date": None,
+    "breed_spent": 0,
+}
+MILL_DEFAULTS = {
+    "level": 0,
+    "last_production": None,
+    "stock": [],
+    "emoji": "🏭",
+    "slogan": "Quality feed for every pig!",
+    "royalty_points": 0,
+    "sales": 0,
+}
+LISTING_DEFAULTS = {
+    "type": "normal",
+    "sales": 0,
+}
+# Top-level pig fields of the first farms
+LEGACY_PIG = ("pigs", "age", "last_fed", "is_pregnant", "pregnant_since")
+
+
+def fill(rec, defaults):
+    for field, default in defaults.items():
+        if field not in rec:
+            rec[field] = copy.copy(default)
+
+
+def legacy_pig(player):
+    # Move a pig kept at the top level of the farm into player["pig"]
+    old = {field: player.pop(field) for field in LEGACY_PIG if field in player}
+    if "pig" not in player and old.get("pigs"):
+        birth = date.today() - timedelta(days=old.get("age") or 0)
+        player["pig"] = {
+            "birth_date": birth.isoformat(),
+            "fed_dates": [old["last_fed"]] if old.get("last_fed") else [],
+            "pregnant": bool(old.get("is_pregnant")),
+            "pregnant_date": old.get("pregnant_since") if old.get("is_pregnant") else None,
+        }
+    if "breed_spent" in player:
+        spent = player.pop("breed_spent")
+        if player.get("pig") is not None:
+            player["pig"].setdefault("breed_spent", spent)
+
+
+def migrate_player(player):
+    # Bring a farm up to SCHEMA_VERSION in place; True if it changed
+    if player.get("schema") == SCHEMA_VERSION:
+        return False
+    legacy_pig(player)
+    fill(player, PLAYER_DEFAULTS)
+    migrate_piglets(player)
+    if player.get("pig", {}) is None:
+        del player["pig"]
+    pig = player.get("pig")
+    if pig is not None:
+        migrate_pig(pig)
+        pig.setdefault("birth_date", date.today().isoformat())
+        fill(pig, PIG_DEFAULTS)
+    player["schema"] = SCHEMA_VERSION
+    return True
+
+
+def migrate_mill(mill):
+    # Same for a mill. Its mill_id is given by the store.
+    if mill.get("schema") == SCHEMA_VERSION:
+        return False
+    fill(mill, MILL_DEFAULTS)
+    mill.setdefault("brand", f"Mill #{mill.get('mill_id', '')}")
+    mill["schema"] = SCHEMA_VERSION
+    return True
+
+
+def migrate_listing(listing):
+    # And a market listing. Its id is given by the order book.
+    if listing.get("schema") == SCHEMA_VERSION:
+        return False
+    fill(listing, LISTING_DEFAULTS)
+    listed_at(listing)
+    listing["schema"] = SCHEMA_VERSION
+    return True
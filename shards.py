@@ -0,0 +1,387 @@
+import asyncio
+import json
+import os
+import secrets
+import signal
+import sys
+import zlib
+from functools import wraps
+
+import httpx
+from telegram import Bot, Update
+
+import webhook
+from storage import DB_FILE, STORAGE_BACKEND, Store, import_json_files, open_backend, read_json, split_feed, write_file_atomic
+
+# SHARDS > 1 spreads the players over that many worker processes on this
+# host, so commands aren't all queued behind one GIL. Each worker owns the
+# farms, mills and plants of the user ids that hash to it (shard_of) and
+# keeps them in its own directory, shards/<n>/. `python bot.py` then runs
+# the router: it starts the workers, takes updates from Telegram (polling,
+# or the webhook with BOT_MODE=webhook) and hands each one to the worker
+# owning its sender. Workers reach players on other shards through the
+# router's /rpc endpoint, see CLUSTER.call().
+SHARDS = int(os.getenv("SHARDS", "1"))
+SHARD_ID = int(os.getenv("SHARD_ID", "-1"))  # set by the router for its workers
+SHARD_DIR = os.getenv("SHARD_DIR", "shards")
+SHARD_ROOT = os.getenv("SHARD_ROOT", "")  # the router's directory, for files every shard shares
+SHARD_HOST = "127.0.0.1"
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "9100"))  # router's /rpc; worker n is on base + 1 + n
+SHARD_SECRET = os.getenv("SHARD_SECRET", "")
+MARKET_SHARD = 0  # the feed market's order book lives here
+FORWARD_BATCH = 100  # most updates sent to a worker in one request
+RPC_TIMEOUT = 30
+POLL_TIMEOUT = 30  # long polling getUpdates
+RETRY_DELAY = 1
+MAX_ATTEMPTS = 5
+TELEGRAM_API = "https://api.telegram.org/bot"
+
+
+class ShardError(Exception):
+    pass
+
+
+class ShardUnavailable(ConnectionError):
+    # The shard is down or starting; worth trying again
+    pass
+
+
+def shard_of(user_id):
+    return zlib.crc32(str(user_id).encode()) % SHARDS
+
+
+def shared_file(name):
+    return os.path.join(SHARD_ROOT, name)
+
+
+def worker_port(shard):
+    return SHARD_BASE_PORT + 1 + shard
+
+
+def sender(update):
+    # Id of the user an update (as sent by Telegram) is from, like
+    # Update.effective_user
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"]
+    return None
+
+
+def auth(secret):
+    return {"X-Telegram-Bot-Api-Secret-Token": secret}
+
+
+def result(response):
+    if response.status_code == 503:
+        raise ShardUnavailable(response.request.url)
+    if response.status_code != 200:
+        try:
+            error = response.json()["error"]
+        except (ValueError, KeyError):
+            error = f"HTTP {response.status_code}"
+        raise ShardError(error)
+    return response.json()["result"]
+
+
+class Cluster:
+    # A worker's way to the other shards. Ops are coroutines op(app, **args)
+    # registered with @CLUSTER.op(name); call() runs one on another shard
+    # (or this one) through the router. Arguments and results are JSON.
+
+    def __init__(self):
+        self.ops = {}
+        self.app = None
+        self.client = None
+        self.pending = set()
+
+    @property
+    def sharded(self):
+        return SHARD_ID >= 0
+
+    def local(self, user_id):
+        return not self.sharded or shard_of(user_id) == SHARD_ID
+
+    @property
+    def local_market(self):
+        return not self.sharded or SHARD_ID == MARKET_SHARD
+
+    def op(self, name):
+        def register(fn):
+            self.ops[name] = fn
+            return fn
+
+        return register
+
+    async def dispatch(self, request):
+        # POST /rpc on a worker
+        return await self.ops[request["op"]](self.app, **request.get("args", {}))
+
+    def start(self, app):
+        self.app = app
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=RPC_TIMEOUT, headers=auth(SHARD_SECRET))
+
+    async def stop(self):
+        if self.pending:
+            await asyncio.wait(self.pending, timeout=RPC_TIMEOUT)
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def call(self, op, user=None, shard=None, everywhere=False, **args):
+        # Run op on the shard owning user, on shard, or everywhere (a list
+        # of results in shard order)
+        request = {"op": op, "args": args}
+        if everywhere:
+            request["all"] = True
+        else:
+            request["shard"] = shard_of(user) if shard is None else shard
+        try:
+            response = await self.client.post(f"http://{SHARD_HOST}:{SHARD_BASE_PORT}/rpc", json=request)
+        except httpx.ConnectError as e:
+            raise ShardUnavailable(e)
+        return result(response)
+
+    async def call_again(self, op, **args):
+        # call() for ops that are safe to run twice: tried again while the
+        # shard is unreachable or its reply doesn't come in time
+        for attempt in range(MAX_ATTEMPTS - 1):
+            try:
+                return await self.call(op, **args)
+            except (ShardUnavailable, httpx.TimeoutException):
+                await asyncio.sleep(2 ** attempt)
+        return await self.call(op, **args)
+
+    def post(self, op, user, **args):
+        # call() in the background, for changes the caller doesn't wait on
+        # (like paying a seller), retried while the shard is unreachable
+        task = asyncio.get_running_loop().create_task(self._post(op, user, args))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _post(self, op, user, args):
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                await self.call(op, user=user, **args)
+                return
+            except ShardUnavailable:
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                print(f"⚠️ {op} for {user} failed: {e} {args}")
+                return
+        print(f"⚠️ Gave up on {op} for {user}, shard unreachable: {args}")
+
+
+CLUSTER = Cluster()
+
+
+@CLUSTER.op("update")
+async def take_update(app, update):
+    await app.update_queue.put(Update.de_json(update, app.bot))
+
+
+def on_owner_shard(callback, target):
+    # For commands about another player (target(update, context) names
+    # them): the update is handed to the shard holding that player and runs
+    # there
+    @wraps(callback)
+    async def wrapper(update, context):
+        others = [str(k) for k in target(update, context) if k]
+        if others and not CLUSTER.local(others[0]):
+            await CLUSTER.call("update", user=others[0], update=update.to_dict())
+            return
+        return await callback(update, context)
+
+    return wrapper
+
+
+def seed(data_file, feed_file):
+    # On the first sharded start, split the current data into the shard
+    # directories. Changing SHARDS afterwards would need a re-split, which
+    # is refused rather than done behind anyone's back.
+    layout_file = os.path.join(SHARD_DIR, "layout.json")
+    layout = read_json(layout_file, None)
+    if layout is not None:
+        if layout["shards"] != SHARDS:
+            sys.exit(f"❌ {SHARD_DIR}/ is split into {layout['shards']} shards, not SHARDS={SHARDS}")
+        return
+
+    store = Store(open_backend(data_file, feed_file))
+    players_path, feed_path = asyncio.run(store.export_json())
+    store.backend.close()
+    players = read_json(players_path, {})
+    mills, market, plants = split_feed(read_json(feed_path, {"mills": {}, "market": []}))
+
+    for shard in range(SHARDS):
+        directory = os.path.join(SHARD_DIR, str(shard))
+        os.makedirs(directory, exist_ok=True)
+        part = {uid: p for uid, p in players.items() if shard_of(uid) == shard}
+        feed = {
+            "mills": {uid: m for uid, m in mills.items() if shard_of(uid) == shard},
+            "market": market if shard == MARKET_SHARD else [],
+        }
+        feed.update((uid, p) for uid, p in plants.items() if shard_of(uid) == shard)
+        write_file_atomic(os.path.join(directory, data_file), json.dumps(part, indent=2))
+        write_file_atomic(os.path.join(directory, feed_file), json.dumps(feed, indent=2))
+        if STORAGE_BACKEND == "sqlite":
+            import_json_files(os.path.join(directory, data_file), os.path.join(directory, feed_file),
+                              os.path.join(directory, DB_FILE))
+        print(f"🗂️ Shard {shard}: {len(part)} players")
+    write_file_atomic(layout_file, json.dumps({"shards": SHARDS}))
+
+
+class Router:
+    # Starts the workers (restarting any that die), feeds them updates and
+    # relays calls between them. Each worker gets its updates in the order
+    # Telegram sent them, in batches, over one connection.
+
+    def __init__(self, script, token):
+        self.script = os.path.abspath(script)
+        self.token = token
+        self.secret = SHARD_SECRET or secrets.token_urlsafe(32)
+        self.queues = [asyncio.Queue() for _ in range(SHARDS)]
+        self.workers = [None] * SHARDS
+        self.stopping = False
+        self.client = None
+
+    def worker_env(self, shard):
+        return dict(
+            os.environ,
+            SHARD_ID=str(shard),
+            SHARD_SECRET=self.secret,
+            SHARD_ROOT=os.getcwd(),
+            BOT_MODE="webhook",
+            WEBHOOK_URL="",
+            WEBHOOK_LISTEN=SHARD_HOST,
+            WEBHOOK_PORT=str(worker_port(shard)),
+            WEBHOOK_SECRET=self.secret,
+            WEBHOOK_CERT="",
+        )
+
+    async def supervise(self, shard):
+        directory = os.path.join(SHARD_DIR, str(shard))
+        while not self.stopping:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, self.script, cwd=directory, env=self.worker_env(shard)
+            )
+            self.workers[shard] = proc
+            code = await proc.wait()
+            if not self.stopping:
+                print(f"⚠️ Shard {shard} exited ({code}), restarting")
+                await asyncio.sleep(RETRY_DELAY)
+
+    def route(self, update):
+        user_id = sender(update)
+        self.queues[MARKET_SHARD if user_id is None else shard_of(user_id)].put_nowait(update)
+
+    async def deliver(self, update):
+        self.route(update)
+
+    async def forward(self, shard):
+        queue = self.queues[shard]
+        url = f"http://{SHARD_HOST}:{worker_port(shard)}/{webhook.WEBHOOK_PATH}"
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty() and len(batch) < FORWARD_BATCH:
+                batch.append(queue.get_nowait())
+            while True:
+                try:
+                    response = await self.client.post(url, json=batch)
+                    if response.status_code == 200:
+                        break
+                    if response.status_code == 400:
+                        print(f"⚠️ Shard {shard} rejected {len(batch)} updates")
+                        break
+                except httpx.HTTPError:
+                    pass
+                # Starting up or restarting; it'll be back
+                await asyncio.sleep(RETRY_DELAY)
+            for _ in batch:
+                queue.task_done()
+
+    async def rpc(self, request):
+        if not request.get("all"):
+            return await self.relay(request["shard"], request)
+        return list(await asyncio.gather(*(self.relay(shard, request) for shard in range(SHARDS))))
+
+    async def relay(self, shard, request):
+        try:
+            response = await self.client.post(f"http://{SHARD_HOST}:{worker_port(shard)}/rpc", json=request)
+        except httpx.ConnectError as e:
+            raise ShardUnavailable(e)
+        return result(response)
+
+    async def poll(self):
+        api = f"{TELEGRAM_API}{self.token}/"
+        offset = None
+        async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+            await client.post(api + "deleteWebhook")
+            while True:
+                try:
+                    reply = (await client.post(api + "getUpdates", json={
+                        "offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": Update.ALL_TYPES,
+                    })).json()
+                except (httpx.HTTPError, ValueError) as e:
+                    print(f"⚠️ getUpdates failed: {e}")
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+                if not reply.get("ok"):
+                    print(f"⚠️ getUpdates failed: {reply.get('description')}")
+                    await asyncio.sleep(reply.get("parameters", {}).get("retry_after", RETRY_DELAY))
+                    continue
+                # Raw dicts, passed on without parsing them into Updates
+                for update in reply["result"]:
+                    self.route(update)
+                    offset = update["update_id"] + 1
+
+    async def run(self):
+        stop = webhook.stop_event()
+        self.client = httpx.AsyncClient(
+            timeout=RPC_TIMEOUT, headers=auth(self.secret), limits=httpx.Limits(max_connections=None)
+        )
+        rpc_server = webhook.WebhookServer(self.deliver, self.secret, lambda: True, rpc=self.rpc)
+        await rpc_server.start(SHARD_HOST, SHARD_BASE_PORT)
+        loop = asyncio.get_running_loop()
+        tasks = [loop.create_task(self.supervise(shard)) for shard in range(SHARDS)]
+        forwarders = [loop.create_task(self.forward(shard)) for shard in range(SHARDS)]
+
+        public = poller = None
+        if webhook.BOT_MODE == "webhook":
+            secret = webhook.webhook_secret()
+            public = webhook.WebhookServer(self.deliver, secret, lambda: not self.stopping)
+            await public.start(ssl_context=webhook.ssl_context())
+            if webhook.WEBHOOK_URL:
+                async with Bot(self.token) as bot:
+                    await webhook.register(bot, secret)
+        else:
+            poller = loop.create_task(self.poll())
+        print(f"🔀 Routing updates to {SHARDS} shards")
+
+        await stop.wait()
+        self.stopping = True
+        if public is not None:
+            await public.stop()
+        if poller is not None:
+            poller.cancel()
+        # Hand over what was already taken from Telegram, then stop the
+        # workers (they flush their stores) and only then the relay, which
+        # they may still use while stopping
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), RPC_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("⚠️ Some updates weren't handed to their shard before stopping")
+        for proc in self.workers:
+            if proc is not None and proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+        await asyncio.gather(*tasks)
+        for task in forwarders:
+            task.cancel()
+        await rpc_server.stop()
+        await self.client.aclose()
+
+
+def run_router(script, token, data_file, feed_file):
+    seed(data_file, feed_file)
+    asyncio.run(Router(script, token).run())
@@ -0,0 +1,1489 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import sys
+import time
+import itertools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from metrics import METRICS
+from orderbook import OrderBook, index_listings
+from packfile import ZDICT_SAMPLE, PackReader, compact_json, json_to_pack, write_pack
+from ranking import Ranking
+from records import Listing, Mill, Player, record_json
+from schema import migrate_listing, migrate_mill, migrate_player, read_feed, read_players
+
+# Seconds between write-behind flushes of dirty state
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "10"))
+
+# "json" rewrites players.json/feed_data.json, "journal" appends changes to
+# JOURNAL_FILE and compacts it into them, "pack" does the same with players
+# in the binary PACK_FILE, "sqlite" keeps everything in DB_FILE
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+DB_FILE = os.getenv("DB_FILE", "pigfarm.db")
+PACK_FILE = os.getenv("PACK_FILE", "players.pak")
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "players.journal")
+# Compact the journal into fresh snapshots once it grows past this size
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+# Farms nobody has used for this many days leave the working set: the json
+# and journal backends move them into COLD_FILE, the others stop caching
+# them. 0 keeps everyone in memory.
+COLD_AFTER_DAYS = int(os.getenv("COLD_AFTER_DAYS", "30"))
+COLD_FILE = os.getenv("COLD_FILE", "players.cold.pak")
+RETIRE_INTERVAL = 3600  # seconds between idle farm sweeps
+IMPORT_BATCH = 1000  # records of a restored file written to SQLite at a time
+SCAN_BATCH = 1000  # resident records a scan looks at between yields to the event loop
+
+# Player fields that are ranked (and get their own indexed column in SQLite)
+PLAYER_COLUMNS = ("coins", "streak", "ton_balance")
+MILL_COLUMNS = ("royalty_points",)
+
+# Disk and database writes run here, off the event loop. One worker, so jobs
+# run in the order they were submitted.
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-io")
+
+
+async def run_io(func, *args):
+    # Await blocking file work on the storage I/O thread
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, func, *args)
+
+
+def batches(items, size):
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def read_json(path, default):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return default
+
+
+def write_tmp(path, content):
+    # content is text, bytes, or a function that writes to a binary file
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        if callable(content):
+            content(f)
+        else:
+            f.write(content.encode() if isinstance(content, str) else content)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp
+
+
+def write_file_atomic(path, content):
+    # Write next to the target and rename over it so a crash never leaves a
+    # half-written file behind
+    os.replace(write_tmp(path, content), path)
+
+
+def write_files_atomic(files, marker):
+    # Replace several files as one unit: stage them all, record the batch in
+    # a commit marker, then rename. If we crash after the marker is written,
+    # recover_commit() finishes the renames on the next start; before that,
+    # none of the files have changed.
+    if len(files) == 1:
+        write_file_atomic(*files[0])
+        return
+    for path, content in files:
+        write_tmp(path, content)
+    write_file_atomic(marker, json.dumps([path for path, _ in files]))
+    for path, _ in files:
+        os.replace(path + ".tmp", path)
+    os.remove(marker)
+
+
+def recover_commit(marker):
+    if not os.path.exists(marker):
+        return
+    with open(marker, "r") as f:
+        paths = json.load(f)
+    for path in paths:
+        if os.path.exists(path + ".tmp"):
+            os.replace(path + ".tmp", path)
+    os.remove(marker)
+    print(f"♻️ Finished interrupted commit of {', '.join(paths)}")
+
+
+def encode_record(rec):
+    # Same layout json.dump(..., indent=2) gives a value nested one level deep
+    return json.dumps(rec, indent=2, default=record_json).replace("\n", "\n  ")
+
+
+def encode_object(items):
+    # Join already-encoded (key, text) members into one indent=2 JSON object
+    body = ",\n".join(f"  {json.dumps(key)}: {text}" for key, text in items)
+    return "{\n" + body + "\n}" if body else "{}"
+
+
+def upgrade(rec, migrate, record):
+    # (rec brought up to date by migrate and held as a record, whether
+    # migrate changed it)
+    changed = migrate(rec)
+    return record.from_json(rec), changed
+
+
+def epoch_today():
+    # Days since 1970-01-01 in UTC, the unit of a player's last_seen
+    return int(time.time() // 86400)
+
+
+def rewrite_pack(f, pack, fresh, drop):
+    # Write a new pack: pack's entries whose id isn't in drop, then the
+    # fresh (id, record) pairs. Old entries are copied byte for byte unless
+    # the pack had too few farms when its dictionary was sampled.
+    if pack is None:
+        write_pack(f, fresh)
+    elif len(pack) >= ZDICT_SAMPLE:
+        kept = ((uid, raw) for uid, raw in pack.raw_items() if uid not in drop)
+        write_pack(f, itertools.chain(kept, fresh), zdict=bytes(pack.zdict))
+    else:
+        kept = ((uid, rec) for uid, rec in pack.items() if uid not in drop)
+        write_pack(f, itertools.chain(kept, fresh))
+
+
+def short_mill_id(user_id, taken):
+    # Last four digits of the owner's id, lengthened until no other mill
+    # uses it
+    for n in range(min(4, len(user_id)), len(user_id) + 1):
+        if not taken(user_id[-n:]):
+            return user_id[-n:]
+    i = 2
+    while taken(f"{user_id}-{i}"):
+        i += 1
+    return f"{user_id}-{i}"
+
+
+def split_feed(feed):
+    mills = feed.get("mills", {})
+    market = feed.get("market", [])
+    plants = {k: v for k, v in feed.items() if k not in ("mills", "market")}
+    return mills, market, plants
+
+
+class JsonBackend:
+    # players.json and feed_data.json, loaded whole at startup. Each record's
+    # encoding is cached so a flush only re-encodes what actually changed.
+    # With a cold_file, farms that have gone idle are moved out of
+    # players.json into a packfile and read back one at a time on demand.
+    #
+    # Backend methods that touch disk are called on the event loop and return
+    # a job for the storage I/O thread. Anything read from live records is
+    # encoded before they return, since handlers keep mutating them while
+    # the job runs.
+    name = "json"
+    eager = True
+    eager_feed = True  # mills and plants stay resident, in dicts shared with the store
+
+    def __init__(self, data_file, feed_file, cold_file=None):
+        self.data_file = data_file
+        self.feed_file = feed_file
+        self.cold_file = cold_file
+        self._cold = None
+        self._archiving = {}
+        self._players = {}
+        self._mills = {}
+        self._plants = {}
+        self._market = {}
+        self._encoded = {}
+        self._encoded_mills = {}
+        self._encoded_plants = {}
+        self._encoded_listings = {}
+        self.commit_marker = data_file + ".commit"
+
+    def load(self):
+        recover_commit(self.commit_marker)
+        players = read_json(self.data_file, {})
+        mills, market, plants = split_feed(read_json(self.feed_file, {"mills": {}, "market": []}))
+        market = index_listings(market)
+        self._players, self._mills, self._plants, self._market = players, mills, plants, market
+        self._encoded = {}
+        self._encoded_mills = {}
+        self._encoded_plants = {}
+        self._encoded_listings = {}
+        self._archiving = {}
+        self._open_cold()
+        return players, mills, plants, market
+
+    def _open_cold(self):
+        # The old reader is closed on the I/O thread, after any job queued
+        # there that may still read it
+        old = self._cold
+        self._cold = PackReader(self.cold_file) if self.cold_file and os.path.exists(self.cold_file) else None
+        if old is not None:
+            IO_EXECUTOR.submit(old.close)
+
+    def load_player(self, user_id):
+        # Only asked for farms that aren't in players.json. Farms on their
+        # way to the cold pack are read from what archive() took out (a copy,
+        # the job is still encoding it).
+        rec = self._archiving.get(user_id)
+        if rec is not None:
+            return copy.deepcopy(rec)
+        return self._cold.get(user_id) if self._cold is not None else None
+
+    def iter_cold(self):
+        # Archived farms that haven't come back into players.json since
+        for user_id, rec in list(self._archiving.items()):
+            if user_id not in self._players:
+                yield user_id, rec
+        if self._cold is not None:
+            for user_id, rec in self._cold.items():
+                if user_id not in self._players and user_id not in self._archiving:
+                    yield user_id, rec
+
+    def scan_players(self):
+        # The farms that aren't resident, for Store.scan_players() to walk on
+        # the I/O thread
+        return self.iter_cold()
+
+    def _cold_file(self, moved):
+        cold, drop = self._cold, set(self._players) | set(moved)
+        return self.cold_file, lambda f: rewrite_pack(f, cold, moved.items(), drop)
+
+    def _take_idle(self, user_ids):
+        # Out of players.json, but readable until the new cold pack is open
+        moved = {uid: self._players.pop(uid) for uid in user_ids}
+        for uid in user_ids:
+            self._encoded.pop(uid, None)
+        self._archiving.update(moved)
+        return moved
+
+    def _archived(self, moved):
+        # Back on the loop: switch to the new cold pack. Farms that came back
+        # meanwhile are resident again with their own copy, which wins.
+        def finish():
+            self._open_cold()
+            for uid in moved:
+                self._archiving.pop(uid, None)
+
+        return finish
+
+    def archive(self, user_ids):
+        # Move idle farms from players.json into the cold pack. The job
+        # returns a function that switches to the new pack back on the loop.
+        moved = self._take_idle(user_ids)
+        write = self._files_job(feed=False, extra=[self._cold_file(moved)])
+        finish = self._archived(moved)
+
+        def job():
+            write()
+            return finish
+
+        return job
+
+    def _apply(self, records, changes, encoded=None):
+        for key, rec in changes.items():
+            if rec is None:
+                records.pop(key, None)
+            else:
+                records[key] = rec
+            if encoded is not None:
+                encoded.pop(key, None)
+
+    def _encode_all(self, records, encoded):
+        for key, rec in records.items():
+            text = encoded.get(key)
+            if text is None:
+                text = encoded[key] = encode_record(rec)
+            yield key, text
+
+    def _players_file(self):
+        members = list(self._encode_all(self._players, self._encoded))
+        return self.data_file, lambda f: f.write(encode_object(members).encode())
+
+    def _feed_file(self):
+        mills = list(self._encode_all(self._mills, self._encoded_mills))
+        listings = [text for _, text in self._encode_all(self._market, self._encoded_listings)]
+        plants = list(self._encode_all(self._plants, self._encoded_plants))
+
+        def write(f):
+            # Listings are stored as a list, each one encoded like a mill
+            market = "[\n    " + ",\n    ".join(listings) + "\n  ]" if listings else "[]"
+            doc = [("mills", encode_object(mills).replace("\n", "\n  ")), ("market", market)]
+            doc.extend(plants)
+            f.write(encode_object(doc).encode())
+
+        return self.feed_file, write
+
+    def _files_job(self, players=True, feed=True, extra=()):
+        files = []
+        if players:
+            files.append(self._players_file())
+        if feed:
+            files.append(self._feed_file())
+        files.extend(extra)
+        marker = self.commit_marker
+        return lambda: write_files_atomic(files, marker)
+
+    def _apply_feed(self, mills, plants, listings):
+        self._apply(self._mills, mills, self._encoded_mills)
+        self._apply(self._plants, plants, self._encoded_plants)
+        self._apply(self._market, listings, self._encoded_listings)
+
+    def write(self, players, mills, plants, listings):
+        # Both files of one flush are committed together
+        feed_changed = bool(mills or plants or listings)
+        if players:
+            self._apply(self._players, players, self._encoded)
+        if feed_changed:
+            self._apply_feed(mills, plants, listings)
+        if players or feed_changed:
+            return self._files_job(players=bool(players), feed=feed_changed)
+        return None
+
+    def export_json(self, directory):
+        if self._cold is None:
+            return lambda: [self.data_file, self.feed_file]
+        # players.json only holds active farms; back up the archived ones too
+        hot, cold = list(self._encode_all(self._players, self._encoded)), self._cold
+        data_file = os.path.join(directory, "players.json")
+
+        def job():
+            active = {uid for uid, _ in hot}
+            archived = ((uid, encode_record(rec)) for uid, rec in cold.items() if uid not in active)
+            write_file_atomic(data_file, encode_object(itertools.chain(hot, archived)))
+            return [data_file, self.feed_file]
+
+        return job
+
+    def _drop_cold(self):
+        # A restored players.json holds every farm, archived ones included
+        if self._cold is None:
+            return lambda: None
+        self._cold = None
+        return lambda: os.remove(self.cold_file)
+
+    def restored_file(self, file_name):
+        # Where a restored players.json/feed_data.json is renamed to before
+        # import_json(); None if the backend reads the upload instead
+        return self.data_file if file_name == "players.json" else self.feed_file
+
+    def import_json(self, file_name, path):
+        # A job taking in the restored file at path (read on the I/O thread,
+        # a record at a time). Here it was renamed into place, nothing to do.
+        return self._drop_cold() if file_name == "players.json" else None
+
+    def close(self):
+        pass
+
+
+class JournalBackend(JsonBackend):
+    # players.json/feed_data.json as a snapshot plus an append-only journal.
+    # Every flush appends one line holding the full new value of each record
+    # it touched, so replaying the journal over the snapshot is idempotent and
+    # a torn last line from a crash is simply ignored. compact() folds the
+    # journal back into a fresh snapshot.
+    name = "journal"
+
+    def __init__(self, data_file, feed_file, journal_file, compact_bytes, cold_file=None):
+        super().__init__(data_file, feed_file, cold_file)
+        self.journal_file = journal_file
+        self.compact_bytes = compact_bytes
+        self._journal = None
+        self._journal_bytes = 0
+
+    def load(self):
+        super().load()
+        self._replay_journal()
+        return self._players, self._mills, self._plants, self._market
+
+    def _replay_journal(self):
+        replayed = good = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError:
+                        entry = None
+                    if entry is None:
+                        break  # torn write at the tail
+                    self._replay(entry)
+                    replayed += 1
+                    good += len(line)
+            if os.path.getsize(self.journal_file) > good:
+                # Drop the torn tail so new entries start on a clean line
+                os.truncate(self.journal_file, good)
+        if replayed:
+            print(f"📜 Replayed {replayed} journal entries")
+        self._journal_bytes = good
+        if self._journal is None:
+            self._journal = open(self.journal_file, "ab")
+
+    def _apply_players(self, changes):
+        self._apply(self._players, changes, self._encoded)
+
+    def _replay(self, entry):
+        self._apply_players(entry.get("players", {}))
+        listings = entry.get("listings", {})
+        if "market" in entry or isinstance(listings, list):
+            # Journals written before listings had ids carry the whole
+            # market or a list of new listings
+            if "market" in entry:
+                self._market = {}
+            next_id = max(map(int, self._market), default=0) + 1
+            listings = index_listings(entry.get("market", listings), next_id)
+        self._apply_feed(entry.get("mills", {}), entry.get("plants", {}), listings)
+
+    def write(self, players, mills, plants, listings):
+        entry = {}
+        if players:
+            entry["players"] = players
+            self._apply_players(players)
+        if mills:
+            entry["mills"] = mills
+        if plants:
+            entry["plants"] = plants
+        if listings:
+            entry["listings"] = listings
+        if not entry:
+            return None
+        self._apply_feed(mills, plants, listings)
+        line = json.dumps(entry, separators=(",", ":"), default=record_json).encode() + b"\n"
+        self._journal_bytes += len(line)
+        return lambda: self._append(line)
+
+    def _append(self, line):
+        self._journal.write(line)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def journal_size(self):
+        # Counted when entries are queued, so it doesn't wait on the I/O thread
+        return self._journal_bytes
+
+    def needs_compaction(self):
+        return self.journal_size() >= self.compact_bytes
+
+    def _truncate_journal(self):
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _rewrite_job(self, players=True, feed=True, extra=()):
+        # Snapshots are replaced atomically before the journal is cleared; if
+        # we crash in between, replaying the old entries is harmless
+        write = self._files_job(players=players, feed=feed, extra=extra)
+        self._journal_bytes = 0
+
+        def job():
+            write()
+            self._truncate_journal()
+
+        return job
+
+    def compact(self):
+        return self._rewrite_job()
+
+    def archive(self, user_ids):
+        # Like compact(), so no journal entry can bring the moved farms back
+        moved = self._take_idle(user_ids)
+        rewrite = self._rewrite_job(extra=[self._cold_file(moved)])
+        finish = self._archived(moved)
+
+        def job():
+            rewrite()
+            return finish
+
+        return job
+
+    def import_json(self, file_name, path):
+        # One snapshot was replaced by the restored file; write out the other
+        # one so the journal can be dropped
+        players = file_name == "players.json"
+        drop_cold = self._drop_cold() if players else (lambda: None)
+        rewrite = self._rewrite_job(players=not players, feed=players)
+
+        def job():
+            rewrite()
+            drop_cold()
+
+        return job
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class PackBackend(JournalBackend):
+    # Players live in a packfile snapshot (see packfile.py) that is memory
+    # mapped and decoded one farm at a time, with changes journaled exactly
+    # like the journal backend. Compaction rewrites the pack, copying the
+    # entries of untouched farms byte for byte. Mills, plants and the market
+    # stay in feed_data.json.
+    name = "pack"
+    eager = False
+
+    def __init__(self, pack_file, json_file, feed_file, journal_file, compact_bytes):
+        super().__init__(pack_file, feed_file, journal_file, compact_bytes)
+        self.json_file = json_file
+        self._pack = None
+
+    def _reopen(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+        if os.path.exists(self.data_file):
+            self._pack = PackReader(self.data_file)
+        # Compact JSON of farms changed since the pack was written; None
+        # marks a deletion
+        self._players = {}
+        self._encoded = {}
+
+    def load(self):
+        recover_commit(self.commit_marker)
+        if not os.path.exists(self.data_file) and os.path.exists(self.json_file):
+            count = json_to_pack(self.json_file, self.data_file)
+            print(f"📦 Converted {count} players from {self.json_file} into {self.data_file}")
+        self._reopen()
+        self._mills, market, self._plants = split_feed(read_json(self.feed_file, {"mills": {}, "market": []}))
+        self._market = index_listings(market)
+        self._encoded_mills = {}
+        self._encoded_listings = {}
+        self._replay_journal()
+        return {}, self._mills, self._plants, self._market
+
+    def _apply_players(self, changes):
+        for user_id, rec in changes.items():
+            self._players[user_id] = None if rec is None else compact_json(rec)
+
+    def load_player(self, user_id):
+        if user_id in self._players:
+            raw = self._players[user_id]
+            return json.loads(raw) if raw is not None else None
+        return self._pack.get(user_id) if self._pack is not None else None
+
+    def load_mill(self, user_id):
+        return self._mills.get(user_id)
+
+    def load_plant(self, user_id):
+        return self._plants.get(user_id)
+
+    def _rows(self):
+        # Every farm as of now: the pack and the overlay are taken when this
+        # is called, so the rows can be read later, on the I/O thread
+        pack, changed = self._pack, dict(self._players)
+        kept = ((uid, rec) for uid, rec in (pack.items() if pack is not None else ()) if uid not in changed)
+        fresh = ((uid, json.loads(raw)) for uid, raw in changed.items() if raw is not None)
+        return itertools.chain(kept, fresh)
+
+    def iter_players(self):
+        return self._rows()
+
+    def iter_mills(self):
+        return iter(list(self._mills.items()))
+
+    scan_players = iter_players
+    scan_mills = iter_mills
+
+    def _players_file(self):
+        pack, changed = self._pack, dict(self._players)
+
+        def write(f):
+            fresh = ((uid, json.loads(raw)) for uid, raw in changed.items() if raw is not None)
+            rewrite_pack(f, pack, fresh, changed)
+
+        return self.data_file, write
+
+    def compact(self):
+        # The job opens the new pack; switching to it happens back on the
+        # event loop through the function it returns
+        written = dict(self._players)
+        rewrite = self._rewrite_job()
+
+        def job():
+            rewrite()
+            pack = PackReader(self.data_file)
+            return lambda: self._swap_pack(pack, written)
+
+        return job
+
+    def _swap_pack(self, pack, written):
+        # The old reader isn't closed here: a queued job may still be reading
+        # it, so it's left to be closed once nothing references it
+        self._pack = pack
+        for user_id, raw in written.items():
+            # Farms changed again since the snapshot stay in the overlay
+            if user_id in self._players and self._players[user_id] is raw:
+                del self._players[user_id]
+
+    def export_json(self, directory):
+        rows = self._rows()
+        data_file = os.path.join(directory, "players.json")
+
+        def job():
+            members = ((uid, encode_record(rec)) for uid, rec in rows)
+            write_file_atomic(data_file, encode_object(members))
+            return [data_file, self.feed_file]
+
+        return job
+
+    def restored_file(self, file_name):
+        # The pack is rebuilt from the restored farms
+        return None if file_name == "players.json" else self.feed_file
+
+    def import_json(self, file_name, path):
+        if file_name != "players.json":
+            return self._rewrite_job(players=True, feed=False)
+        # Build the new pack from the restored farms alone, streamed from the
+        # upload; the journal's changes are dropped with the old overlay
+        self._players = {}
+        self._encoded = {}
+        return self._rewrite_job(
+            players=False, feed=True, extra=[(self.data_file, lambda f: write_pack(f, read_players(path)))]
+        )
+
+    def close(self):
+        super().close()
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+
+
+class SqliteBackend:
+    # One row per player, mill, plant and market listing. Pigs and piglets
+    # live in the player row's JSON; the fields we rank or filter on are
+    # mirrored into indexed columns.
+    name = "sqlite"
+    eager = False
+    eager_feed = False
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS players (
+            user_id TEXT PRIMARY KEY,
+            coins REAL NOT NULL DEFAULT 0,
+            streak INTEGER NOT NULL DEFAULT 0,
+            ton_balance REAL NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS players_coins ON players (coins);
+        CREATE INDEX IF NOT EXISTS players_streak ON players (streak);
+        CREATE INDEX IF NOT EXISTS players_ton_balance ON players (ton_balance);
+        CREATE TABLE IF NOT EXISTS mills (
+            user_id TEXT PRIMARY KEY,
+            royalty_points REAL NOT NULL DEFAULT 0,
+            mill_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS mills_royalty_points ON mills (royalty_points);
+        CREATE TABLE IF NOT EXISTS plants (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS market (
+            id INTEGER PRIMARY KEY,
+            seller_id TEXT NOT NULL,
+            price REAL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS market_price ON market (price, id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Databases imported before mills had short ids
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(mills)")]
+        if "mill_id" not in columns:
+            self.conn.execute("ALTER TABLE mills ADD COLUMN mill_id TEXT")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS mills_mill_id ON mills (mill_id)")
+        self.conn.commit()
+        # Handlers read through self.conn on the event loop; the I/O thread
+        # writes through its own connection, and WAL keeps them out of each
+        # other's way
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+
+    def load(self):
+        # Players, mills and plants are read on demand; only the market is
+        # kept resident
+        return {}, {}, {}, self._listings(self.conn)
+
+    def _listings(self, conn):
+        # The row id is the listing id, also for rows stored before listings
+        # carried one
+        listings = {}
+        for listing_id, data in conn.execute("SELECT id, data FROM market ORDER BY id"):
+            listing = json.loads(data)
+            listing["id"] = listing_id
+            listings[str(listing_id)] = listing
+        return listings
+
+    def _get(self, table, key):
+        row = self.conn.execute(f"SELECT data FROM {table} WHERE user_id = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_player(self, user_id):
+        return self._get("players", user_id)
+
+    def load_mill(self, user_id):
+        return self._get("mills", user_id)
+
+    def load_plant(self, user_id):
+        return self._get("plants", user_id)
+
+    def iter_players(self):
+        for user_id, data in self.conn.execute("SELECT user_id, data FROM players"):
+            yield user_id, json.loads(data)
+
+    def iter_mills(self):
+        for user_id, data in self.conn.execute("SELECT user_id, data FROM mills"):
+            yield user_id, json.loads(data)
+
+    def _scan(self, table):
+        # Like iter_players(), through the I/O thread's connection. It's a
+        # generator, so the query only runs once the I/O thread iterates it.
+        for user_id, data in self.writer.execute(f"SELECT user_id, data FROM {table}"):
+            yield user_id, json.loads(data)
+
+    def scan_players(self):
+        return self._scan("players")
+
+    def scan_mills(self):
+        return self._scan("mills")
+
+    def find_mill_owner(self, mill_id):
+        row = self.conn.execute("SELECT user_id FROM mills WHERE mill_id = ?", (mill_id,)).fetchone()
+        return row[0] if row else None
+
+    def mills_without_id(self):
+        rows = self.conn.execute("SELECT user_id, data FROM mills WHERE mill_id IS NULL").fetchall()
+        return [(user_id, json.loads(data)) for user_id, data in rows]
+
+    def iter_player_scores(self):
+        # (user_id, coins, streak, ton_balance) straight from the indexed
+        # columns, without decoding any farm; for the I/O thread
+        return self.writer.execute(f"SELECT user_id, {', '.join(PLAYER_COLUMNS)} FROM players")
+
+    def iter_mill_scores(self):
+        return self.writer.execute("SELECT user_id, royalty_points FROM mills")
+
+    # Rows are built on the event loop, from records that may change as
+    # soon as we return, and written on the I/O thread through self.writer
+    def _player_rows(self, players):
+        return [
+            (user_id, None if rec is None else (*(rec.get(c, 0) or 0 for c in PLAYER_COLUMNS), json.dumps(rec, default=record_json)))
+            for user_id, rec in players.items()
+        ]
+
+    def _mill_rows(self, mills):
+        return [
+            (user_id, None if mill is None else (mill.get("royalty_points", 0), mill.get("mill_id"), json.dumps(mill, default=record_json)))
+            for user_id, mill in mills.items()
+        ]
+
+    def _plant_rows(self, plants):
+        return [(user_id, None if plant is None else json.dumps(plant)) for user_id, plant in plants.items()]
+
+    def _listing_rows(self, listings):
+        return [
+            (int(listing_id), None if l is None else (l.get("seller_id"), l.get("price"), json.dumps(l, default=record_json)))
+            for listing_id, l in listings.items()
+        ]
+
+    def _write_players(self, rows):
+        for user_id, values in rows:
+            if values is None:
+                self.writer.execute("DELETE FROM players WHERE user_id = ?", (user_id,))
+                continue
+            self.writer.execute(
+                "INSERT INTO players (user_id, coins, streak, ton_balance, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET coins = excluded.coins, streak = excluded.streak, "
+                "ton_balance = excluded.ton_balance, data = excluded.data",
+                (user_id, *values),
+            )
+
+    def _write_mills(self, rows):
+        for user_id, values in rows:
+            if values is None:
+                self.writer.execute("DELETE FROM mills WHERE user_id = ?", (user_id,))
+                continue
+            self.writer.execute(
+                "INSERT INTO mills (user_id, royalty_points, mill_id, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET royalty_points = excluded.royalty_points, "
+                "mill_id = excluded.mill_id, data = excluded.data",
+                (user_id, *values),
+            )
+
+    def _write_plants(self, rows):
+        for user_id, data in rows:
+            if data is None:
+                self.writer.execute("DELETE FROM plants WHERE user_id = ?", (user_id,))
+            else:
+                self.writer.execute("INSERT OR REPLACE INTO plants (user_id, data) VALUES (?, ?)", (user_id, data))
+
+    def _write_listings(self, rows):
+        for listing_id, values in rows:
+            if values is None:
+                self.writer.execute("DELETE FROM market WHERE id = ?", (listing_id,))
+            else:
+                self.writer.execute(
+                    "INSERT OR REPLACE INTO market (id, seller_id, price, data) VALUES (?, ?, ?, ?)",
+                    (listing_id, *values),
+                )
+
+    def write(self, players, mills, plants, listings):
+        player_rows = self._player_rows(players)
+        mill_rows = self._mill_rows(mills)
+        plant_rows = self._plant_rows(plants)
+        listing_rows = self._listing_rows(listings)
+
+        def job():
+            with self.writer:
+                self._write_players(player_rows)
+                self._write_mills(mill_rows)
+                self._write_plants(plant_rows)
+                self._write_listings(listing_rows)
+
+        return job
+
+    def restored_file(self, file_name):
+        return None
+
+    def import_json(self, file_name, path):
+        # Replace whole tables with the contents of players.json or
+        # feed_data.json, read and written IMPORT_BATCH records at a time in
+        # one transaction
+        def players():
+            self.writer.execute("DELETE FROM players")
+            for batch in batches(read_players(path), IMPORT_BATCH):
+                self._write_players(self._player_rows(dict(batch)))
+
+        def feed():
+            for table in ("mills", "plants", "market"):
+                self.writer.execute(f"DELETE FROM {table}")
+            write = {"mills": lambda b: self._write_mills(self._mill_rows(b)),
+                     "plants": lambda b: self._write_plants(self._plant_rows(b))}
+            market = []
+            for batch in batches(read_feed(path), IMPORT_BATCH):
+                grouped = {"mills": {}, "plants": {}}
+                for section, key, value in batch:
+                    if section == "market":
+                        market.append(value)
+                    else:
+                        grouped[section][key] = value
+                for section, records in grouped.items():
+                    write[section](records)
+            # Listings are numbered once they're all in, see index_listings()
+            self._write_listings(self._listing_rows(index_listings(market)))
+
+        def job():
+            with self.writer:
+                if file_name == "players.json":
+                    players()
+                else:
+                    feed()
+
+        return job
+
+    def export_json(self, directory):
+        data_file = os.path.join(directory, "players.json")
+        feed_file = os.path.join(directory, "feed_data.json")
+
+        def job():
+            rows = self.writer.execute("SELECT user_id, data FROM players")
+            write_file_atomic(data_file, encode_object((uid, encode_record(json.loads(data))) for uid, data in rows))
+            feed = {
+                "mills": {uid: json.loads(data) for uid, data in self.writer.execute("SELECT user_id, data FROM mills")},
+                "market": list(self._listings(self.writer).values()),
+            }
+            for user_id, data in self.writer.execute("SELECT user_id, data FROM plants"):
+                feed[user_id] = json.loads(data)
+            write_file_atomic(feed_file, json.dumps(feed, indent=2))
+            return [data_file, feed_file]
+
+        return job
+
+    def close(self):
+        self.writer.close()
+        self.conn.close()
+
+
+def open_backend(data_file, feed_file):
+    if STORAGE_BACKEND == "sqlite":
+        if not os.path.exists(DB_FILE) and (os.path.exists(data_file) or os.path.exists(feed_file)):
+            # First start on SQLite after JSON: bring the farms along, like
+            # the pack backend converts players.json. Built beside the
+            # database, so a crash halfway leaves nothing to mistake for it.
+            building = DB_FILE + ".tmp"
+            for path in (building, building + "-wal", building + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+            n_players, n_mills, n_listings = import_json_files(data_file, feed_file, building)
+            os.replace(building, DB_FILE)
+            print(f"📦 Imported {n_players} players, {n_mills} mills and {n_listings} listings into {DB_FILE}")
+        return SqliteBackend(DB_FILE)
+    if STORAGE_BACKEND == "pack":
+        return PackBackend(PACK_FILE, data_file, feed_file, JOURNAL_FILE, JOURNAL_COMPACT_BYTES)
+    cold_file = COLD_FILE if COLD_AFTER_DAYS else None
+    if STORAGE_BACKEND == "journal":
+        return JournalBackend(data_file, feed_file, JOURNAL_FILE, JOURNAL_COMPACT_BYTES, cold_file)
+    return JsonBackend(data_file, feed_file, cold_file)
+
+
+class Transaction:
+    # Copy-on-write view of the store for commands that change several
+    # records at once (a farm and a mill, a buyer and a seller). Records are
+    # deep-copied on first access and only swapped into the store, and marked
+    # dirty, on commit; if the command raises, the copies are discarded and
+    # nothing it did is visible or flushed.
+
+    def __init__(self, store):
+        self.store = store
+        self._copies = {"players": {}, "mills": {}, "plants": {}}
+        self._saved = {"players": set(), "mills": set(), "plants": set()}
+        self._fills = []
+
+    def _get(self, kind, key, getter):
+        copies = self._copies[kind]
+        if key not in copies:
+            rec = getter(key)
+            copies[key] = copy.deepcopy(rec) if rec is not None else None
+        return copies[key]
+
+    def get_player(self, user_id):
+        return self._get("players", user_id, self.store.get_player)
+
+    def save_player(self, user_id):
+        self._saved["players"].add(user_id)
+
+    def get_mill(self, user_id):
+        return self._get("mills", user_id, self.store.get_mill)
+
+    def save_mill(self, user_id):
+        self._saved["mills"].add(user_id)
+
+    def get_plant(self, user_id):
+        return self._get("plants", user_id, self.store.get_plant)
+
+    def save_plant(self, user_id):
+        self._saved["plants"].add(user_id)
+
+    def fill_listing(self, listing_id, amount):
+        # Applied to the order book on commit, with the records
+        self._fills.append((listing_id, amount))
+
+    def commit(self):
+        store = self.store
+        targets = {
+            "players": (store.players, store.save_player),
+            "mills": (store.mills, store.save_mill),
+            "plants": (store.plants, store.save_plant),
+        }
+        for kind, keys in self._saved.items():
+            cache, save = targets[kind]
+            for key in keys:
+                rec = self._copies[kind].get(key)
+                if rec is not None:
+                    cache[key] = rec
+                    save(key)
+        for listing_id, amount in self._fills:
+            store.fill_listing(listing_id, amount)
+
+
+class Store:
+    # Resident view of every farm, mill and market listing. Handlers fetch a
+    # record, mutate it in place and call save_*(); the flusher coalesces all
+    # changes made since the last flush into one backend write.
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._flusher = None
+        self._busy = None
+        # Held by the flusher, exports and restores, which mustn't overlap
+        self._maintenance = asyncio.Lock()
+        # While a restore swaps files, changes stay dirty instead of being
+        # written over it (they're dropped by the reload)
+        self._restoring = False
+        self.reload()
+
+    def reload(self):
+        # Re-read from the backend, dropping any unflushed changes
+        with METRICS.timed("storage", "load_all"):
+            self.players, self.mills, self.plants, listings = self.backend.load()
+        self.market = OrderBook(listings)
+        self.dirty_players = set()
+        self.dirty_mills = set()
+        self.dirty_plants = set()
+        self.dirty_listings = set()
+        self.mill_ids = {}
+        # Empty until load_rankings() has read every farm and mill
+        self.player_ranks = {field: Ranking() for field in PLAYER_COLUMNS}
+        self.mill_ranks = {field: Ranking() for field in MILL_COLUMNS}
+        self._reranked = None
+        self._index_mills()
+        self._upgrade()
+
+    def _upgrade(self):
+        # Bring resident records written by older versions up to date (see
+        # schema.py) and save them, so the next start finds them current,
+        # then hold them as records (see records.py). The dicts are shared
+        # with the backend, so the records replace the dicts in place. Lazy
+        # backends' records are upgraded as they're read.
+        for user_id, player in self.players.items():
+            self.players[user_id], changed = upgrade(player, migrate_player, Player)
+            if changed:
+                self.dirty_players.add(user_id)
+        for user_id, mill in self.mills.items():
+            self.mills[user_id], changed = upgrade(mill, migrate_mill, Mill)
+            if changed:
+                self.dirty_mills.add(user_id)
+        for listing_id, listing in self.market.listings.items():
+            self.market.listings[listing_id], changed = upgrade(listing, migrate_listing, Listing)
+            if changed:
+                self.dirty_listings.add(int(listing_id))
+
+    def _index_mills(self):
+        # Map every short mill id to its owner, giving mills created before
+        # ids existed one (in owner order, so the result is deterministic)
+        if hasattr(self.backend, "find_mill_owner"):
+            legacy = self.backend.mills_without_id()
+        else:
+            legacy = []
+            for user_id, mill in self.mills.items():
+                if mill.get("mill_id"):
+                    self.mill_ids[mill["mill_id"]] = user_id
+                else:
+                    legacy.append((user_id, mill))
+        for user_id, mill in sorted(legacy, key=lambda x: x[0]):
+            mill["mill_id"] = self.allocate_mill_id(user_id)
+            self.add_mill(user_id, mill)
+
+    async def load_rankings(self):
+        # Rank every farm and mill. The scores are read on the I/O thread
+        # (SQLite has them in indexed columns, other backends decode what
+        # isn't resident there); records saved meanwhile are ranked again
+        # once the new rankings are in.
+        self._reranked = set()
+        if hasattr(self.backend, "iter_player_scores"):
+            backend = self.backend
+            player_rows, mill_rows = await run_io(
+                lambda: (list(backend.iter_player_scores()), list(backend.iter_mill_scores()))
+            )
+        else:
+            player_rows = await self.scan_players(lambda uid, p: (uid, *(p.get(f, 0) for f in PLAYER_COLUMNS)))
+            mill_rows = await self.scan_mills(lambda uid, m: (uid, *(m.get(f, 0) for f in MILL_COLUMNS)))
+        self.player_ranks = {
+            field: Ranking((row[0], row[i]) for row in player_rows) for i, field in enumerate(PLAYER_COLUMNS, 1)
+        }
+        self.mill_ranks = {
+            field: Ranking((row[0], row[i]) for row in mill_rows) for i, field in enumerate(MILL_COLUMNS, 1)
+        }
+        reranked, self._reranked = self._reranked, None
+        for kind, key in reranked:
+            if kind == "players":
+                self._rerank(self.player_ranks, self.players.get(key), key)
+            else:
+                self._rerank(self.mill_ranks, self.mills.get(key), key)
+
+    def _rerank(self, ranks, rec, key):
+        if self._reranked is not None:
+            self._reranked.add(("players" if ranks is self.player_ranks else "mills", key))
+        for field, ranking in ranks.items():
+            if rec is None:
+                ranking.discard(key)
+            else:
+                ranking.update(key, rec.get(field, 0))
+
+    def _lookup(self, cache, key, loader, migrate=None, record=None, dirty=None, keep=True):
+        # Misses go to the backend: lazy backends read the row, eager ones
+        # bring the farm back from their cold archive. With keep=False the
+        # record is only read, not cached.
+        rec = cache.get(key)
+        if rec is None and loader is not None and key is not None:
+            with METRICS.timed("storage", "load"):
+                rec = loader(key)
+            if rec is not None:
+                if migrate is not None:
+                    rec, changed = upgrade(rec, migrate, record)
+                    if changed and keep:
+                        dirty.add(key)
+                if keep:
+                    cache[key] = rec
+        return rec
+
+    # Players
+    def get_player(self, user_id):
+        return self._lookup(
+            self.players, user_id, getattr(self.backend, "load_player", None), migrate_player, Player,
+            self.dirty_players,
+        )
+
+    def peek_player(self, user_id):
+        # For looking only (leaderboards): a farm that isn't resident is read
+        # without coming back into the working set. Don't change or save it.
+        return self._lookup(
+            self.players, user_id, getattr(self.backend, "load_player", None), migrate_player, Player, keep=False
+        )
+
+    def add_player(self, user_id, player):
+        # Returns the farm as stored, a Player
+        player, _ = upgrade(player, migrate_player, Player)
+        player.setdefault("last_seen", epoch_today())
+        self.players[user_id] = player
+        self.save_player(user_id)
+        return player
+
+    def touch(self, user_id):
+        # Note that user_id used the bot today, fetching their farm back into
+        # the working set if it had gone idle
+        player = self.get_player(user_id)
+        if player is not None and player.get("last_seen") != epoch_today():
+            player["last_seen"] = epoch_today()
+            self.save_player(user_id)
+        return player
+
+    def save_player(self, user_id):
+        self.dirty_players.add(user_id)
+        self._rerank(self.player_ranks, self.players.get(user_id), user_id)
+
+    def iter_players(self):
+        # Records that aren't resident are upgraded for the caller only
+        if self.backend.eager:
+            yield from list(self.players.items())
+            for user_id, rec in self.backend.iter_cold():
+                yield user_id, upgrade(rec, migrate_player, Player)[0]
+            return
+        self.flush()
+        for user_id, rec in self.backend.iter_players():
+            resident = self.players.get(user_id)
+            yield user_id, resident if resident is not None else upgrade(rec, migrate_player, Player)[0]
+
+    async def scan_players(self, pick):
+        # [pick(user_id, farm)] over every farm, leaving out Nones, without
+        # holding up the event loop the way iter_players() does. pick runs on
+        # the I/O thread for farms that aren't resident, so it should only
+        # read the farm.
+        return await self._scan(self.players, "scan_players", migrate_player, Player, pick)
+
+    async def _scan(self, cache, scan, migrate, record, pick):
+        picked = []
+        # Keeps restores and archiving from swapping files under the scan
+        async with self._maintenance:
+            resident = list(cache.items())
+            seen = set(cache)
+            rows = getattr(self.backend, scan, tuple)()
+            for n, (key, rec) in enumerate(resident, 1):
+                value = pick(key, rec)
+                if value is not None:
+                    picked.append(value)
+                if n % SCAN_BATCH == 0:
+                    await asyncio.sleep(0)
+
+            def job():
+                found = []
+                for key, rec in rows:
+                    if key not in seen:
+                        value = pick(key, upgrade(rec, migrate, record)[0])
+                        if value is not None:
+                            found.append(value)
+                return found
+
+            picked += await run_io(job)
+        return picked
+
+    def top_players(self, field, n):
+        # Top n players with a positive value of field, highest first
+        return [(uid, self.peek_player(uid)) for uid, _ in self.player_ranks[field].top(n, positive=True)]
+
+    def player_rank(self, field, user_id):
+        # (rank, score, ranked players) for user_id on field
+        ranking = self.player_ranks[field]
+        return ranking.rank(user_id), ranking.score(user_id), len(ranking)
+
+    # Feed mills
+    def get_mill(self, user_id):
+        return self._lookup(
+            self.mills, user_id, getattr(self.backend, "load_mill", None), migrate_mill, Mill, self.dirty_mills
+        )
+
+    def add_mill(self, user_id, mill):
+        mill, _ = upgrade(mill, migrate_mill, Mill)
+        self.mills[user_id] = mill
+        self.save_mill(user_id)
+        if mill.get("mill_id"):
+            self.mill_ids[mill["mill_id"]] = user_id
+        return mill
+
+    def find_mill_owner(self, mill_id):
+        owner = self.mill_ids.get(mill_id)
+        if owner is None and hasattr(self.backend, "find_mill_owner"):
+            owner = self.backend.find_mill_owner(mill_id)
+            if owner is not None:
+                self.mill_ids[mill_id] = owner
+        return owner
+
+    def allocate_mill_id(self, user_id):
+        return short_mill_id(user_id, lambda mill_id: self.find_mill_owner(mill_id) not in (None, user_id))
+
+    def peek_mill(self, user_id):
+        return self._lookup(self.mills, user_id, getattr(self.backend, "load_mill", None), migrate_mill, Mill, keep=False)
+
+    def save_mill(self, user_id):
+        self.dirty_mills.add(user_id)
+        self._rerank(self.mill_ranks, self.mills.get(user_id), user_id)
+
+    def iter_mills(self):
+        if self.backend.eager:
+            yield from self.mills.items()
+            return
+        self.flush()
+        for user_id, rec in self.backend.iter_mills():
+            resident = self.mills.get(user_id)
+            yield user_id, resident if resident is not None else upgrade(rec, migrate_mill, Mill)[0]
+
+    async def scan_mills(self, pick):
+        return await self._scan(self.mills, "scan_mills", migrate_mill, Mill, pick)
+
+    def top_mills(self, n):
+        return [(uid, self.peek_mill(uid)) for uid, _ in self.mill_ranks["royalty_points"].top(n)]
+
+    # Pork plants (kept in the feed data, keyed by user id)
+    def get_plant(self, user_id):
+        return self._lookup(self.plants, user_id, getattr(self.backend, "load_plant", None))
+
+    def save_plant(self, user_id):
+        self.dirty_plants.add(user_id)
+
+    # Feed market (see orderbook.py)
+    def add_listing(self, listing):
+        listing, _ = upgrade(listing, migrate_listing, Listing)
+        listing_id = self.market.add(listing)
+        self.dirty_listings.add(listing_id)
+        return listing_id
+
+    def fill_listing(self, listing_id, amount):
+        self.market.fill(listing_id, amount)
+        self.dirty_listings.add(listing_id)
+
+    def unfill_listing(self, listing, amount):
+        self.market.unfill(listing, amount)
+        self.dirty_listings.add(listing["id"])
+
+    def remove_listing(self, listing_id):
+        self.dirty_listings.add(listing_id)
+        return self.market.remove(listing_id)
+
+    @contextmanager
+    def transaction(self):
+        # with STORE.transaction() as tx: ... -- all-or-nothing changes; the
+        # next flush writes them in a single atomic batch
+        tx = Transaction(self)
+        yield tx
+        tx.commit()
+
+    def is_dirty(self):
+        return bool(self.dirty_players or self.dirty_mills or self.dirty_plants or self.dirty_listings)
+
+    def _take_dirty(self):
+        if self._restoring or not self.is_dirty():
+            return None
+        players = {uid: self.players.get(uid) for uid in self.dirty_players}
+        mills = {uid: self.mills.get(uid) for uid in self.dirty_mills}
+        # Catch changes made after the last save_*() call
+        for uid, rec in players.items():
+            self._rerank(self.player_ranks, rec, uid)
+        for uid, rec in mills.items():
+            self._rerank(self.mill_ranks, rec, uid)
+        plants = {uid: self.plants.get(uid) for uid in self.dirty_plants}
+        listings = {str(i): self.market.get(i) for i in self.dirty_listings}
+        self.dirty_players, self.dirty_mills, self.dirty_plants = set(), set(), set()
+        self.dirty_listings = set()
+        return players, mills, plants, listings
+
+    def _redirty(self, batch):
+        # Keep everything dirty so the next flush retries it
+        players, mills, plants, listings = batch
+        self.dirty_players.update(players)
+        self.dirty_mills.update(mills)
+        self.dirty_plants.update(plants)
+        self.dirty_listings.update(int(i) for i in listings)
+
+    def flush(self):
+        # Write dirty state and wait for it, blocking the caller
+        batch = self._take_dirty()
+        if batch is None:
+            return
+        try:
+            with METRICS.timed("storage", "save"):
+                job = self.backend.write(*batch)
+                if job is not None:
+                    IO_EXECUTOR.submit(job).result()
+        except Exception:
+            self._redirty(batch)
+            raise
+
+    async def flush_async(self):
+        # Same as flush(), but the write runs on the I/O thread while the
+        # event loop keeps serving other updates
+        batch = self._take_dirty()
+        if batch is None:
+            return
+        try:
+            with METRICS.timed("storage", "save"):
+                job = self.backend.write(*batch)
+                if job is not None:
+                    await run_io(job)
+        except Exception:
+            self._redirty(batch)
+            raise
+
+    async def compact(self):
+        if not hasattr(self.backend, "compact"):
+            return
+        with METRICS.timed("storage", "compact"):
+            finish = await run_io(self.backend.compact())
+            if finish is not None:
+                finish()
+
+    async def export_json(self, directory=None):
+        # Current players.json/feed_data.json for backups. Backends that keep
+        # them as files return those; the others write them to directory.
+        async with self._maintenance:
+            await self.flush_async()
+            await self.compact()
+            if directory is None:
+                directory = tempfile.mkdtemp(prefix="pigfarm-export-")
+            else:
+                os.makedirs(directory, exist_ok=True)
+            return await run_io(self.backend.export_json(directory))
+
+    async def restore_json(self, file_name, path):
+        # Swap a checked upload (see schema.py) at path in for players.json
+        # or feed_data.json and reload everything from the backend. The file
+        # is renamed over the live one (or the backend's rebuilt files are),
+        # so it's never seen half-written; changes made while the restore
+        # runs are dropped, the restored file wins.
+        live = self.backend.restored_file(file_name)
+        async with self._maintenance:
+            await self.flush_async()
+            self._restoring = True
+            try:
+                # Never decoded whole: swapped in as a file, or read a record
+                # at a time by the backend's job
+                if live is not None:
+                    await run_io(os.replace, path, live)
+                job = self.backend.import_json(file_name, path)
+                if job is not None:
+                    await run_io(job)
+                self.reload()
+            finally:
+                self._restoring = False
+        await self.load_rankings()
+
+    async def retire_idle(self, days=COLD_AFTER_DAYS):
+        # Drop farms unused for `days` days from the working set. Farms with
+        # unflushed changes, or that a running command holds (self._busy),
+        # stay put.
+        if not days:
+            return 0
+        cutoff = epoch_today() - days
+        busy = self._busy or (lambda user_id: False)
+        idle = [
+            uid for uid, p in self.players.items()
+            if p.get("last_seen", 0) < cutoff and uid not in self.dirty_players and not busy(uid)
+        ]
+        # Nobody fed these pigs yesterday or today, so their streaks have
+        # lapsed. Clear them here, or the midnight reset (daily.py) would
+        # fetch the farms back to do it; they leave with the next sweep,
+        # once the change is written.
+        lapsed = {uid for uid in idle if self.players[uid].get("streak")}
+        for uid in lapsed:
+            self.players[uid]["streak"] = 0
+            self.save_player(uid)
+        idle = [uid for uid in idle if uid not in lapsed]
+        if not idle:
+            return 0
+        if self.backend.eager:
+            archive = getattr(self.backend, "archive", None)
+            if archive is None or not self.backend.cold_file:
+                return 0
+            # Shares self.players, so the farms leave it right away; the
+            # backend serves them to get_player() until they're in the pack
+            with METRICS.timed("storage", "archive"):
+                finish = await run_io(archive(idle))
+                finish()
+        else:
+            for uid in idle:
+                del self.players[uid]
+                # The pack backend's mills and plants are the backend's own
+                # dicts; dropping them there would delete them
+                if self.backend.eager_feed:
+                    continue
+                if uid not in self.dirty_mills:
+                    self.mills.pop(uid, None)
+                if uid not in self.dirty_plants:
+                    self.plants.pop(uid, None)
+        return len(idle)
+
+    async def compact_if_needed(self):
+        needs_compaction = getattr(self.backend, "needs_compaction", None)
+        if needs_compaction and needs_compaction():
+            await self.compact()
+
+    async def _flush_loop(self, interval):
+        next_retire = time.monotonic() + RETIRE_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with self._maintenance:
+                    await self.flush_async()
+                    await self.compact_if_needed()
+                    if time.monotonic() >= next_retire:
+                        next_retire = time.monotonic() + RETIRE_INTERVAL
+                        retired = await self.retire_idle()
+                        if retired:
+                            print(f"🧊 Moved {retired} idle farms out of the working set")
+            except Exception as e:
+                print(f"⚠️ Flush failed, will retry: {e}")
+
+    def start(self, interval=FLUSH_INTERVAL, busy=None):
+        # busy(user_id) tells whether a command is using that farm right now
+        self._busy = busy
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop(interval))
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush_async()
+        await self.compact_if_needed()
+
+
+def import_json_files(data_file, feed_file, db_file):
+    # One-shot import of the JSON files into a SQLite database
+    backend = SqliteBackend(db_file)
+    for file_name, path in (("players.json", data_file), ("feed_data.json", feed_file)):
+        if os.path.exists(path):
+            backend.import_json(file_name, path)()
+    counts = tuple(backend.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                   for table in ("players", "mills", "market"))
+    backend.close()
+    return counts
+
+
+if __name__ == "__main__":
+    # python storage.py import [players.json] [feed_data.json] [pigfarm.db]
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("Usage: python storage.py import [players.json] [feed_data.json] [pigfarm.db]")
+        sys.exit(1)
+    args = sys.argv[2:] + ["players.json", "feed_data.json", DB_FILE][len(sys.argv) - 2:]
+    n_players, n_mills, n_listings = import_json_files(*args[:3])
+    print(f"✅ Imported {n_players} players, {n_mills} mills and {n_listings} listings into {args[2]}")
@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+
+# The bot reads this at import
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = ("json", "journal", "pack", "sqlite")
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The bot keeps its files in the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def make_store(workdir, monkeypatch):
+    # make_store(backend, players={uid: farm}, feed={...}) opens a Store on
+    # players.json/feed_data.json in workdir, as the bot does
+    import storage
+
+    stores = []
+
+    def make(backend="json", players=None, feed=None):
+        monkeypatch.setattr(storage, "STORAGE_BACKEND", backend)
+        if players is not None:
+            with open("players.json", "w") as f:
+                json.dump(players, f, indent=2)
+        if feed is not None:
+            with open("feed_data.json", "w") as f:
+                json.dump(feed, f, indent=2)
+        store = storage.Store(storage.open_backend("players.json", "feed_data.json"))
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.backend.close()
+
+
+@pytest.fixture
+def bot(make_store, monkeypatch):
+    # The bot module with a fresh json store of its own
+    import bot
+
+    monkeypatch.setattr(bot, "STORE", make_store())
+    return bot
+
+
+class FakeChat:
+    # Stands in for the message, chat and bot a handler answers through, and
+    # keeps what it was sent
+    username = "PigFarmTestBot"
+
+    def __init__(self, user_id):
+        self.id = self.chat_id = int(user_id)
+        self.chat = self
+        self.bot = self
+        self.document = None
+        self.message_id = 1
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+        return self
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.sent.append(text)
+        return self
+
+    async def edit_message_text(self, text, **kwargs):
+        self.sent.append(text)
+        return True
+
+    async def reply_document(self, **kwargs):
+        self.sent.append(("document", kwargs.get("filename")))
+        return self
+
+    async def send_action(self, **kwargs):
+        pass
+
+
+@pytest.fixture
+def send():
+    # await send(handler, user_id, *args) runs a command handler and returns
+    # the replies it sent
+    async def send(handler, user_id, *args):
+        chat = FakeChat(user_id)
+        user = types.SimpleNamespace(id=int(user_id), username=f"farmer{user_id}", first_name="Farmer")
+        update = types.SimpleNamespace(effective_user=user, effective_chat=chat, message=chat)
+        context = types.SimpleNamespace(args=[str(a) for a in args], bot=chat, user_data={}, application=None)
+        await handler(update, context)
+        return chat.sent
+
+    return send
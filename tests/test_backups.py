@@ -0,0 +1,116 @@
+import asyncio
+import gzip
+import json
+import os
+import zipfile
+
+import backups
+from backups import Backups, chunk_bounds, missing_chunks, prune, restore, snapshot
+
+
+def players_json(players):
+    return json.dumps(players, indent=2).encode()
+
+
+def farms(ids):
+    return {str(uid): {"username": f"u{uid}", "coins": uid % 97} for uid in ids}
+
+
+def chunks(data):
+    return [data[start:end] for start, end in chunk_bounds(data)]
+
+
+def test_chunks_cover_the_file():
+    data = players_json(farms(range(1000, 1500)))
+    bounds = list(chunk_bounds(data))
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(data)
+    assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+    assert 3 < len(bounds) < 100
+
+
+def test_inserting_a_farm_only_changes_its_own_chunk():
+    before = farms(range(1000, 1500, 2))
+    after = dict(before)
+    after["1251"] = {"username": "new", "coins": 1}
+    after = dict(sorted(after.items()))
+    old, new = chunks(players_json(before)), chunks(players_json(after))
+    assert len(set(new) - set(old)) == 1
+    assert len(set(old) - set(new)) == 1
+
+
+def test_long_runs_without_records_are_cut_at_chunk_max(monkeypatch):
+    monkeypatch.setattr(backups, "CHUNK_MAX", 100)
+    bounds = list(chunk_bounds(b"x" * 250))
+    assert bounds == [(0, 100), (100, 200), (200, 250)]
+
+
+def test_snapshot_stores_only_new_chunks_and_restores(workdir):
+    with open("players.json", "wb") as f:
+        f.write(players_json(farms(range(1000, 1400))))
+    path, manifest, new, _ = snapshot(["players.json"], "b")
+    assert len(new) == len(manifest["files"]["players.json"]["chunks"])
+    assert snapshot(["players.json"], "b")[2] == []
+
+    players = farms(range(1000, 1400))
+    players["1200"]["coins"] = 5000
+    with open("players.json", "wb") as f:
+        f.write(players_json(players))
+    _, second, new, _ = snapshot(["players.json"], "b")
+    assert len(new) == 1
+    assert missing_chunks(second, manifest) == new
+
+    restore(manifest, "old", "b")
+    with open("old/players.json") as f:
+        assert json.load(f) == farms(range(1000, 1400))
+    restore(second, "new", "b")
+    with open("new/players.json") as f:
+        assert json.load(f)["1200"]["coins"] == 5000
+
+
+def test_prune_drops_chunks_no_kept_manifest_uses(workdir):
+    for i in range(3):
+        with open("players.json", "wb") as f:
+            f.write(players_json({"1": {"coins": i}}))
+        snapshot(["players.json"], "b")
+    assert prune("b", keep=1) == 2
+    assert len(os.listdir("b/manifests")) == 1
+
+
+def test_backup_zips_hold_what_the_last_sent_one_lacks(make_store):
+    store = make_store(players={}, feed={"mills": {}, "market": []})
+    for uid in range(1000, 1300):
+        store.add_player(str(uid), {"username": f"u{uid}", "coins": 1})
+    store.flush()
+    keeper = Backups("b")
+
+    def archive(full=False):
+        return asyncio.run(keeper.archive(store, full))
+
+    def zipped_chunks(path):
+        with zipfile.ZipFile(path) as z:
+            return [n for n in z.namelist() if n.startswith("chunks")]
+
+    [first], summary, sent = archive()
+    assert "no earlier backup was sent" in summary
+    full_chunks = zipped_chunks(first)
+    sent()
+    assert archive()[0] == []
+
+    store.get_player("1100").coins = 99
+    store.save_player("1100")
+    store.flush()
+    [delta], summary, sent = archive()
+    unsent = zipped_chunks(delta)
+    assert 1 <= len(unsent) < len(full_chunks)
+
+    # That zip never reached the admin, so the next one carries its chunks too
+    store.get_player("1250").coins = 77
+    store.save_player("1250")
+    store.flush()
+    [delta], summary, sent = archive()
+    assert set(unsent) < set(zipped_chunks(delta))
+
+    paths, _, sent = archive(full=True)
+    assert sent is None
+    with gzip.open([p for p in paths if p.endswith("players.json.gz")][0]) as f:
+        assert json.load(f)["1100"]["coins"] == 99
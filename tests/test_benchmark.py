@@ -0,0 +1,42 @@
+import asyncio
+import json
+import types
+
+import benchmark
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert benchmark.percentile(values, 50) == 51
+    assert benchmark.percentile(values, 99) == 99
+    assert benchmark.percentile([7], 99) == 7
+    assert benchmark.percentile([], 50) is None
+
+
+def test_generated_datasets_are_repeatable(workdir):
+    benchmark.generate(30, "a", seed=3)
+    benchmark.generate(30, "b", seed=3)
+    with open("a/players.json") as f:
+        players = json.load(f)
+    with open("b/players.json") as f:
+        assert json.load(f) == players
+    assert len(players) == 30 and str(benchmark.FIRST_USER_ID) in players
+
+
+def test_a_raising_command_is_counted_as_an_error(make_store):
+    async def feed(update, context):
+        raise ValueError("no pig")
+
+    async def mark_active(update, context):
+        pass
+
+    fake = types.SimpleNamespace(feed=feed, mark_active=mark_active, STORE=make_store(players={}))
+    result = asyncio.run(benchmark.bench_command(fake, "feed", [("1", [])] * 3, 1))
+    assert result["calls"] == 3 and result["errors"] == 3
+    assert result["error_messages"] == {"ValueError: no pig": 3}
+
+
+def test_the_handlers_run_cleanly_on_a_generated_dataset(bot):
+    commands = ("feed", "myfarm", "breed", "buyfeed", "topbrands", "tonlog")
+    run = asyncio.run(benchmark.bench_dataset(bot, 50, commands, 20, 4, 1))
+    assert {name: result["errors"] for name, result in run["commands"].items()} == dict.fromkeys(commands, 0)
@@ -0,0 +1,55 @@
+import asyncio
+import types
+
+
+def test_a_failed_reply_doesnt_undo_a_mill_upgrade(bot, send):
+    async def failing_reply(text, **kwargs):
+        raise RuntimeError("Telegram is down")
+
+    async def main():
+        bot.STORE.add_player("1", {"coins": 50})
+        await send(bot.startmill, 1)
+        user = types.SimpleNamespace(id=1, username="farmer1", first_name="Farmer")
+        update = types.SimpleNamespace(effective_user=user, message=types.SimpleNamespace(reply_text=failing_reply))
+        try:
+            await bot.upgrademill(update, types.SimpleNamespace(args=[]))
+        except RuntimeError:
+            pass
+
+    asyncio.run(main())
+    assert bot.STORE.get_mill("1").level == 1
+    assert bot.STORE.get_player("1").coins == 40
+
+
+def test_mill_upgrade_refused_without_coins(bot, send):
+    async def main():
+        bot.STORE.add_player("1", {"coins": 0})
+        await send(bot.startmill, 1)
+        return await send(bot.upgrademill, 1)
+
+    assert "You need 10 coins" in asyncio.run(main())[0]
+    assert bot.STORE.get_mill("1").level == 0
+
+
+def test_page_bounds_clamp_to_the_pages_there_are(bot):
+    assert bot.page_bounds(1, 0) == (1, 1, 0)
+    assert bot.page_bounds(2, 25) == (2, 3, 10)
+    assert bot.page_bounds(9, 25) == (3, 3, 20)
+    assert bot.page_bounds(-1, 25) == (1, 3, 0)
+    assert bot.page_arg(["3"]) == 3 and bot.page_arg(["x"]) == 1 and bot.page_arg([]) == 1
+
+
+def test_page_buttons_only_link_pages_that_exist(bot):
+    assert bot.page_buttons("tasks", 1, 1) is None
+    [buttons] = bot.page_buttons("tasks", 2, 3).inline_keyboard
+    assert [b.callback_data for b in buttons] == ["tasks:1", "tasks:3"]
+
+
+def test_feedmarket_shows_one_page_of_listings(bot, send):
+    for i in range(25):
+        bot.STORE.add_listing({"seller_id": str(100 + i), "amount": 1, "price": i + 1, "type": "normal",
+                               "brand": f"Mill {i + 1}", "emoji": "🏭", "slogan": "", "sales": 0})
+
+    [text] = asyncio.run(send(bot.feedmarket, 1, 3))
+    assert "25 listings), page 3/3" in text
+    assert "21. 🏭 Mill 21" in text and "25. 🏭 Mill 25" in text and "Mill 20 " not in text
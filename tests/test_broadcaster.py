@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+from broadcaster import Broadcaster, TokenBucket
+
+
+class FakeBot:
+    def __init__(self, blocked=(), retry_once=()):
+        self.blocked = set(blocked)
+        self.retry_once = set(retry_once)
+        self.sent = []
+        self.progress = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == 999:
+            self.progress.append(text)
+            return type("Message", (), {"message_id": 1})
+        if chat_id in self.retry_once:
+            self.retry_once.discard(chat_id)
+            raise RetryAfter(0.01)
+        if chat_id in self.blocked:
+            raise Forbidden("bot was blocked by the user")
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.progress.append(text)
+
+
+def farms(*ids, **extra):
+    return {uid: {"username": f"u{uid}", **extra.get(uid, {})} for uid in ids}
+
+
+def test_broadcast_reaches_everyone_and_marks_who_blocked_the_bot(make_store):
+    store = make_store(players=farms("1", "2", "3", "4", "admin", **{"4": {"blocked": True}}))
+    bot = FakeBot(blocked={2}, retry_once={3})
+    broadcaster = Broadcaster(path="broadcast.json")
+
+    async def main():
+        broadcaster.start(store, bot, 999, "Hello")
+        await broadcaster.task
+
+    asyncio.run(main())
+    assert sorted(bot.sent) == [1, 3]
+    assert store.get_player("2").blocked
+    assert bot.progress[-1].startswith("✅ Broadcast finished!")
+    assert "✅ Sent: 2" in bot.progress[-1] and "🚫 Blocked: 1" in bot.progress[-1]
+    assert not os.path.exists("broadcast.json")
+
+
+def test_an_interrupted_broadcast_resumes_after_its_cursor(make_store):
+    store = make_store(players=farms("1", "2", "3"))
+    state = {"text": "Hi", "admin_chat": 999, "cursor": "2", "total": 3, "sent": 2, "blocked": 0, "failed": 0}
+    with open("broadcast.json", "w") as f:
+        json.dump(state, f)
+    bot = FakeBot()
+    broadcaster = Broadcaster(path="broadcast.json")
+
+    async def main():
+        broadcaster.resume(store, bot)
+        await broadcaster.task
+
+    asyncio.run(main())
+    assert bot.sent == [3]
+    assert "📬 3/3 players" in bot.progress[-1]
+
+
+def test_token_bucket_holds_to_its_rate():
+    async def main():
+        bucket = TokenBucket(200, burst=5)
+        start = time.monotonic()
+        for _ in range(25):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # 5 from the burst, the other 20 at 200 a second
+    assert asyncio.run(main()) >= 0.09
@@ -0,0 +1,40 @@
+import asyncio
+
+from daily import reset_streaks
+from storage import epoch_today
+
+TODAY = epoch_today()
+
+
+def farm(streak, last_fed, **fields):
+    return {"streak": streak, "pig": {"last_fed": last_fed, "fed_bits": 1}, **fields}
+
+
+def test_streaks_lapse_when_the_pig_missed_yesterday(make_store):
+    store = make_store(players={})
+    store.add_player("1", farm(5, TODAY))
+    store.add_player("2", farm(3, TODAY - 1))
+    store.add_player("3", farm(4, TODAY - 2))
+    store.add_player("4", farm(0, TODAY - 9))
+    asyncio.run(store.load_rankings())
+
+    assert asyncio.run(reset_streaks(store, TODAY)) == 1
+    assert [store.get_player(uid).streak for uid in "1234"] == [5, 3, 0, 0]
+    assert store.player_rank("streak", "3") == (3, 0, 4)
+
+
+def test_idle_farms_lose_their_streak_on_the_way_out(make_store):
+    store = make_store(players={})
+    store.add_player("1", farm(4, TODAY - 60, last_seen=TODAY - 60))
+    store.flush()
+    asyncio.run(store.load_rankings())
+
+    # First sweep clears the streak and keeps the farm until that's written
+    assert asyncio.run(store.retire_idle()) == 0
+    assert store.get_player("1").streak == 0
+    store.flush()
+    assert asyncio.run(store.retire_idle()) == 1
+
+    # So the midnight reset has nothing to fetch back
+    assert asyncio.run(reset_streaks(store, TODAY)) == 0
+    assert "1" not in store.players
@@ -0,0 +1,77 @@
+import asyncio
+import types
+
+from dispatch import UserLocks, per_user
+
+
+def update_from(user_id):
+    return types.SimpleNamespace(effective_user=types.SimpleNamespace(id=user_id))
+
+
+def test_same_user_runs_in_arrival_order():
+    async def main():
+        order = []
+        gate = asyncio.Event()
+
+        async def slow(update, context):
+            await gate.wait()
+            order.append("first")
+
+        async def quick(update, context):
+            order.append("second")
+
+        first = asyncio.create_task(per_user(slow)(update_from(1), None))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(per_user(quick)(update_from(1), None))
+        await asyncio.sleep(0.01)
+        assert order == []
+        gate.set()
+        await asyncio.gather(first, second)
+        return order
+
+    assert asyncio.run(main()) == ["first", "second"]
+
+
+def test_different_users_run_in_parallel():
+    async def main():
+        gate = asyncio.Event()
+        done = []
+
+        async def waits(update, context):
+            await gate.wait()
+
+        async def other(update, context):
+            done.append(update.effective_user.id)
+
+        blocked = asyncio.create_task(per_user(waits)(update_from(1), None))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(per_user(other)(update_from(2), None), 1)
+        gate.set()
+        await blocked
+        return done
+
+    assert asyncio.run(main()) == [2]
+
+
+def test_locks_are_dropped_once_released():
+    locks = UserLocks()
+
+    async def main():
+        async with locks.hold("1", "2"):
+            assert locks.busy("1") and locks.busy("2")
+        return len(locks), locks.busy("1")
+
+    assert asyncio.run(main()) == (0, False)
+
+
+def test_crossed_multi_user_holds_dont_deadlock():
+    locks = UserLocks()
+
+    async def trade(a, b):
+        async with locks.hold(a, b):
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.wait_for(asyncio.gather(trade("1", "2"), trade("2", "1")), 1)
+
+    asyncio.run(main())
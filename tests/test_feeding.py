@@ -0,0 +1,51 @@
+from datetime import date
+
+from feeding import FED_WINDOW, epoch_day, fed_every_day, fed_on, mark_fed, migrate_pig
+from records import Pig
+
+
+def pig(**fields):
+    return Pig(**{"last_fed": None, "fed_bits": 0, **fields})
+
+
+def test_mark_fed_remembers_each_day():
+    p = pig()
+    for day in (100, 101, 103):
+        mark_fed(p, day)
+    assert [fed_on(p, day) for day in range(99, 105)] == [False, True, True, False, True, False]
+    assert p.last_fed == 103
+
+
+def test_a_late_meal_for_an_earlier_day_is_recorded():
+    p = pig()
+    mark_fed(p, 110)
+    mark_fed(p, 108)
+    assert p.last_fed == 110 and fed_on(p, 108) and not fed_on(p, 109)
+
+
+def test_days_older_than_the_window_are_forgotten():
+    p = pig()
+    mark_fed(p, 100)
+    mark_fed(p, 100 + FED_WINDOW)
+    assert p.fed_bits == 1 and not fed_on(p, 100)
+    mark_fed(p, 300)
+    assert p.fed_bits == 1 and p.last_fed == 300
+
+
+def test_fed_every_day_needs_an_unbroken_run_ending_today():
+    p = pig()
+    for day in (10, 11, 12):
+        mark_fed(p, day)
+    assert fed_every_day(p, 12, 3)
+    assert not fed_every_day(p, 12, 4)
+    assert not fed_every_day(p, 13, 3)
+
+
+def test_migrate_pig_converts_fed_dates():
+    data = {"fed_dates": ["2024-05-01", "2024-05-03", "bad", None]}
+    assert migrate_pig(data)
+    assert "fed_dates" not in data
+    p = Pig(**data)
+    assert p.last_fed == epoch_day(date(2024, 5, 3))
+    assert fed_on(p, epoch_day(date(2024, 5, 1))) and not fed_on(p, epoch_day(date(2024, 5, 2)))
+    assert not migrate_pig(data)
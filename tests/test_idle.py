@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from conftest import BACKENDS
+from storage import epoch_today
+
+
+def store_with_idle_farm(make_store, backend):
+    store = make_store(backend, players={})
+    store.add_player("1", {"coins": 5, "last_seen": epoch_today() - 90})
+    store.add_player("2", {"coins": 8})
+    store.flush()
+    assert asyncio.run(store.retire_idle()) == 1
+    return store
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_idle_farms_leave_the_working_set(make_store, backend):
+    store = store_with_idle_farm(make_store, backend)
+    assert "1" not in store.players and "2" in store.players
+    assert store.get_player("1").coins == 5
+    assert "1" in store.players
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_peeking_at_an_idle_farm_leaves_it_out(make_store, backend):
+    store = store_with_idle_farm(make_store, backend)
+    assert store.peek_player("1").coins == 5
+    assert "1" not in store.players
+    asyncio.run(store.load_rankings())
+    assert [uid for uid, _ in store.top_players("coins", 5)] == ["2", "1"]
+    assert "1" not in store.players
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_a_returning_farmers_changes_are_kept(make_store, backend):
+    store = store_with_idle_farm(make_store, backend)
+    store.touch("1").coins = 50
+    store.save_player("1")
+    store.flush()
+    store.backend.close()
+
+    reopened = make_store(backend)
+    assert reopened.get_player("1").coins == 50
+    assert reopened.get_player("1").last_seen == epoch_today()
+
+
+def test_busy_and_unsaved_farms_stay(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"last_seen": 1})
+    store.add_player("2", {"last_seen": 1})
+    store.flush()
+    store.save_player("2")
+    store._busy = lambda uid: uid == "1"
+    assert asyncio.run(store.retire_idle()) == 0
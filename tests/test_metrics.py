@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import metrics
+from metrics import Histogram, Metrics, instrument
+
+
+def test_histogram_quantiles_are_bucket_bounds():
+    hist = Histogram()
+    for seconds in (0.0002, 0.0002, 0.003, 0.2):
+        hist.observe(seconds)
+    assert hist.count == 4 and hist.sum == pytest.approx(0.2034)
+    assert hist.quantile(0.5) == 0.00025
+    assert hist.quantile(0.75) == 0.005
+    assert hist.quantile(0.99) == 0.25
+    hist.observe(60)
+    assert hist.quantile(1) == float("inf")
+
+
+def test_timed_counts_errors_and_reraises():
+    m = Metrics()
+    with m.timed("storage", "save"):
+        pass
+    with pytest.raises(OSError):
+        with m.timed("storage", "save"):
+            raise OSError("disk full")
+    assert m.latency["storage", "save"].count == 2
+    assert m.errors["storage", "save"] == 1
+
+
+def test_render_writes_prometheus_text():
+    m = Metrics()
+    m.observe("handler", "feed", 0.003)
+    m.observe("handler", "feed", 0.02, error=True)
+    text = m.render()
+    assert "# TYPE pigfarm_handler_seconds histogram" in text
+    assert 'pigfarm_handler_seconds_bucket{command="feed",le="0.005"} 1' in text
+    assert 'pigfarm_handler_seconds_bucket{command="feed",le="+Inf"} 2' in text
+    assert 'pigfarm_handler_seconds_count{command="feed"} 2' in text
+    assert 'pigfarm_handler_errors_total{command="feed"} 1' in text
+    assert text.endswith("\n")
+
+
+def test_instrument_times_the_handler(monkeypatch):
+    m = Metrics()
+    monkeypatch.setattr(metrics, "METRICS", m)
+
+    async def myfarm(update, context):
+        return "ok"
+
+    assert asyncio.run(instrument("myfarm", myfarm)(None, None)) == "ok"
+    assert m.latency["handler", "myfarm"].count == 1
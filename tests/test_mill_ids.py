@@ -0,0 +1,34 @@
+import pytest
+
+from conftest import BACKENDS
+from storage import short_mill_id
+
+
+def test_short_mill_id_uses_the_last_digits_until_they_clash():
+    assert short_mill_id("5551234", lambda mill_id: False) == "1234"
+    assert short_mill_id("5551234", lambda mill_id: mill_id == "1234") == "51234"
+    assert short_mill_id("12", lambda mill_id: False) == "12"
+    taken = {"1234", "51234", "551234", "5551234"}
+    assert short_mill_id("5551234", taken.__contains__) == "5551234-2"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_mills_without_ids_are_given_unique_ones(make_store, backend):
+    feed = {"mills": {"1111234": {"level": 1}, "2221234": {"level": 2}, "77": {"level": 1}}}
+    make_store("json", players={}, feed=feed).backend.close()
+
+    store = make_store(backend)
+    assert store.get_mill("1111234").mill_id == "1234"
+    assert store.get_mill("2221234").mill_id == "21234"
+    assert store.get_mill("77").mill_id == "77"
+    assert store.find_mill_owner("21234") == "2221234"
+    assert store.find_mill_owner("9999") is None
+
+    store.flush()
+    assert make_store(backend).find_mill_owner("21234") == "2221234"
+
+
+def test_a_new_mill_id_skips_ones_already_taken(make_store):
+    store = make_store(players={}, feed={"mills": {"1111234": {"level": 1, "mill_id": "1234"}}})
+    assert store.allocate_mill_id("1111234") == "1234"  # its own id
+    assert store.allocate_mill_id("2221234") == "21234"
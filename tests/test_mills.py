@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from mills import MILL_CAP_BATCHES, MillAlerts, TimingWheel, collect, full_at, next_batch_at, ready_batches
+
+START = datetime(2024, 5, 1, 12, 0)
+
+
+def mill(started=START, level=1):
+    return {"last_production": started.isoformat(), "level": level}
+
+
+def test_batches_accrue_with_time_up_to_the_cap():
+    m = mill()
+    assert ready_batches(m, 2, START + timedelta(hours=1)) == 0
+    assert ready_batches(m, 2, START + timedelta(hours=5)) == 2
+    assert ready_batches(m, 2, START + timedelta(days=3)) == MILL_CAP_BATCHES
+    assert ready_batches({}, 2, START) == MILL_CAP_BATCHES
+    assert next_batch_at(m, 2, START + timedelta(hours=5)) == START + timedelta(hours=6)
+    assert full_at(m, 2) == START + timedelta(hours=2 * MILL_CAP_BATCHES)
+
+
+def test_collect_carries_time_towards_the_next_batch():
+    m = mill()
+    assert collect(m, 2, START + timedelta(hours=5)) == 2
+    assert m["last_production"] == (START + timedelta(hours=4)).isoformat()
+    assert collect(m, 2, START + timedelta(hours=5)) == 0
+
+
+def test_collect_from_a_full_mill_restarts_the_clock():
+    m = mill()
+    now = START + timedelta(days=3)
+    assert collect(m, 2, now) == MILL_CAP_BATCHES
+    assert m["last_production"] == now.isoformat()
+
+
+def test_timing_wheel_fires_keys_when_due():
+    wheel = TimingWheel(tick=60, slots=10, now=0)
+    wheel.schedule("soon", 150)
+    wheel.schedule("later", 60 * 25)  # more than two turns of the wheel away
+    wheel.schedule("overdue", -500)
+    wheel.schedule("gone", 200)
+    wheel.cancel("gone")
+    assert len(wheel) == 3
+    assert wheel.advance(60) == ["overdue"]
+    assert wheel.advance(179) == []
+    assert wheel.advance(180) == ["soon"]
+    assert wheel.advance(60 * 24) == []
+    assert wheel.advance(60 * 25) == ["later"]
+    assert len(wheel) == 0
+
+
+def test_rescheduling_replaces_the_old_entry():
+    wheel = TimingWheel(tick=60, slots=10, now=0)
+    wheel.schedule("a", 120)
+    wheel.schedule("a", 300)
+    assert wheel.advance(240) == []
+    assert wheel.advance(300) == ["a"]
+
+
+def test_alerts_load_every_mill_that_isnt_full(make_store):
+    now = datetime.now()
+    feed = {"mills": {
+        "1": {"level": 1, "mill_id": "1", "last_production": now.isoformat()},
+        "2": {"level": 1, "mill_id": "2", "last_production": (now - timedelta(days=30)).isoformat()},
+    }}
+    store = make_store(players={}, feed=feed)
+    alerts = MillAlerts()
+    asyncio.run(alerts._load(store, {1: {"cooldown": 1}}))
+    assert list(alerts.wheel.where) == ["1"]
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from orderbook import LISTING_DAYS, OrderBook, index_listings
+
+
+def listing(seller, price, amount=5, age_days=0, **fields):
+    return {"seller_id": seller, "price": price, "amount": amount, "sales": 0,
+            "listed_at": int(time.time() - age_days * 86400), **fields}
+
+
+def book(*listings):
+    market = OrderBook({})
+    for l in listings:
+        market.add(l)
+    return market
+
+
+def test_match_takes_the_cheapest_then_the_oldest_offer():
+    market = book(listing("a", 3), listing("b", 2), listing("c", 2), listing("d", 1, amount=1))
+    plan = market.match(8, "buyer")
+    assert [(l["seller_id"], take) for l, take in plan] == [("d", 1), ("b", 5), ("c", 2)]
+    assert [(l["seller_id"], take) for l, take in market.match(8, "buyer", max_price=1)] == [("d", 1)]
+
+
+def test_match_skips_expired_listings_and_the_buyers_own():
+    market = book(listing("old", 1, age_days=LISTING_DAYS + 1), listing("me", 1), listing("b", 4))
+    assert [l["seller_id"] for l, _ in market.match(3, "me")] == ["b"]
+    assert [l["seller_id"] for l, _ in market.match(3, "x", sellers={"me"})] == ["me"]
+
+
+def test_fill_closes_sold_out_listings_and_unfill_reopens_them():
+    market = book(listing("a", 1, amount=2), listing("b", 2))
+    first = market.get(1)
+    market.fill(1, 2)
+    assert market.get(1) is None and len(market) == 1
+    assert first["sales"] == 2
+    market.unfill(first, 2)
+    assert market.get(1) is first and first["amount"] == 2 and first["sales"] == 0
+    assert [l["id"] for l in market.offers()] == [1, 2]
+    assert [l["id"] for l in market.page(1, 5)] == [2]
+
+
+def test_expired_comes_from_the_age_index_oldest_first():
+    market = book(listing("a", 1, age_days=LISTING_DAYS + 1), listing("b", 1),
+                  listing("c", 5, age_days=LISTING_DAYS + 3))
+    assert [l["seller_id"] for l in market.expired()] == ["c", "a"]
+    market.remove(3)
+    assert [l["seller_id"] for l in market.expired()] == ["a"]
+
+
+def test_index_listings_numbers_old_listings_after_the_highest_id():
+    listings = index_listings([listing("a", 1, id=4), listing("b", 1), listing("c", 1)])
+    assert sorted(listings) == ["4", "5", "6"]
+    assert OrderBook(listings).next_id == 7
+
+
+def test_buyfeed_counts_the_sellers_it_bought_from(bot, send):
+    for uid in ("1", "2", "3"):
+        bot.STORE.add_player(uid, {"username": f"u{uid}", "coins": 100, "feed": 0})
+    for seller, price in (("1", 1), ("2", 2)):
+        bot.STORE.add_listing({"seller_id": seller, "amount": 5, "price": price, "type": "normal",
+                               "brand": "Mill", "emoji": "🏭", "slogan": "", "sales": 0})
+
+    replies = asyncio.run(send(bot.buyfeed, "3", 3))
+    assert replies == ["✅ Purchased 3 feed from 1 seller(s) for 3 coins."]
+    assert bot.STORE.get_player("1").coins == 103 and bot.STORE.get_player("3").coins == 97
+    replies = asyncio.run(send(bot.buyfeed, "3", 4))
+    assert replies == ["✅ Purchased 4 feed from 2 seller(s) for 6 coins."]
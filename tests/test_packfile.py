@@ -0,0 +1,52 @@
+import itertools
+
+from packfile import PackReader, key_for, slot_for, write_pack
+
+
+def pack(tmp_path, players, name="players.pak"):
+    path = str(tmp_path / name)
+    with open(path, "wb") as f:
+        write_pack(f, players.items())
+    return PackReader(path)
+
+
+def test_reads_back_single_records(tmp_path):
+    players = {str(1000 + i): {"coins": i, "username": f"u{i}"} for i in range(200)}
+    reader = pack(tmp_path, players)
+    assert len(reader) == 200
+    assert reader.get("1042") == {"coins": 42, "username": "u42"}
+    assert reader.get("999") is None
+    assert "1199" in reader and "1200" not in reader
+    assert dict(reader.items()) == players
+    reader.close()
+
+
+def test_probes_past_colliding_slots(tmp_path):
+    # Three ids in the same home slot of an 8-slot index, and a fourth that
+    # isn't stored but hashes there too
+    same_slot = (uid for uid in map(str, itertools.count(1)) if slot_for(key_for(uid), 8) == 0)
+    *stored, missing = itertools.islice(same_slot, 4)
+    reader = pack(tmp_path, {uid: {"coins": int(uid)} for uid in stored})
+    assert reader.slots == 8
+    for uid in stored:
+        assert reader.get(uid) == {"coins": int(uid)}
+    assert reader.get(missing) is None
+    reader.close()
+
+
+def test_non_numeric_ids_get_hashed_keys(tmp_path):
+    assert key_for("123") == 123
+    assert key_for("admin") >= 1 << 63
+    assert key_for("admin") == key_for("admin")
+    reader = pack(tmp_path, {"admin": {"coins": 1}, "123": {"coins": 2}})
+    assert reader.get("admin") == {"coins": 1}
+    assert reader.get("123") == {"coins": 2}
+    reader.close()
+
+
+def test_empty_pack(tmp_path):
+    reader = pack(tmp_path, {})
+    assert len(reader) == 0
+    assert reader.get("1") is None
+    assert list(reader.items()) == []
+    reader.close()
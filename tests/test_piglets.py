@@ -0,0 +1,41 @@
+import piglets
+from piglets import add_piglets, count_piglets, inventory, migrate_piglets, piglet_groups, remove_piglets
+from records import Player
+
+
+def farm(monkeypatch, day=100, **piglet_counts):
+    monkeypatch.setattr(piglets, "today", lambda: day)
+    return Player.from_json({"piglets": piglet_counts, "piglets_day": day})
+
+
+def test_piglets_are_counted_by_type_and_age(monkeypatch):
+    player = farm(monkeypatch)
+    add_piglets(player, "normal", 12)
+    add_piglets(player, "golden")
+    add_piglets(player, "normal", 2, age=3)
+    assert count_piglets(player) == 15
+    assert piglet_groups(player) == [("golden", 0, 1), ("normal", 0, 12), ("normal", 3, 2)]
+
+
+def test_remove_takes_at_most_what_there_is(monkeypatch):
+    player = farm(monkeypatch, normal={"0": 3}, golden={"1": 1})
+    assert remove_piglets(player, "normal", 0, 2) == 2
+    assert remove_piglets(player, "golden", 1, 5) == 1
+    assert remove_piglets(player, "spotted", 0) == 0
+    assert piglet_groups(player) == [("normal", 0, 1)]
+    assert "golden" not in inventory(player)
+
+
+def test_ages_move_on_with_the_days(monkeypatch):
+    player = farm(monkeypatch, normal={"0": 2, "4": 1})
+    monkeypatch.setattr(piglets, "today", lambda: 103)
+    assert piglet_groups(player) == [("normal", 3, 2), ("normal", 7, 1)]
+    assert player.piglets_day == 103
+
+
+def test_migrate_piglets_counts_the_old_list(monkeypatch):
+    monkeypatch.setattr(piglets, "today", lambda: 50)
+    data = {"piglets": [{"type": "golden", "age": 2}, {"type": "golden", "age": 2}, {}]}
+    assert migrate_piglets(data)
+    assert data == {"piglets": {"golden": {"2": 2}, "normal": {"0": 1}}, "piglets_day": 50}
+    assert not migrate_piglets(data)
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from conftest import BACKENDS
+from ranking import Ranking
+
+
+def test_ranking_orders_by_score_then_id():
+    ranking = Ranking([("a", 5), ("b", 9), ("c", 5), ("d", None)])
+    assert ranking.top(3) == [("b", 9), ("a", 5), ("c", 5)]
+    assert [ranking.rank(k) for k in "abcd"] == [2, 1, 3, 4]
+    assert ranking.rank("x") is None
+    assert ranking.above(5) == 1
+    assert ranking.top(10, positive=True) == [("b", 9), ("a", 5), ("c", 5)]
+
+
+def test_ranking_update_and_discard():
+    ranking = Ranking([("a", 5), ("b", 9)])
+    ranking.update("a", 12)
+    ranking.update("c", 1)
+    assert ranking.top(3) == [("a", 12), ("b", 9), ("c", 1)]
+    ranking.discard("b")
+    ranking.discard("missing")
+    assert len(ranking) == 2 and ranking.rank("c") == 2 and ranking.score("b") is None
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_store_ranks_every_farm(make_store, backend):
+    players = {"1": {"coins": 30}, "2": {"coins": 50}, "3": {"coins": 0}}
+    make_store("json", players=players).backend.close()
+    store = make_store(backend)
+    asyncio.run(store.load_rankings())
+
+    assert [uid for uid, _ in store.top_players("coins", 5)] == ["2", "1"]
+    assert store.player_rank("coins", "1") == (2, 30, 3)
+    store.get_player("3").coins = 99
+    store.save_player("3")
+    assert store.player_rank("coins", "3") == (1, 99, 3)
+
+
+def test_farms_saved_while_the_rankings_build_are_ranked_again(make_store):
+    store = make_store(players={"1": {"coins": 30}, "2": {"coins": 50}})
+
+    async def main():
+        build = asyncio.create_task(store.load_rankings())
+        await asyncio.sleep(0)
+        store.get_player("1").coins = 80
+        store.save_player("1")
+        await build
+
+    asyncio.run(main())
+    assert store.player_rank("coins", "1") == (1, 80, 2)
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from records import Listing, Pig, Piglets, Player, record_json
+
+
+def farm():
+    return {"username": "a", "coins": 3, "pig": {"last_fed": 10, "fed_bits": 1},
+            "piglets": {"golden": {"0": 2}}, "nickname": "Oinky"}
+
+
+def test_records_read_and_write_like_dicts():
+    player = Player.from_json(farm())
+    assert player.coins == player["coins"] == 3
+    assert isinstance(player.pig, Pig) and isinstance(player.piglets, Piglets)
+    assert "pig" in player and "plant" not in player and "nickname" in player
+    assert player.get("plant") is None and player["nickname"] == "Oinky"
+    with pytest.raises(KeyError):
+        player["plant"]
+
+    player["coins"] += 2
+    player.setdefault("streak", 4)
+    player["pig"] = {"last_fed": 11}
+    assert player.coins == 5 and player.streak == 4 and player.pig.last_fed == 11
+    assert player.pop("nickname") == "Oinky" and player.pop("nickname", None) is None
+    del player["streak"]
+    assert "streak" not in player
+
+
+def test_records_keep_unknown_keys_and_round_trip_to_json():
+    data = farm()
+    player = Player.from_json(json.loads(json.dumps(data)))
+    assert json.loads(json.dumps(player, default=record_json)) == data
+    assert player == data and dict(player.items()) == player.to_json()
+    assert Player.from_json(player) is player
+
+
+def test_records_use_slots_not_dicts():
+    listing = Listing(id=1, seller_id="1", amount=2, price=3)
+    assert not hasattr(listing, "__dict__")
+    with pytest.raises(AttributeError):
+        listing.colour = "pink"
+    assert listing.extra is None and len(listing) == 4
+    with pytest.raises(TypeError):
+        json.dumps(object(), default=record_json)
@@ -0,0 +1,155 @@
+import asyncio
+import io
+import json
+from datetime import date, datetime
+
+import pytest
+
+from conftest import BACKENDS
+from feeding import epoch_day, fed_on
+from schema import (
+    READ_SIZE, SCHEMA_VERSION, JsonStream, SchemaError, check_file, migrate_listing, migrate_mill, migrate_player,
+    read_feed, read_players,
+)
+
+
+class Trickle(io.StringIO):
+    # Hands out at most a few characters per read
+    def read(self, size=-1):
+        return super().read(min(size, 3))
+
+
+def walk_players(stream):
+    return {user_id: stream.value() for user_id in stream.members()}
+
+
+def test_values_split_across_reads_decode_whole():
+    players = {str(uid): {"username": f"ü{uid}", "coins": uid * 1001, "ton_log": [1.5, None, True]}
+               for uid in range(1, 40)}
+    stream = JsonStream(Trickle(json.dumps(players, indent=2)))
+    assert walk_players(stream) == players
+    stream.end()
+
+
+def test_a_number_on_the_read_size_border_isnt_cut(tmp_path):
+    head = '{"1": {"coins": '
+    text = head + " " * (READ_SIZE - len(head) - 3) + '123456789}, "2": {"username": "' + "x" * READ_SIZE + '"}}'
+    path = tmp_path / "players.json"
+    path.write_text(text)
+    assert dict(read_players(str(path))) == {"1": {"coins": 123456789}, "2": {"username": "x" * READ_SIZE}}
+
+
+def test_read_feed_walks_mills_market_and_plants(tmp_path):
+    feed = {"mills": {"1": {"level": 1}}, "market": [{"seller_id": "1", "amount": 2, "price": 3}],
+            "5": {"plant_level": 2}}
+    path = tmp_path / "feed_data.json"
+    path.write_text(json.dumps(feed))
+    assert list(read_feed(str(path))) == [
+        ("mills", "1", {"level": 1}), ("market", 0, feed["market"][0]), ("plants", "5", {"plant_level": 2}),
+    ]
+
+
+@pytest.mark.parametrize("text, error", [
+    ('{"abc": {}}', "is not a user id"),
+    ('{"1": {"coins": "many"}}', "coins should be a number"),
+    ('{"1": {"coins": 1}', "expected"),
+    ('{"1": {"coins": 1}} []', "extra data"),
+    ('{"1": [1, 2', "not valid JSON"),
+    ('[]', "expected '{'"),
+])
+def test_check_file_rejects_broken_players(tmp_path, text, error):
+    path = tmp_path / "players.json"
+    path.write_text(text)
+    with pytest.raises(SchemaError, match=error):
+        check_file("players.json", str(path))
+
+
+def test_check_file_rejects_broken_feed_data(tmp_path):
+    path = tmp_path / "feed_data.json"
+    listing = {"id": 1, "seller_id": "1", "amount": 1, "price": 1}
+    path.write_text(json.dumps({"mills": {}, "market": [listing, listing]}))
+    with pytest.raises(SchemaError, match="used twice"):
+        check_file("feed_data.json", str(path))
+    path.write_text(json.dumps({"mills": {"1": {"level": 9}}, "market": []}))
+    with pytest.raises(SchemaError, match="no level 9"):
+        check_file("feed_data.json", str(path), mill_levels=5)
+    path.write_bytes(b'{"mills": {"1": {"slogan": "\xff"}}}')
+    with pytest.raises(SchemaError, match="UTF-8"):
+        check_file("feed_data.json", str(path))
+
+
+def test_check_file_counts_what_it_checked(tmp_path):
+    path = tmp_path / "feed_data.json"
+    path.write_text(json.dumps({"mills": {"1": {"level": 1}}, "market": [], "2": {}, "3": {}}))
+    assert check_file("feed_data.json", str(path)) == {"mills": 1, "listings": 0, "plants": 2}
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_restore_swaps_in_the_uploaded_players(make_store, backend):
+    make_store("json", players={"1": {"coins": 1}, "2": {"coins": 2}}).backend.close()
+    store = make_store(backend)
+    asyncio.run(store.load_rankings())
+    store.get_player("1").coins = 500
+    store.save_player("1")
+
+    with open("upload.json", "w") as f:
+        json.dump({"2": {"coins": 20}, "3": {"coins": 30}}, f, indent=2)
+    check_file("players.json", "upload.json")
+    asyncio.run(store.restore_json("players.json", "upload.json"))
+
+    assert store.get_player("1") is None
+    assert (store.get_player("2").coins, store.get_player("3").coins) == (20, 30)
+    assert [uid for uid, _ in store.top_players("coins", 5)] == ["3", "2"]
+    store.flush()
+    store.backend.close()
+    assert make_store(backend).get_player("3").coins == 30
+
+
+def test_migrate_player_brings_a_v1_farm_up_to_date():
+    farm = {"username": "old", "coins": 7, "pigs": 1, "age": 3, "last_fed": "2024-05-01",
+            "is_pregnant": True, "pregnant_since": "2024-04-30", "breed_spent": 2,
+            "piglets": [{"type": "golden", "age": 1}]}
+    assert migrate_player(farm)
+    assert farm["schema"] == SCHEMA_VERSION
+    assert not {"pigs", "age", "last_fed", "is_pregnant", "pregnant_since", "breed_spent"} & farm.keys()
+    assert (farm["coins"], farm["streak"], farm["ton_log"]) == (7, 0, [])
+    pig = farm["pig"]
+    assert pig["pregnant"] and pig["pregnant_date"] == "2024-04-30" and pig["breed_spent"] == 2
+    assert pig["last_fed"] == epoch_day(date(2024, 5, 1)) and "fed_dates" not in pig
+    assert farm["piglets"] == {"golden": {"1": 1}}
+    assert not migrate_player(farm)
+
+
+def test_migrate_player_without_a_pig():
+    farm = {"coins": 1, "pig": None}
+    assert migrate_player(farm)
+    assert "pig" not in farm and farm["feed"] == 0
+
+
+def test_migrate_mill_and_listing():
+    mill = {"mill_id": "42", "level": 1}
+    assert migrate_mill(mill)
+    assert mill["brand"] == "Mill #42" and mill["stock"] == [] and mill["schema"] == SCHEMA_VERSION
+    listing = {"seller_id": "1", "amount": 1, "price": 1, "timestamp": "2024-05-01T12:00:00"}
+    assert migrate_listing(listing)
+    assert listing["listed_at"] == int(datetime(2024, 5, 1, 12).timestamp()) and listing["type"] == "normal"
+    assert not migrate_listing(listing)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_old_records_are_upgraded_once_when_loaded(make_store, backend):
+    feed = {"mills": {"1": {"level": 1, "mill_id": "1"}},
+            "market": [{"seller_id": "1", "amount": 2, "price": 3, "timestamp": "2024-05-01T12:00:00"}]}
+    make_store("json", players={"1": {"coins": 4, "pigs": 1, "last_fed": "2024-05-01"}}, feed=feed).backend.close()
+
+    store = make_store(backend)
+    player = store.get_player("1")
+    assert player.schema == SCHEMA_VERSION and fed_on(player.pig, epoch_day(date(2024, 5, 1)))
+    assert store.get_mill("1").schema == SCHEMA_VERSION
+    assert store.market.get(1).schema == SCHEMA_VERSION
+    store.flush()
+    store.backend.close()
+
+    again = make_store(backend)
+    again.get_player("1")
+    assert not again.is_dirty()
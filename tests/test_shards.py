@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import shards
+from shards import Cluster, ShardUnavailable, sender, shard_of
+
+
+def test_shard_of_is_stable_and_in_range(monkeypatch):
+    monkeypatch.setattr(shards, "SHARDS", 3)
+    spread = {shard_of(str(uid)) for uid in range(1000, 1100)}
+    assert spread == {0, 1, 2}
+    assert shard_of("1234") == shard_of(1234) == shard_of("1234")
+
+
+def test_sender_finds_the_user_of_any_update():
+    assert sender({"update_id": 1, "message": {"from": {"id": 7}, "text": "/feed"}}) == 7
+    assert sender({"update_id": 2, "callback_query": {"from": {"id": 8}}}) == 8
+    assert sender({"update_id": 3, "message_reaction": {"user": {"id": 9}}}) == 9
+    assert sender({"update_id": 4, "poll": {"id": "x"}}) is None
+
+
+def test_seed_splits_the_data_once(make_store, monkeypatch):
+    monkeypatch.setattr(shards, "SHARDS", 2)
+    players = {str(uid): {"coins": uid} for uid in range(100, 120)}
+    feed = {"mills": {"100": {"level": 1, "mill_id": "100"}},
+            "market": [{"id": 1, "seller_id": "100", "amount": 2, "price": 1, "sales": 0, "listed_at": 1}]}
+    make_store(players=players, feed=feed).backend.close()
+
+    shards.seed("players.json", "feed_data.json")
+    parts = []
+    for shard in range(2):
+        with open(os.path.join("shards", str(shard), "players.json")) as f:
+            text = f.read()
+        assert text.startswith('{\n  "')  # indent=2, like every other data file
+        parts.append(json.loads(text))
+        assert all(shard_of(uid) == shard for uid in parts[-1])
+    assert sorted(parts[0].keys() | parts[1].keys()) == sorted(players)
+    with open(os.path.join("shards", "0", "feed_data.json")) as f:
+        assert len(json.load(f)["market"]) == 1
+
+    monkeypatch.setattr(shards, "SHARDS", 3)
+    with pytest.raises(SystemExit):
+        shards.seed("players.json", "feed_data.json")
+
+
+def test_call_again_retries_while_the_shard_is_down(monkeypatch):
+    cluster = Cluster()
+    attempts = []
+
+    async def call(op, **args):
+        attempts.append(op)
+        if len(attempts) < 3:
+            raise ShardUnavailable("starting")
+        return "done"
+
+    async def no_wait(seconds):
+        pass
+
+    monkeypatch.setattr(cluster, "call", call)
+    monkeypatch.setattr(shards.asyncio, "sleep", no_wait)
+    assert asyncio.run(cluster.call_again("take_feed", shard=0)) == "done"
+    assert len(attempts) == 3
+
+
+# The market shard's side of a sharded /buyfeed, see bot.take_feed
+
+@pytest.fixture
+def market(bot, monkeypatch):
+    monkeypatch.setattr(bot, "FEED_DEALS", {})
+    posted = []
+    monkeypatch.setattr(bot.CLUSTER, "post", lambda op, user, **args: posted.append((op, user, args)))
+    for seller, price in (("1", 1), ("2", 2)):
+        bot.STORE.add_listing({"seller_id": seller, "amount": 5, "price": price, "type": "normal",
+                               "brand": "Mill", "emoji": "🏭", "slogan": "", "sales": 0})
+    return bot, posted
+
+
+def take(bot, deal_id, amount, budget=100):
+    return asyncio.run(bot.take_feed(None, deal_id=deal_id, buyer_id="9", amount=amount, max_price=None,
+                                     budget=budget))
+
+
+def test_take_feed_answers_a_retried_deal_the_same_way(market):
+    bot, posted = market
+    first = take(bot, "d1", 7)
+    assert first == {"bought": 7, "cost": 9, "sellers": 2, "filled": True}
+    assert take(bot, "d1", 7) == first
+    assert bot.STORE.market.get(1) is None and bot.STORE.market.get(2)["amount"] == 3
+
+
+def test_take_feed_over_budget_takes_nothing(market):
+    bot, posted = market
+    assert take(bot, "d1", 7, budget=5) == {"bought": 7, "cost": 9, "sellers": 0, "filled": False}
+    assert bot.STORE.market.get(1)["amount"] == 5
+
+
+def test_settle_feed_pays_each_seller_once(market):
+    bot, posted = market
+    take(bot, "d1", 7)
+    asyncio.run(bot.settle_feed(None, deal_id="d1"))
+    asyncio.run(bot.settle_feed(None, deal_id="d1"))
+    assert sorted(posted) == [("feed_sold", "1", {"seller_id": "1", "coins": 5, "amount": 5}),
+                              ("feed_sold", "2", {"seller_id": "2", "coins": 4, "amount": 2})]
+
+
+def test_cancel_feed_puts_the_feed_back_even_before_the_take(market):
+    bot, posted = market
+    take(bot, "d1", 7)
+    asyncio.run(bot.cancel_feed(None, deal_id="d1"))
+    assert bot.STORE.market.get(1)["amount"] == 5 and bot.STORE.market.get(2)["amount"] == 5
+
+    asyncio.run(bot.cancel_feed(None, deal_id="d2"))
+    assert take(bot, "d2", 7)["filled"] is False
+    assert bot.STORE.market.get(1)["amount"] == 5
+    assert posted == []
+
+
+def test_deals_nobody_settled_go_back_on_the_book(market):
+    bot, posted = market
+    take(bot, "d1", 3)
+    bot.FEED_DEALS["d1"]["at"] = time.time() - bot.DEAL_TIMEOUT - 1
+    bot.drop_stale_deals()
+    assert bot.STORE.market.get(1)["amount"] == 5 and bot.FEED_DEALS == {}
+
+
+def test_sharded_buyer_pays_before_the_sellers_are(market, send, monkeypatch):
+    bot, posted = market
+    bot.STORE.add_player("9", {"coins": 20, "feed": 0})
+
+    async def call_again(op, **args):
+        return await bot.take_feed(None, **{k: v for k, v in args.items() if k != "shard"})
+
+    def post(op, user, **args):
+        posted.append((op, bot.STORE.get_player("9").coins))
+
+    monkeypatch.setattr(bot.CLUSTER, "call_again", call_again)
+    monkeypatch.setattr(bot.CLUSTER, "post", post)
+    replies = asyncio.run(send(lambda update, context: bot.buyfeed_sharded(update, "9", 7, None), 9))
+    assert replies == ["✅ Purchased 7 feed from 2 seller(s) for 9 coins."]
+    assert posted == [("settle_feed", 11)]
+
+
+def test_sharded_buyer_isnt_charged_when_the_market_doesnt_answer(market, send, monkeypatch):
+    bot, posted = market
+    bot.STORE.add_player("9", {"coins": 20, "feed": 0})
+
+    async def call_again(op, **args):
+        raise ShardUnavailable("down")
+
+    monkeypatch.setattr(bot.CLUSTER, "call_again", call_again)
+    replies = asyncio.run(send(lambda update, context: bot.buyfeed_sharded(update, "9", 7, None), 9))
+    assert "nothing was bought" in replies[0]
+    assert bot.STORE.get_player("9").coins == 20
+    assert [op for op, _, _ in posted] == ["cancel_feed"]
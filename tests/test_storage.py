@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+
+
+def on_disk():
+    with open("players.json") as f:
+        return json.load(f)
+
+
+def test_changes_reach_disk_on_flush(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"username": "a", "coins": 5})
+    assert store.get_player("1").coins == 5
+    assert store.is_dirty()
+    assert "1" not in on_disk()
+
+    store.flush()
+    assert not store.is_dirty()
+    assert on_disk()["1"]["coins"] == 5
+
+
+def test_only_saved_changes_are_written(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"coins": 1})
+    store.add_player("2", {"coins": 2})
+    store.flush()
+    store.get_player("1").coins = 10
+    store.get_player("2").coins = 20
+    store.save_player("1")
+    store.flush()
+    assert on_disk()["1"]["coins"] == 10
+    assert on_disk()["2"]["coins"] == 2
+
+
+def test_reload_drops_unflushed_changes(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"coins": 1})
+    store.flush()
+    store.get_player("1").coins = 7
+    store.save_player("1")
+    store.reload()
+    assert store.get_player("1").coins == 1
+    assert not store.is_dirty()
+
+
+def test_stop_flushes(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"coins": 3})
+    asyncio.run(store.stop())
+    assert on_disk()["1"]["coins"] == 3
+
+
+def test_sqlite_writes_rows_and_score_columns(make_store):
+    import sqlite3
+
+    store = make_store("sqlite")
+    store.add_player("1", {"username": "a", "coins": 4, "streak": 2})
+    store.add_player("2", {"username": "b", "coins": 9})
+    store.flush()
+    store.get_player("1").coins = 12
+    store.save_player("1")
+    store.flush()
+
+    rows = dict(sqlite3.connect("pigfarm.db").execute("SELECT user_id, coins FROM players"))
+    assert rows == {"1": 12, "2": 9}
+    reopened = make_store("sqlite")
+    assert reopened.get_player("1").coins == 12
+    assert reopened.get_player("1").streak == 2
+    assert reopened.get_player("3") is None
+
+
+def test_sqlite_imports_json_data_on_first_start(make_store):
+    old = make_store("json", players={})
+    old.add_player("7", {"username": "old", "coins": 3})
+    old.flush()
+
+    store = make_store("sqlite")
+    assert store.get_player("7").coins == 3
+    assert os.path.exists("pigfarm.db") and not os.path.exists("pigfarm.db.tmp")
+
+
+def test_journal_replays_flushed_changes_after_a_restart(make_store):
+    store = make_store("journal", players={})
+    store.add_player("1", {"coins": 1})
+    store.flush()
+    store.get_player("1").coins = 2
+    store.save_player("1")
+    store.flush()
+    assert "1" not in on_disk()  # only in the journal so far
+
+    assert make_store("journal").get_player("1").coins == 2
+
+
+def test_journal_ignores_a_torn_last_line(make_store):
+    store = make_store("journal", players={})
+    store.add_player("1", {"coins": 1})
+    store.flush()
+    store.backend.close()
+    with open("players.journal", "ab") as f:
+        f.write(b'{"players":{"1":{"coi')
+
+    reopened = make_store("journal")
+    assert reopened.get_player("1").coins == 1
+    reopened.add_player("2", {"coins": 2})
+    reopened.flush()
+    assert make_store("journal").get_player("2").coins == 2
+
+
+def test_journal_compaction_folds_it_into_the_snapshot(make_store):
+    store = make_store("journal", players={})
+    store.add_player("1", {"coins": 5})
+    store.flush()
+    asyncio.run(store.compact())
+    assert on_disk()["1"]["coins"] == 5
+    assert os.path.getsize("players.journal") == 0
+    assert make_store("journal").get_player("1").coins == 5
+
+
+def test_transaction_commits_every_record_together(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"coins": 10})
+    store.add_player("2", {"coins": 0})
+    store.flush()
+
+    with store.transaction() as tx:
+        tx.get_player("1").coins -= 4
+        tx.get_player("2").coins += 4
+        tx.save_player("1")
+        tx.save_player("2")
+        assert store.get_player("1").coins == 10  # not before the commit
+    assert (store.get_player("1").coins, store.get_player("2").coins) == (6, 4)
+    assert store.dirty_players == {"1", "2"}
+
+
+def test_transaction_rolls_back_on_an_exception(make_store):
+    store = make_store(players={})
+    store.add_player("1", {"coins": 10})
+    store.flush()
+
+    try:
+        with store.transaction() as tx:
+            tx.get_player("1").coins = 0
+            tx.save_player("1")
+            raise RuntimeError("handler failed")
+    except RuntimeError:
+        pass
+    assert store.get_player("1").coins == 10
+    assert not store.is_dirty()
+
+
+def test_flush_async_writes_on_the_io_thread(make_store, monkeypatch):
+    import threading
+
+    store = make_store(players={})
+    store.add_player("1", {"coins": 1})
+    threads = []
+    write = store.backend.write
+
+    def recording_write(*batch):
+        job = write(*batch)
+
+        def run():
+            threads.append(threading.current_thread().name)
+            job()
+
+        return run
+
+    monkeypatch.setattr(store.backend, "write", recording_write)
+    asyncio.run(store.flush_async())
+    assert threads[0].startswith("storage-io")
+    assert on_disk()["1"]["coins"] == 1
+
+
+def test_a_failed_write_is_retried_by_the_next_flush(make_store, monkeypatch):
+    store = make_store(players={})
+    store.add_player("1", {"coins": 1})
+
+    def broken(*batch):
+        def run():
+            raise OSError("disk full")
+
+        return run
+
+    write = store.backend.write
+    monkeypatch.setattr(store.backend, "write", broken)
+    try:
+        asyncio.run(store.flush_async())
+    except OSError:
+        pass
+    assert store.dirty_players == {"1"}
+
+    monkeypatch.setattr(store.backend, "write", write)
+    asyncio.run(store.flush_async())
+    assert on_disk()["1"]["coins"] == 1
@@ -0,0 +1,79 @@
+import asyncio
+
+import httpx
+
+from webhook import MAX_BODY, WebhookServer
+
+SECRET = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+
+
+def serve(check, ready=True):
+    # Runs check(client, delivered) against a server on a free local port
+    delivered = []
+
+    async def deliver(update):
+        delivered.append(update)
+
+    async def rpc(request):
+        if request.get("op") == "boom":
+            raise ValueError("no such op")
+        return {"echo": request}
+
+    async def main():
+        server = WebhookServer(deliver, "s3cret", lambda: ready, rpc=rpc)
+        await server.start("127.0.0.1", 0)
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+                await check(client, delivered)
+        finally:
+            await server.stop()
+
+    asyncio.run(main())
+
+
+def test_updates_need_the_secret_token():
+    async def check(client, delivered):
+        assert (await client.post("/telegram", json={"update_id": 1})).status_code == 403
+        bad = {"X-Telegram-Bot-Api-Secret-Token": "guess"}
+        assert (await client.post("/telegram", json={"update_id": 1}, headers=bad)).status_code == 403
+        assert delivered == []
+
+    serve(check)
+
+
+def test_updates_and_batches_are_delivered():
+    async def check(client, delivered):
+        assert (await client.post("/telegram", json={"update_id": 1}, headers=SECRET)).status_code == 200
+        batch = [{"update_id": 2}, {"update_id": 3}]
+        assert (await client.post("/telegram", json=batch, headers=SECRET)).status_code == 200
+        assert (await client.post("/telegram", content=b"{nope", headers=SECRET)).status_code == 400
+        too_big = b" " * (MAX_BODY + 1)
+        assert (await client.post("/telegram", content=too_big, headers=SECRET)).status_code == 413
+        assert [u["update_id"] for u in delivered] == [1, 2, 3]
+
+    serve(check)
+
+
+def test_probes_and_rpc():
+    async def check(client, delivered):
+        assert (await client.get("/healthz")).text == "ok\n"
+        assert (await client.get("/readyz")).status_code == 200
+        assert "pigfarm_uptime_seconds" in (await client.get("/metrics")).text
+        assert (await client.get("/nothing")).status_code == 404
+        reply = await client.post("/rpc", json={"op": "ping"}, headers=SECRET)
+        assert reply.json() == {"result": {"echo": {"op": "ping"}}}
+        failed = await client.post("/rpc", json={"op": "boom"}, headers=SECRET)
+        assert failed.status_code == 500 and failed.json() == {"error": "ValueError: no such op"}
+        assert (await client.post("/rpc", json={"op": "ping"})).status_code == 403
+
+    serve(check)
+
+
+def test_not_ready_asks_telegram_to_retry():
+    async def check(client, delivered):
+        assert (await client.get("/readyz")).status_code == 503
+        assert (await client.post("/telegram", json={"update_id": 1}, headers=SECRET)).status_code == 503
+        assert delivered == []
+
+    serve(check, ready=False)
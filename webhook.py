@@ -0,0 +1,233 @@
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import signal
+import ssl
+
+from telegram import Update
+
+from metrics import METRICS
+
+# BOT_MODE=webhook serves updates pushed by Telegram instead of polling.
+# Telegram only pushes to HTTPS on ports 443, 80, 88 or 8443: either give
+# WEBHOOK_CERT/WEBHOOK_KEY, or run plain HTTP behind a TLS reverse proxy.
+# Without WEBHOOK_URL the webhook isn't registered with Telegram, which is
+# how to try it locally with recorded updates:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -d @update.json http://127.0.0.1:8443/telegram
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL, e.g. https://pigs.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "")
+# Parallel connections Telegram may open to us (it allows 1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+MAX_BODY = 1024 * 1024  # updates are a few KB
+IDLE_TIMEOUT = 75  # seconds a kept-alive connection may sit idle
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class WebhookServer:
+    # A small HTTP/1.1 server on asyncio streams, enough for Telegram's
+    # POSTs and for probes:
+    #   POST /<WEBHOOK_PATH>  an update (or a list of them, from the shard
+    #                         router); needs the secret token header
+    #   POST /rpc             a call between shards, see shards.py
+    #   GET  /healthz         the process is up
+    #   GET  /readyz          the bot is started and taking updates
+    #   GET  /metrics         the Prometheus text from metrics.py
+    # deliver(update_dict) takes each update; is_ready() says whether we can
+
+    def __init__(self, deliver, secret, is_ready, path=WEBHOOK_PATH, rpc=None):
+        self.deliver = deliver
+        self.secret = secret.encode()
+        self.is_ready = is_ready
+        self.path = "/" + path
+        self.rpc = rpc
+        self.server = None
+        self.connections = set()
+
+    @property
+    def ready(self):
+        return self.is_ready() and self.server is not None and self.server.is_serving()
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, ssl_context=None):
+        self.server = await asyncio.start_server(self.handle, host, port, ssl=ssl_context)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # Kept-alive connections would otherwise sit in readline() until
+            # the loop goes away
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            while self.connections:
+                await asyncio.sleep(0.01)
+
+    async def handle(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, b"", keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, payload, content_type = await self.route(method, target.split("?")[0], headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, payload, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def respond(self, writer, status, payload, content_type="text/plain", keep_alive=True):
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode() + payload)
+        await writer.drain()
+
+    async def route(self, method, path, headers, body):
+        if method == "POST" and path == self.path:
+            return await self.receive(headers, body)
+        if method == "POST" and path == "/rpc" and self.rpc is not None:
+            return await self.call(headers, body)
+        if method == "GET" and path == "/healthz":
+            return 200, b"ok\n", "text/plain"
+        if method == "GET" and path == "/readyz":
+            return (200, b"ready\n", "text/plain") if self.ready else (503, b"starting\n", "text/plain")
+        if method == "GET" and path == "/metrics":
+            return 200, METRICS.render().encode(), "text/plain; version=0.0.4"
+        return 404, b"", "text/plain"
+
+    def authorized(self, headers):
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+        return hmac.compare_digest(token, self.secret)
+
+    async def receive(self, headers, body):
+        if not self.authorized(headers):
+            return 403, b"", "text/plain"
+        if not self.is_ready():
+            # Telegram retries later
+            return 503, b"", "text/plain"
+        try:
+            updates = json.loads(body)
+            # Answer right away; the updates are processed from a queue
+            for update in updates if isinstance(updates, list) else [updates]:
+                await self.deliver(update)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400, b"", "text/plain"
+        return 200, b"", "text/plain"
+
+    async def call(self, headers, body):
+        if not self.authorized(headers):
+            return 403, b"", "text/plain"
+        if not self.is_ready():
+            return 503, b"", "text/plain"
+        try:
+            reply = {"result": await self.rpc(json.loads(body))}
+        except Exception as e:
+            return 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode(), "application/json"
+        return 200, json.dumps(reply).encode(), "application/json"
+
+
+def webhook_secret():
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    print("⚠️ WEBHOOK_SECRET not set, using a random one for this run")
+    return secrets.token_urlsafe(32)
+
+
+def ssl_context():
+    if not WEBHOOK_CERT:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY or None)
+    return context
+
+
+async def register(bot, secret):
+    # Point Telegram at WEBHOOK_URL. Uploading the certificate lets it trust
+    # a self-signed one.
+    certificate = open(WEBHOOK_CERT, "rb") if WEBHOOK_CERT else None
+    try:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            certificate=certificate,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=secret,
+        )
+    finally:
+        if certificate:
+            certificate.close()
+
+
+def stop_event():
+    # Set on SIGINT/SIGTERM
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def serve(app, rpc=None):
+    # Same lifecycle as Application.run_polling(), with our server in place
+    # of the updater. rpc(request) answers POST /rpc when given.
+    secret = webhook_secret()
+    stop = stop_event()
+
+    async def deliver(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    server = WebhookServer(deliver, secret, lambda: app.running, rpc=rpc)
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await server.start(ssl_context=ssl_context())
+        if WEBHOOK_URL:
+            await register(app.bot, secret)
+        await app.start()
+        print(f"🪝 Webhook listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        # The webhook stays registered, so Telegram holds updates for us
+        # until we're back
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def run(app, rpc=None):
+    asyncio.run(serve(app, rpc))